@@ -28,8 +28,15 @@ import json
 import pytz
 import tempfile
 import stat
+import concurrent.futures
+import threading
+import bisect
+import sqlite3
+import array
+import binascii
 
 from collections import OrderedDict
+from collections.abc import Mapping
 
 import accurev
 import git
@@ -64,6 +71,10 @@ class Config(object):
                 startTransaction = xmlElement.attrib.get('start-transaction')
                 endTransaction   = xmlElement.attrib.get('end-transaction')
                 commandCacheFilename = xmlElement.attrib.get('command-cache-filename')
+                commandCacheMaxSize = xmlElement.attrib.get('command-cache-max-size')
+                if commandCacheMaxSize is not None:
+                    commandCacheMaxSize = int(commandCacheMaxSize)
+                targetedPop = Config.GetBooleanAttribute(xmlElement, 'targeted-pop')
                 
                 excludeStreamTypes = None
                 streamMap = None
@@ -82,11 +93,11 @@ class Config(object):
 
                         streamMap[streamName] = branchName
                 
-                return cls(depot, username, password, startTransaction, endTransaction, streamMap, commandCacheFilename, excludeStreamTypes)
+                return cls(depot, username, password, startTransaction, endTransaction, streamMap, commandCacheFilename, excludeStreamTypes, commandCacheMaxSize, targetedPop)
             else:
                 return None
             
-        def __init__(self, depot = None, username = None, password = None, startTransaction = None, endTransaction = None, streamMap = None, commandCacheFilename = None, excludeStreamTypes = None):
+        def __init__(self, depot = None, username = None, password = None, startTransaction = None, endTransaction = None, streamMap = None, commandCacheFilename = None, excludeStreamTypes = None, commandCacheMaxSize = None, targetedPop = None):
             self.depot    = depot
             self.username = username
             self.password = password
@@ -95,6 +106,8 @@ class Config(object):
             self.streamMap = streamMap
             self.commandCacheFilename = commandCacheFilename
             self.excludeStreamTypes = excludeStreamTypes
+            self.commandCacheMaxSize = commandCacheMaxSize # in megabytes
+            self.targetedPop = targetedPop
     
         def __repr__(self):
             str = "Config.AccuRev(depot=" + repr(self.depot)
@@ -106,6 +119,10 @@ class Config(object):
                 str += ", streamMap="    + repr(self.streamMap)
             if self.commandCacheFilename is not None:
                 str += ", commandCacheFilename=" + repr(self.commandCacheFilename)
+            if self.commandCacheMaxSize is not None:
+                str += ", commandCacheMaxSize=" + repr(self.commandCacheMaxSize)
+            if self.targetedPop is not None:
+                str += ", targetedPop=" + repr(self.targetedPop)
             if self.excludeStreamTypes is not None:
                 str += ", excludeStreamTypes=" + repr(self.excludeStreamTypes)
             str += ")"
@@ -114,6 +131,11 @@ class Config(object):
 
         def UseCommandCache(self):
             return self.commandCacheFilename is not None
+
+        def CommandCacheMaxSizeBytes(self):
+            if self.commandCacheMaxSize is None:
+                return None
+            return self.commandCacheMaxSize * 1024 * 1024
             
     class Git(object):
         @classmethod
@@ -127,6 +149,8 @@ class Config(object):
                 sourceStreamFastForward = xmlElement.attrib.get('source-stream-fast-forward')
                 sourceStreamInferrence = xmlElement.attrib.get('source-stream-inferrence')
                 newBasisIsFirstParent = xmlElement.attrib.get('new-basis-is-first-parent')
+                fastImport = xmlElement.attrib.get('fast-import')
+                checkpointInterval = xmlElement.attrib.get('checkpoint-interval')
 
                 remoteMap = OrderedDict()
                 remoteElementList = xmlElement.findall('remote')
@@ -137,11 +161,11 @@ class Config(object):
                     
                     remoteMap[remoteName] = git.GitRemoteListItem(name=remoteName, url=remoteUrl, pushUrl=remotePushUrl)
 
-                return cls(repoPath=repoPath, messageStyle=messageStyle, messageKey=messageKey, authorIsCommitter=authorIsCommitter, remoteMap=remoteMap, emptyChildStreamAction=emptyChildStreamAction, sourceStreamFastForward=sourceStreamFastForward, sourceStreamInferrence=sourceStreamInferrence, newBasisIsFirstParent=newBasisIsFirstParent)
+                return cls(repoPath=repoPath, messageStyle=messageStyle, messageKey=messageKey, authorIsCommitter=authorIsCommitter, remoteMap=remoteMap, emptyChildStreamAction=emptyChildStreamAction, sourceStreamFastForward=sourceStreamFastForward, sourceStreamInferrence=sourceStreamInferrence, newBasisIsFirstParent=newBasisIsFirstParent, fastImport=fastImport, checkpointInterval=checkpointInterval)
             else:
                 return None
             
-        def __init__(self, repoPath, messageStyle=None, messageKey=None, authorIsCommitter=None, remoteMap=None, emptyChildStreamAction=None, sourceStreamFastForward=None, sourceStreamInferrence=None, newBasisIsFirstParent=None):
+        def __init__(self, repoPath, messageStyle=None, messageKey=None, authorIsCommitter=None, remoteMap=None, emptyChildStreamAction=None, sourceStreamFastForward=None, sourceStreamInferrence=None, newBasisIsFirstParent=None, fastImport=None, checkpointInterval=None):
             self.repoPath               = repoPath
             self.messageStyle           = messageStyle
             self.messageKey             = messageKey
@@ -188,6 +212,24 @@ class Config(object):
             else:
                 self.newBasisIsFirstParent = True
 
+            if fastImport is not None:
+                fastImport = fastImport.lower()
+                if fastImport not in [ "true", "false" ]:
+                    raise Exception("Error, the fast-import attribute only accepts true or false options but got: {0}".format(fastImport))
+                self.fastImport = (fastImport == "true")
+            else:
+                self.fastImport = False
+
+            if checkpointInterval is not None:
+                try:
+                    self.checkpointInterval = int(checkpointInterval)
+                except ValueError:
+                    self.checkpointInterval = 0
+                if self.checkpointInterval < 1:
+                    raise Exception("Error, the checkpoint-interval attribute only accepts a positive number of transactions but got: {0}".format(checkpointInterval))
+            else:
+                self.checkpointInterval = 100
+
         def __repr__(self):
             str = "Config.Git(repoPath=" + repr(self.repoPath)
             if self.messageStyle is not None:
@@ -200,6 +242,10 @@ class Config(object):
                 str += ", authorIsCommitter="    + repr(self.authorIsCommitter)
             if self.newBasisIsFirstParent is not None:
                 str += ", newBasisIsFirstParent=" + repr(self.newBasisIsFirstParent)
+            if self.fastImport:
+                str += ", fastImport=" + repr(self.fastImport)
+            if self.checkpointInterval is not None:
+                str += ", checkpointInterval=" + repr(self.checkpointInterval)
             str += ")"
             
             return str
@@ -413,6 +459,103 @@ class Config(object):
         
         return str
 
+# The transactions that ProcessTransactions() works through, i.e. { <key:tr_num>: { <key:stream_num>: { "state_hash": <val:commit_hash>, "data_hash": <val:data_hash>,
+# "data_tree_hash": <val:tree_hash> } } }, stored column by column: a sorted array of transaction ids with the offset of each transaction's first row, and
+# per row the stream number and the binary hashes. Indexing it by a transaction id returns a read-only TransactionMap.Transaction view which builds the
+# per stream dictionaries on demand, so that only the transaction being processed is expanded into python objects.
+class TransactionMap(object):
+    class Transaction(Mapping):
+        def __init__(self, transactionMap, start, end):
+            self.transactionMap = transactionMap
+            self.start = start
+            self.end = end
+
+        def _row(self, streamNumber):
+            try:
+                streamNumber = int(streamNumber)
+            except (TypeError, ValueError):
+                return None
+            for row in range(self.start, self.end):
+                if self.transactionMap.streams[row] == streamNumber:
+                    return row
+            return None
+
+        def __getitem__(self, streamNumber):
+            row = self._row(streamNumber)
+            if row is None:
+                raise KeyError(streamNumber)
+            return self.transactionMap.StreamData(row)
+
+        def __contains__(self, streamNumber):
+            return self._row(streamNumber) is not None
+
+        def __iter__(self):
+            for row in range(self.start, self.end):
+                yield self.transactionMap.streams[row]
+
+        def __len__(self):
+            return self.end - self.start
+
+        def __repr__(self):
+            return "TransactionMap.Transaction(" + repr(dict(self.items())) + ")"
+
+    def __init__(self):
+        self.transactions = array.array('q') # Sorted transaction ids.
+        self.offsets = array.array('q') # Index of the first row of each transaction.
+        self.streams = array.array('q') # Stream number of each row.
+        self.hasData = bytearray() # 1 if the row has a data commit, the data hashes of the other rows are zeroes.
+        self.stateHashes = bytearray()
+        self.dataHashes = bytearray()
+        self.dataTreeHashes = bytearray()
+        self.hashSize = None # Size of a binary hash in bytes, 20 for sha1 and 32 for sha256.
+
+    # Adds a row. Rows must be added in transaction order.
+    def Append(self, trId, streamNumber, stateHash, dataHash=None, dataTreeHash=None):
+        if len(self.transactions) == 0 or self.transactions[-1] != trId:
+            if len(self.transactions) > 0 and self.transactions[-1] > trId:
+                raise Exception("Transaction {tr} was added after transaction {last}!".format(tr=trId, last=self.transactions[-1]))
+            self.transactions.append(trId)
+            self.offsets.append(len(self.streams))
+        stateHash = bytes.fromhex(stateHash)
+        if self.hashSize is None:
+            self.hashSize = len(stateHash)
+        self.streams.append(streamNumber)
+        self.stateHashes.extend(stateHash)
+        if dataHash is not None:
+            self.hasData.append(1)
+            self.dataHashes.extend(bytes.fromhex(dataHash))
+            self.dataTreeHashes.extend(bytes.fromhex(dataTreeHash))
+        else:
+            self.hasData.append(0)
+            self.dataHashes.extend(bytes(self.hashSize))
+            self.dataTreeHashes.extend(bytes(self.hashSize))
+
+    def StreamData(self, row):
+        begin, end = row * self.hashSize, (row + 1) * self.hashSize
+        # binascii.hexlify() rather than bytearray.hex(), which needs Python 3.5.
+        streamData = { "state_hash": binascii.hexlify(self.stateHashes[begin:end]).decode('ascii') }
+        if self.hasData[row]:
+            streamData["data_hash"] = binascii.hexlify(self.dataHashes[begin:end]).decode('ascii')
+            streamData["data_tree_hash"] = binascii.hexlify(self.dataTreeHashes[begin:end]).decode('ascii')
+        return streamData
+
+    def __getitem__(self, trId):
+        i = bisect.bisect_left(self.transactions, trId)
+        if i == len(self.transactions) or self.transactions[i] != trId:
+            raise KeyError(trId)
+        end = self.offsets[i + 1] if i + 1 < len(self.offsets) else len(self.streams)
+        return TransactionMap.Transaction(self, self.offsets[i], end)
+
+    def __contains__(self, trId):
+        i = bisect.bisect_left(self.transactions, trId)
+        return i < len(self.transactions) and self.transactions[i] == trId
+
+    def __iter__(self):
+        return iter(self.transactions)
+
+    def __len__(self):
+        return len(self.transactions)
+
 # Prescribed recepie:
 # - Get the list of tracked streams from the config file.
 # - For each stream in the list
@@ -440,10 +583,71 @@ class AccuRev2Git(object):
 
     cachedDepots = None
 
+    histPageSize = 250 # Number of transactions retrieved by a single `accurev hist -p <depot> -t <start>-<end>` page.
+    histPageCacheSize = 16 # Number of hist pages that are kept in memory. Older pages are re-read from the command cache (if enabled).
+    prefetchDepth = 4 # Number of upcoming deep-hist candidate transactions whose accurev information is retrieved in the background.
+    prefetchMaxPending = 32 # Maximum number of prefetched accurev results (finished or not) that are held in memory.
+    diffProbeMaxWindow = 8 # Maximum number of `accurev diff` commands that the diff method runs concurrently. A value of 1 probes one transaction at a time.
+    infoCacheMaxBytes = 64 * 1024 * 1024 # Memory budget, measured in bytes of xml, for the parsed info files that are kept in memory (see GetInfoFile()). Set to 0 to disable.
+    transactionIndexFilename = 'transactions.sqlite3' # Stored in the .git/ac2git/ directory, see OpenTransactionIndex().
+    transactionIndexTableQuery = '''
+CREATE TABLE IF NOT EXISTS transactions (
+  depot          INT NOT NULL,
+  stream         INT NOT NULL,
+  tr             INT NOT NULL,
+  state_hash     TEXT,
+  data_hash      TEXT,
+  data_tree_hash TEXT,
+  PRIMARY KEY (depot, stream, tr)
+);
+CREATE TABLE IF NOT EXISTS indexed_refs (
+  ref TEXT PRIMARY KEY NOT NULL,
+  tip TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS stream_names (
+  depot         INT NOT NULL,
+  name          TEXT NOT NULL,
+  stream        INT NOT NULL,
+  source_stream INT NOT NULL,
+  tr            INT NOT NULL,
+  state_hash    TEXT NOT NULL,
+  PRIMARY KEY (depot, name, stream, source_stream)
+);
+'''
+
     def __init__(self, config):
         self.config = config
         self.cwd = None
         self.gitRepo = None
+        self.histPages = OrderedDict()
+        self.histPageEnd = None # The last transaction that can be retrieved in a page. Paging is disabled while it is None.
+        self.streamTimeline = None # accurev.ext.StreamTimeline for the depot being retrieved, see RetrieveStreams().
+        self.diffProbePool = None # concurrent.futures.ThreadPoolExecutor for the diff method, see FindNextDiffTransaction().
+        self.diffProbeWindow = 1
+        self.prefetchPool = None # concurrent.futures.ThreadPoolExecutor for the prefetched accurev results, see Prefetch().
+        self.prefetches = OrderedDict() # key -> concurrent.futures.Future, oldest first.
+        self.prefetchLock = threading.Lock()
+        self.fastImport = None # git.repo.fast_import for the data refs, see FastImportDataCommit().
+        self.deepHistLists = None # Stream number -> transactions from accurev.ext.multi_deep_hist(), see PrepareDeepHist().
+        self.deepHistStart = None
+        self.infoCache = OrderedDict() # (blob hash, filename) -> (xml, parsed object), least recently used first. See GetInfoFile().
+        self.infoCacheBytes = 0
+        self.infoCacheHits = 0
+        self.infoCacheMisses = 0
+        self.refTransaction = None # git.repo.ref_transaction that queues the ref updates of the transaction being processed, see BeginRefTransaction().
+        self.commitHistoryTips = {} # commit_history ref -> the commit it points to (or will point to once the ref transaction is committed), see LogBranchState().
+        self.commitHistoryObjects = [] # (hash, data) of the commit_history commits that haven't been written yet, see WriteCommitHistory().
+        self.commitHistoryEmptyTree = None
+        self.branchPositions = {} # commit_history ref -> the (timestamp, branch commit) positions recorded on it, see LoadBranchPositions().
+        self.pendingNotes = OrderedDict() # notes ref -> { commit hash: note } queued by AddNote(), see WriteNotes().
+        self.pendingNotesTransaction = None
+        self.branchHeads = None # Tracked branch name -> commit hash (None if it doesn't exist yet) while processing transactions, see LoadBranchHeads().
+        self.branchTags = None # Tracked branch name -> commit of the tag with the same name (snapshot streams are converted to tags).
+        self.currentBranch = None
+        self.branchHeadsUndo = {} # Tracked branch name -> commit hash before the updates queued in the ref transaction, see RestoreBranchHeads().
+        self.stateJournal = None # File to which ProcessTransactions() appends the branch changes between two state checkpoints, see WriteStateCheckpoint().
+        self.transactionIndex = None # sqlite3 connection to the transaction index, see OpenTransactionIndex().
+        self.transactionIndexSynced = set() # Depots whose stream refs were brought up to date in the transaction index, see SyncDepotTransactionIndex().
 
     # Returns True if the path was deleted, otherwise false
     def DeletePath(self, path):
@@ -474,21 +678,26 @@ class AccuRev2Git(object):
                 if git.GetGitDirPrefix(path) is None:
                     self.DeletePath(path)
 
-    def PreserveEmptyDirs(self):
+    def PreserveEmptyDirs(self, path=None):
         preservedDirs = []
-        for root, dirs, files in os.walk(self.gitRepo.path, topdown=True):
+        for root, dirs, files in os.walk(self.gitRepo.path if path is None else path, topdown=True):
             for name in dirs:
                 path = ToUnixPath(os.path.join(root, name))
                 # Preserve empty directories that are not under the .git/ directory.
                 if git.GetGitDirPrefix(path) is None and len(os.listdir(path)) == 0:
-                    filename = os.path.join(path, '.gitignore')
-                    with codecs.open(filename, 'w', 'utf-8') as file:
-                        #file.write('# accurev2git.py preserve empty dirs\n')
-                        preservedDirs.append(filename)
-                    if not os.path.exists(filename):
-                        logger.error("Failed to preserve directory. Couldn't create '{0}'.".format(filename))
+                    preservedDirs.append(self.PreserveEmptyDir(path))
         return preservedDirs
 
+    # Adds an empty .gitignore file to the directory so that git will keep it and returns its path.
+    def PreserveEmptyDir(self, path):
+        filename = os.path.join(path, '.gitignore')
+        with codecs.open(filename, 'w', 'utf-8') as file:
+            #file.write('# accurev2git.py preserve empty dirs\n')
+            pass
+        if not os.path.exists(filename):
+            logger.error("Failed to preserve directory. Couldn't create '{0}'.".format(filename))
+        return filename
+
     def DeleteEmptyDirs(self):
         deletedDirs = []
         for root, dirs, files in os.walk(self.gitRepo.path, topdown=True):
@@ -622,9 +831,130 @@ class AccuRev2Git(object):
             time.sleep(AccuRev2Git.commandFailureSleepSeconds)
         return rv
 
+    # Starts queueing the ref updates made by UpdateAndCheckoutRef() (without a checkout) and WriteFileRef() so that CommitRefTransaction() can apply
+    # them together, with a single `git update-ref --stdin` command. Until then the ref lookups made while processing a transaction (GetLastCommitHash(),
+    # GetTreeFromRef(), GitRevParse(), GetOrphanCommit(), GetBasisCommitHash() and ReadFileRef()) see the queued values through GetPendingRef().
+    def BeginRefTransaction(self):
+        if self.refTransaction is None:
+            self.refTransaction = git.repo.ref_transaction(self.gitRepo)
+            self.branchHeadsUndo = {}
+
+    def CommitRefTransaction(self):
+        refTransaction, self.refTransaction = self.refTransaction, None
+        if self.WriteCommitHistory() != True or (refTransaction is not None and self.WriteNotes(refTransaction=refTransaction) != True):
+            self.commitHistoryTips, self.branchPositions = {}, {}
+            self.RestoreBranchHeads()
+            return False
+        if refTransaction is not None and refTransaction.commit() != True:
+            self.commitHistoryTips, self.branchPositions = {}, {}
+            self.RestoreBranchHeads()
+            logger.error( "Failed to update {count} refs. Error:\n{err}".format(count=len(refTransaction), err=self.gitRepo.lastStderr) )
+            return False
+        self.branchHeadsUndo = {}
+        return True
+
+    def AbortRefTransaction(self):
+        if self.refTransaction is not None:
+            self.refTransaction.abort()
+            self.refTransaction = None
+        self.commitHistoryObjects = []
+        self.commitHistoryTips = {}
+        self.branchPositions = {} # May contain positions that were never written, reloaded on demand.
+        self.pendingNotes = OrderedDict()
+        self.pendingNotesTransaction = None
+        self.RestoreBranchHeads()
+
+    # Returns the hash that a ref or branch name will point to once the current ref transaction is committed or None if it wasn't updated.
+    def GetPendingRef(self, name):
+        if self.refTransaction is None or name is None or len(self.refTransaction) == 0:
+            return None
+        if not name.startswith('refs/'):
+            name = u'refs/heads/{branch}'.format(branch=name)
+        return self.refTransaction.get(name)
+
+    # Loads the commits of the tracked branches, and of the tags that snapshot streams are converted to, with a single git command so that
+    # GetLastCommitHash() can answer for them from memory. The table is kept up to date by UpdateAndCheckoutRef() and TagTransaction(), which
+    # also write the changes through to git.
+    def LoadBranchHeads(self, branchNames):
+        refList = self.gitRepo.raw_cmd([ u'git', u'for-each-ref', u'--format=%(refname) %(objectname) %(*objectname)', u'refs/heads/', u'refs/tags/' ])
+        if refList is None:
+            raise Exception("Failed to list the branches. Err: {err}".format(err=self.gitRepo.lastStderr))
+
+        branchHeads = OrderedDict([ (name, None) for name in sorted(branchNames) ])
+        branchTags = {}
+        for line in refList.strip().split('\n'):
+            columns = line.split()
+            if len(columns) < 2:
+                continue
+            ref, objHash = columns[0], columns[-1] # The last column is the commit that an annotated tag points to.
+            if ref.startswith('refs/heads/') and ref[len('refs/heads/'):] in branchHeads:
+                branchHeads[ref[len('refs/heads/'):]] = objHash
+            elif ref.startswith('refs/tags/') and ref[len('refs/tags/'):] in branchHeads:
+                branchTags[ref[len('refs/tags/'):]] = objHash
+
+        currentBranch = self.gitRepo.raw_cmd([ u'git', u'symbolic-ref', u'--quiet', u'--short', u'HEAD' ])
+        self.currentBranch = currentBranch.strip() if currentBranch is not None else None
+        self.branchHeads, self.branchTags = branchHeads, branchTags
+
+    # Records the new commit of a tracked branch in the table once its ref was updated (or queued in the ref transaction, see RestoreBranchHeads()).
+    # HEAD refers to the current branch.
+    def SetBranchHead(self, ref, commitHash, queued=False):
+        if self.branchHeads is None:
+            return
+        name = self.currentBranch if ref == 'HEAD' else ref
+        if name is not None and name.startswith('refs/heads/'):
+            name = name[len('refs/heads/'):]
+        elif ref != 'HEAD':
+            name = None
+        if name in self.branchHeads:
+            if queued and name not in self.branchHeadsUndo:
+                self.branchHeadsUndo[name] = self.branchHeads[name]
+            self.branchHeads[name] = commitHash
+
+    # Records the branch that `git checkout <ref>` checked out. Only the name of an existing branch checks it out, a full ref name, a tag or a commit
+    # detach the HEAD. The branches that aren't tracked don't matter to the table so they are treated as a detached HEAD as well.
+    def SetCurrentBranch(self, ref):
+        if self.branchHeads is None:
+            return
+        self.currentBranch = ref if self.branchHeads.get(ref) is not None else None
+
+    # Puts back the commits of the tracked branches whose updates were queued in a ref transaction that failed or was aborted, none of which
+    # reached git.
+    def RestoreBranchHeads(self):
+        if self.branchHeads is not None:
+            for name, commitHash in self.branchHeadsUndo.items():
+                self.branchHeads[name] = commitHash
+        self.branchHeadsUndo = {}
+
+    # Returns the existing tracked branches in the format of the "branch_list" that is stored in the state ref, see ProcessTransactions().
+    def GetBranchHeadList(self):
+        branchList = []
+        for name in self.branchHeads:
+            if self.branchHeads[name] is not None:
+                brHash = OrderedDict()
+                brHash["name"] = name
+                brHash["commit"] = self.branchHeads[name]
+                brHash["is_current"] = (name == self.currentBranch)
+                branchList.append(brHash)
+        return branchList
+
     def GetLastCommitHash(self, branchName=None, ref=None, retry=True):
         cmd = []
-        commitHash = None
+        if self.branchHeads is not None:
+            # Like git, prefer the tag when a branch name refers to both. A ref is only looked up in the branches.
+            name = ref if ref is not None else branchName
+            if name is not None and name.startswith('refs/heads/'):
+                name = name[len('refs/heads/'):]
+            elif ref is not None:
+                name = None
+            if name in self.branchHeads:
+                if ref is None and name in self.branchTags:
+                    return self.branchTags[name]
+                return self.branchHeads[name]
+
+        commitHash = self.GetPendingRef(name=(ref if ref is not None else branchName))
+        if commitHash is not None:
+            return commitHash
         if ref is not None:
             cmd = [ u'git', u'show-ref', u'--hash', ref ]
         else:
@@ -643,7 +973,8 @@ class AccuRev2Git(object):
         treeHash = None
         cmd = [u'git', u'log', u'-1', u'--format=format:%T']
         if ref is not None:
-            cmd.append(ref)
+            pendingHash = self.GetPendingRef(name=ref)
+            cmd.append(ref if pendingHash is None else pendingHash)
         treeHash = self.TryGitCommand(cmd=cmd)
 
         if treeHash is None:
@@ -651,18 +982,29 @@ class AccuRev2Git(object):
 
         return treeHash
 
-    def UpdateAndCheckoutRef(self, ref, commitHash, checkout=True):
+    def UpdateAndCheckoutRef(self, ref, commitHash, checkout=True, oldCommitHash=None):
         if ref is not None and commitHash is not None and len(ref) > 0 and len(commitHash) > 0:
             # refs/heads are branches which are updated automatically when you commit to them (provided we have them checked out).
             # so at least raise a warning for the user.
 
+            if self.refTransaction is not None and not checkout and ref.startswith('refs/'):
+                # Applied by CommitRefTransaction(). The old value is only checked for the first update of the ref in this transaction.
+                if oldCommitHash is not None and re.match(r'^[0-9a-f]{40,64}$', oldCommitHash.strip()) is None:
+                    oldCommitHash = None
+                self.refTransaction.update(ref=ref, newValue=commitHash, oldValue=(oldCommitHash.strip() if oldCommitHash is not None else None))
+                self.SetBranchHead(ref=ref, commitHash=commitHash, queued=True)
+                return True
+
             # If we were asked to update a ref, not updating it is considered a failure to commit.
             if self.gitRepo.raw_cmd([ u'git', u'update-ref', ref, commitHash ]) is None:
                 logger.error( "Failed to update ref {ref} to commit {hash}".format(ref=ref, hash=commitHash) )
                 return False
+            self.SetBranchHead(ref=ref, commitHash=commitHash)
             if checkout and ref != 'HEAD' and self.gitRepo.checkout(branchName=ref) is None: # no point in checking out HEAD if that's what we've updated!
                 logger.error( "Failed to checkout ref {ref} to commit {hash}".format(ref=ref, hash=commitHash) )
                 return False
+            elif checkout and ref != 'HEAD':
+                self.SetCurrentBranch(ref=ref)
 
             return True
 
@@ -686,7 +1028,8 @@ class AccuRev2Git(object):
             pass
         if ref is not None and status.branch != ref:
             logger.debug( "Checkout {ref}".format(ref=ref) )
-            self.gitRepo.checkout(branchName=ref)
+            if self.gitRepo.checkout(branchName=ref) is not None:
+                self.SetCurrentBranch(ref=ref)
             status = self.gitRepo.status()
             logger.debug( "On branch {branch} - {staged} staged, {changed} changed, {untracked} untracked files{initial_commit}.".format(branch=status.branch, staged=len(status.staged), changed=len(status.changed), untracked=len(status.untracked), initial_commit=', initial commit' if status.initial_commit else '') )
             if status is None:
@@ -763,12 +1106,14 @@ class AccuRev2Git(object):
             committerName, committerEmail, committerDate, committerTimezone = authorName, authorEmail, authorDate, authorTimezone
 
         lastCommitHash = None
+        lastCommitHashIsRef = False # True when lastCommitHash is where the ref pointed to before this commit.
         if parents is None:
             lastCommitHash = self.GetLastCommitHash(ref=ref) # If ref is None, it will get the last commit hash from the HEAD ref.
             if lastCommitHash is None:
                 parents = []
             else:
                 parents = [ lastCommitHash ]
+                lastCommitHashIsRef = (ref is not None)
         elif len(parents) != 0:
             lastCommitHash = parents[0]
 
@@ -790,8 +1135,8 @@ class AccuRev2Git(object):
             commitResult = self.gitRepo.commit(message_file=messageFilePath, committer_name=committerName, committer_email=committerEmail, committer_date=committerDate, committer_tz=committerTimezone, author_name=authorName, author_email=authorEmail, author_date=authorDate, author_tz=authorTimezone, allow_empty_message=True, allow_empty=allowEmptyCommit, cleanup='whitespace', git_opts=[u'-c', u'core.autocrlf=false'])
             if commitResult is not None:
                 commitHash = commitResult.shortHash
-                if commitHash is None:
-                    commitHash = self.GetLastCommitHash()
+                if commitHash is None or self.branchHeads is not None:
+                    commitHash = self.GetLastCommitHash() # The full hash, which UpdateAndCheckoutRef() records in the branch table.
             elif "nothing to commit" in self.gitRepo.lastStdout:
                 logger.debug( "nothing to commit{0}...?".format(forTrMessage) )
             else:
@@ -803,7 +1148,7 @@ class AccuRev2Git(object):
         if commitHash is not None:
             if ref is None:
                 ref = 'HEAD'
-            if self.UpdateAndCheckoutRef(ref=ref, commitHash=commitHash, checkout=(checkout and ref != 'HEAD')) != True:
+            if self.UpdateAndCheckoutRef(ref=ref, commitHash=commitHash, checkout=(checkout and ref != 'HEAD'), oldCommitHash=(lastCommitHash if lastCommitHashIsRef else None)) != True:
                 logger.error( "Failed to update ref {ref} with commit {h}{forTr}".format(ref=ref, h=commitHash, forTr=forTrMessage) )
                 commitHash = None
 
@@ -849,6 +1194,9 @@ class AccuRev2Git(object):
     def FindNextChangeTransaction(self, streamName, startTrNumber, endTrNumber, deepHist=None):
         # Iterate over transactions in order using accurev diff -a -i -v streamName -V streamName -t <lastProcessed>-<current iterator>
         if self.config.method == "diff":
+            if AccuRev2Git.diffProbeMaxWindow > 1:
+                return self.FindNextDiffTransaction(streamName=streamName, startTrNumber=startTrNumber, endTrNumber=endTrNumber)
+
             nextTr = startTrNumber + 1
             diff, diffXml = self.TryDiff(streamName=streamName, firstTrNumber=startTrNumber, secondTrNumber=nextTr)
             if diff is None:
@@ -892,6 +1240,49 @@ class AccuRev2Git(object):
             logger.error("Method is unrecognized, allowed values are 'pop', 'diff' and 'deep-hist'")
             raise Exception("Invalid configuration, method unrecognized!")
 
+    # The windowed version of the diff method of FindNextChangeTransaction(). It probes the same transactions, from startTrNumber + 1 up to
+    # endTrNumber + 1, but runs the next self.diffProbeWindow `accurev diff` commands concurrently and takes the first failed or non-empty diff
+    # in transaction order, so the result is the same as probing them one at a time. The window doubles after every window of empty diffs and
+    # is set to the number of empty diffs that preceded a change once one is found.
+    def FindNextDiffTransaction(self, streamName, startTrNumber, endTrNumber):
+        if self.diffProbePool is None:
+            self.diffProbePool = concurrent.futures.ThreadPoolExecutor(max_workers=AccuRev2Git.diffProbeMaxWindow)
+
+        lastTr = max(startTrNumber + 1, endTrNumber + 1)
+        nextTr = startTrNumber + 1
+        emptyCount = 0
+        diff = None
+        while nextTr <= lastTr:
+            windowEnd = min(nextTr + self.diffProbeWindow - 1, lastTr)
+            probes = [ (trNumber, self.diffProbePool.submit(self.TryDiff, streamName, startTrNumber, trNumber)) for trNumber in range(nextTr, windowEnd + 1) ]
+            for i, (trNumber, probe) in enumerate(probes):
+                diff, diffXml = probe.result()
+                if diff is None or len(diff.elements) > 0:
+                    for laterTrNumber, laterProbe in probes[i + 1:]:
+                        laterProbe.cancel()
+                    self.diffProbeWindow = max(1, min(emptyCount, AccuRev2Git.diffProbeMaxWindow))
+                    if diff is None:
+                        return (None, None)
+                    logger.debug("FindNextChangeTransaction diff: {0} (window {1})".format(trNumber, len(probes)))
+                    return (trNumber, diff)
+                emptyCount += 1
+            nextTr = windowEnd + 1
+            self.diffProbeWindow = min(self.diffProbeWindow * 2, AccuRev2Git.diffProbeMaxWindow)
+
+        logger.debug("FindNextChangeTransaction diff: {0}".format(lastTr))
+        return (lastTr, diff)
+
+    # Converts an accurev depot relative path (e.g. /./dir/file) into an absolute path in the git worktree.
+    def GetWorktreePath(self, depotPath):
+        name = depotPath
+        if name.startswith('\\.\\') or name.startswith('/./'):
+            # Replace the accurev depot relative path start with a normal relative path.
+            name = name[3:]
+        if os.path.isabs(name):
+            # For os.path.join() to work we need a non absolute path so turn the absolute path (minus any drive letter or UNC path part) into a relative path w.r.t. the git repo.
+            name = os.path.splitdrive(name)[1][1:]
+        return os.path.abspath(os.path.join(self.gitRepo.path, name))
+
     def DeleteDiffItemsFromRepo(self, diff):
         # Delete all of the files which are even mentioned in the diff so that we can do a quick populate (wouth the overwrite option)
         deletedPathList = []
@@ -899,14 +1290,7 @@ class AccuRev2Git(object):
             for change in element.changes:
                 for stream in [ change.stream1, change.stream2 ]:
                     if stream is not None and stream.name is not None:
-                        name = stream.name
-                        if name.startswith('\\.\\') or name.startswith('/./'):
-                            # Replace the accurev depot relative path start with a normal relative path.
-                            name = name[3:]
-                        if os.path.isabs(name):
-                            # For os.path.join() to work we need a non absolute path so turn the absolute path (minus any drive letter or UNC path part) into a relative path w.r.t. the git repo.
-                            name = os.path.splitdrive(name)[1][1:]
-                        path = os.path.abspath(os.path.join(self.gitRepo.path, name))
+                        path = self.GetWorktreePath(stream.name)
 
                         # Ensure we restrict the deletion to the git repository and that we don't delete the git repository itself.
                         doClearAll = False
@@ -934,7 +1318,13 @@ class AccuRev2Git(object):
 
         return deletedPathList
 
-    def TryDiff(self, streamName, firstTrNumber, secondTrNumber):
+    def TryDiff(self, streamName, firstTrNumber, secondTrNumber, usePrefetched=True):
+        if usePrefetched:
+            prefetched = self.TakePrefetched(key=('diff', streamName, firstTrNumber, secondTrNumber))
+            if prefetched is not None and prefetched[0] is not None:
+                return prefetched
+
+        diff = None
         for i in range(0, AccuRev2Git.commandFailureRetryCount):
             diffXml = accurev.raw.diff(all=True, informationOnly=True, verSpec1=streamName, verSpec2=streamName, transactionRange="{0}-{1}".format(firstTrNumber, secondTrNumber), isXmlOutput=True, useCache=self.config.accurev.UseCommandCache())
             if diffXml is not None:
@@ -946,6 +1336,11 @@ class AccuRev2Git(object):
         return diff, diffXml
 
     def TryHist(self, depot, timeSpec, streamName=None, transactionKind=None):
+        if streamName is None and transactionKind is None:
+            trHist, trHistXml = self.GetPagedHist(depot=depot, timeSpec=timeSpec)
+            if trHist is not None:
+                return trHist, trHistXml
+
         trHist = None
         for i in range(0, AccuRev2Git.commandFailureRetryCount):
             trHistXml = accurev.raw.hist(depot=depot, stream=streamName, timeSpec=timeSpec, transactionKind=transactionKind, useCache=self.config.accurev.UseCommandCache(), isXmlOutput=True, expandedMode=True, verboseMode=True)
@@ -955,6 +1350,128 @@ class AccuRev2Git(object):
                     break
         return trHist, trHistXml
 
+    # Serves single transaction `accurev hist -p <depot> -t <tr> -fexv` queries from pages of `accurev hist -p <depot> -t <start>-<end> -fexv`
+    # so that every stream retrieved in this run shares the same hist round-trips. Returns (None, None) if the transaction should be queried
+    # on its own (keywords, transactions past the histPageEnd or transactions which can't be split out of a page, see accurev.obj.History.splitxmlstring()).
+    def GetPagedHist(self, depot, timeSpec):
+        if self.histPageEnd is None or depot is None:
+            return None, None
+        try:
+            trId = int(timeSpec)
+        except (TypeError, ValueError):
+            return None, None
+        if trId < 1 or trId > self.histPageEnd:
+            return None, None
+
+        transactions, items = self.GetHistPage(depot=depot, trId=trId)
+        return items.get(trId, (None, None))
+
+    # Returns the page of the depot history that contains the trId (see LoadHistPage()). The trId must not be past the histPageEnd.
+    def GetHistPage(self, depot, trId):
+        pageStart = trId - ((trId - 1) % AccuRev2Git.histPageSize)
+        pageEnd = min(pageStart + AccuRev2Git.histPageSize - 1, self.histPageEnd)
+        pageKey = (depot, pageStart, pageEnd)
+        page = self.histPages.get(pageKey)
+        if page is None:
+            page = self.TakePrefetched(key=('hist',) + pageKey)
+            if page is None:
+                page = self.LoadHistPage(depot=depot, pageStart=pageStart, pageEnd=pageEnd)
+            self.histPages[pageKey] = page
+            while len(self.histPages) > AccuRev2Git.histPageCacheSize:
+                self.histPages.popitem(last=False)
+        else:
+            self.histPages.move_to_end(pageKey)
+        return page
+
+    # Returns the list of obj.Transaction objects between the start and end transactions from the depot history pages (see GetHistPage()) or None if
+    # one of the pages couldn't be retrieved. Used by PrepareDeepHist() so that the deep-hist and the retrieval share the same hist commands.
+    def GetHistPageTransactions(self, depot, start, end):
+        rv = []
+        trId = start
+        while trId <= end:
+            transactions, items = self.GetHistPage(depot=depot, trId=trId)
+            if transactions is None:
+                return None
+            rv.extend([ tr for tr in transactions if start <= tr.id <= end ])
+            trId = trId - ((trId - 1) % AccuRev2Git.histPageSize) + AccuRev2Git.histPageSize
+        return rv
+
+    # Returns the page of the depot history between pageStart and pageEnd as a tuple of (transactions, items) where transactions is the list of
+    # obj.Transaction objects in the page, or None if it couldn't be retrieved, and items is a dictionary of transaction number -> (obj.History, xml).
+    # See GetPagedHist().
+    def LoadHistPage(self, depot, pageStart, pageEnd):
+        transactions, items = None, {}
+        for i in range(0, AccuRev2Git.commandFailureRetryCount):
+            pageXml = accurev.raw.hist(depot=depot, timeSpec="{0}-{1}".format(pageStart, pageEnd), useCache=self.config.accurev.UseCommandCache(), isXmlOutput=True, expandedMode=True, verboseMode=True)
+            if pageXml is not None:
+                pageHist = accurev.obj.History.fromxmlstring(pageXml)
+                pageItems = accurev.obj.History.splitxmlstring(pageXml)
+                if pageHist is not None and pageItems is not None:
+                    transactions = pageHist.transactions
+                    for pageTrId, pageTrHist, pageTrHistXml in pageItems:
+                        items[pageTrId] = (pageTrHist, pageTrHistXml)
+                    break
+        else:
+            logger.warning("accurev hist -p {0} -t {1}-{2} failed. Falling back to querying one transaction at a time.".format(depot, pageStart, pageEnd))
+        logger.debug("Retrieved hist page {0}-{1} ({2} transactions).".format(pageStart, pageEnd, len(items)))
+        return transactions, items
+
+    # Runs function(*args) on the prefetch thread pool and keeps its result under the given key until TakePrefetched() is called for it.
+    # At most prefetchMaxPending results are kept, the oldest are dropped (and cancelled if they haven't started) to make room for new ones.
+    def Prefetch(self, key, function, *args):
+        with self.prefetchLock:
+            if key in self.prefetches:
+                return
+            if self.prefetchPool is None:
+                self.prefetchPool = concurrent.futures.ThreadPoolExecutor(max_workers=AccuRev2Git.prefetchDepth)
+            while len(self.prefetches) >= AccuRev2Git.prefetchMaxPending:
+                oldKey, oldFuture = self.prefetches.popitem(last=False)
+                oldFuture.cancel()
+            self.prefetches[key] = self.prefetchPool.submit(function, *args)
+
+    # Returns the prefetched result for the key, waiting for it if it is still running, or None if it wasn't prefetched (or hasn't started yet
+    # in which case it is cancelled and the caller should run it itself).
+    def TakePrefetched(self, key):
+        with self.prefetchLock:
+            future = self.prefetches.pop(key, None)
+        if future is None or future.cancel():
+            return None
+        try:
+            return future.result()
+        except Exception as e:
+            logger.debug("Prefetch of {key} failed: {err}".format(key=key, err=e))
+            return None
+
+    # Cancels the prefetches that haven't started and waits for the running ones so that no accurev commands are left running in the background
+    # when the caller goes on to change the workspace (e.g. with accurev pop or chstream).
+    def ClearPrefetched(self):
+        with self.prefetchLock:
+            running = [ future for future in self.prefetches.values() if not future.cancel() ]
+            self.prefetches.clear()
+        concurrent.futures.wait(running)
+
+    # Retrieves, in the background, the accurev information that RetrieveStreamInfo() will need for the next prefetchDepth candidate transactions
+    # in the deep-hist after the startTrNumber, assuming that each of them will be committed in turn. That is the diff from the previous candidate
+    # (see FindNextChangeTransaction()), the diff to the transaction before it and the depot history page (see GetInfoFiles()).
+    def PrefetchStreamInfo(self, depot, streamName, deepHist, startTrNumber, endTrNumber):
+        prevTrNumber = startTrNumber
+        count = 0
+        for tr in deepHist:
+            if count >= AccuRev2Git.prefetchDepth or tr.id > endTrNumber:
+                break
+            if tr.id <= startTrNumber or tr.Type in ignored_transaction_types:
+                continue
+            self.Prefetch(('diff', streamName, prevTrNumber, tr.id), self.TryDiff, streamName, prevTrNumber, tr.id, False)
+            if tr.id > 1 and tr.Type != "mkstream":
+                self.Prefetch(('diff', streamName, tr.id, tr.id - 1), self.TryDiff, streamName, tr.id, tr.id - 1, False)
+            if self.histPageEnd is not None and tr.id <= self.histPageEnd:
+                pageStart = tr.id - ((tr.id - 1) % AccuRev2Git.histPageSize)
+                pageEnd = min(pageStart + AccuRev2Git.histPageSize - 1, self.histPageEnd)
+                if (depot, pageStart, pageEnd) not in self.histPages:
+                    self.Prefetch(('hist', depot, pageStart, pageEnd), self.LoadHistPage, depot, pageStart, pageEnd)
+            prevTrNumber = tr.id
+            count += 1
+
     def TryPop(self, streamName, transaction, overwrite=False):
         for i in range(0, AccuRev2Git.commandFailureRetryCount):
             popResult = accurev.pop(verSpec=streamName, location=self.gitRepo.path, isRecursive=True, isOverride=overwrite, timeSpec=transaction.id, elementList='.')
@@ -970,7 +1487,78 @@ class AccuRev2Git(object):
         
         return popResult
 
+    # Returns the parent directories of an accurev depot relative path (e.g. /./a/b/c.txt -> [ /./a/b, /./a ]), excluding the depot root.
+    def GetDepotPathParents(self, path):
+        parents = []
+        separator = '\\' if path.startswith('\\.\\') else '/'
+        parent = path.rsplit(separator, 1)[0] if separator in path else ''
+        while len(parent) > 2:
+            parents.append(parent)
+            parent = parent.rsplit(separator, 1)[0] if separator in parent else ''
+        return parents
+
+    # Populates only the elements which are mentioned in the diff between the transaction and the one before it (see GetInfoFiles()) instead
+    # of the whole stream. Directories in the diff are populated recursively (their contents may have moved with them) while files, and the parent
+    # directories of the elements that were added or moved, are populated on their own. Returns a falsy value if the pop failed, in which case the
+    # caller should populate the whole stream.
+    def TryTargetedPop(self, streamName, transaction, diff):
+        dirList, fileList = [], []
+        for element in diff.elements:
+            for change in element.changes:
+                if change is None or change.stream1 is None or change.stream1.name is None:
+                    continue # The element doesn't exist in this transaction, it was deleted by DeleteDiffItemsFromRepo().
+                name = change.stream1.name
+                targetList = dirList if change.stream1.isDir else fileList
+                if name not in targetList:
+                    targetList.append(name)
+                if change.stream2 is None or change.stream2.name != name:
+                    # The element was added or moved so its parent directories may not exist in the worktree.
+                    for parent in self.GetDepotPathParents(name):
+                        if parent not in fileList and parent not in dirList:
+                            fileList.append(parent)
+
+        if len(dirList) == 0 and len(fileList) == 0:
+            return True
+
+        for elementList, isRecursive in [ (dirList, True), (fileList, False) ]:
+            if len(elementList) == 0:
+                continue
+            listFile = tempfile.NamedTemporaryFile(mode='w', suffix='.txt', delete=False, encoding='utf-8')
+            try:
+                with listFile:
+                    listFile.write('\n'.join(elementList))
+                    listFile.write('\n')
+                popResult = accurev.pop(verSpec=streamName, location=self.gitRepo.path, isRecursive=isRecursive, isOverride=True, timeSpec=transaction.id, listFile=listFile.name)
+            finally:
+                os.remove(listFile.name)
+            if not popResult:
+                if popResult is not None:
+                    for message in popResult.messages:
+                        logger.debug("  {0}".format(message.text))
+                return popResult
+            logger.debug("Populated {n} {kind} for tr. {trId} from a list file.".format(n=len(elementList), kind="directories recursively" if isRecursive else "elements", trId=transaction.id))
+
+        return popResult
+
+    # Populates the stream as it was at the transaction. With the targeted-pop option only the elements in the diff are populated (see
+    # TryTargetedPop()), falling back to populating the whole stream if that fails. The whole stream is always populated when overwrite is set,
+    # which the pop method does after clearing the worktree.
+    def PopTransaction(self, streamName, transaction, diff, overwrite=False):
+        popResult = None
+        if not overwrite and diff is not None and self.config.accurev.targetedPop:
+            popResult = self.TryTargetedPop(streamName=streamName, transaction=transaction, diff=diff)
+            if not popResult:
+                logger.warning( "Targeted accurev pop failed for {trId} on {streamName}. Fallback to populating the whole stream...".format(trId=transaction.id, streamName=streamName) )
+        if not popResult:
+            popResult = self.TryPop(streamName=streamName, transaction=transaction, overwrite=overwrite)
+        return popResult
+
     def TryStreams(self, depot, timeSpec, stream=None):
+        if stream is None and self.streamTimeline is not None and self.streamTimeline.depot == depot:
+            streams, streamsXml = self.streamTimeline.Streams(timeSpec)
+            if streams is not None:
+                return streams, streamsXml
+
         streams = None
         for i in range(0, AccuRev2Git.commandFailureRetryCount):
             streamsXml = accurev.raw.show.streams(depot=depot, timeSpec=timeSpec, stream=stream, isXmlOutput=True, includeDeactivatedItems=True, includeHasDefaultGroupAttribute=True, useCache=self.config.accurev.UseCommandCache())
@@ -995,10 +1583,13 @@ class AccuRev2Git(object):
         xmlDecoded = git.decode_proc_output(xmlNormalized)
         return xmlDecoded
 
-    def WriteInfoFiles(self, path, depot, transaction, streamsXml=None, histXml=None, streamName=None, diffXml=None, useCommandCache=False):
+    # Retrieves the accurev information for the transaction and returns a dictionary mapping the info file names (streams.xml, hist.xml and,
+    # for transactions that can change the stream contents, diff.xml) to their normalized contents. Returns None on failure.
+    def GetInfoFiles(self, depot, transaction, streamsXml=None, histXml=None, streamName=None, diffXml=None, useCommandCache=False):
         streams = None
         hist = None
         diff = None
+        infoFiles = {}
 
         if streamsXml is not None:
             streams = accurev.obj.Show.Streams.fromxmlstring(streamsXml)
@@ -1006,39 +1597,85 @@ class AccuRev2Git(object):
         if streams is None or streamsXml is None:
             streams, streamsXml = self.TryStreams(depot=depot, timeSpec=transaction)
             if streams is None or streamsXml is None:
-                return (None, None, None)
+                return None
 
         if histXml is not None:
             hist = accurev.obj.History.fromxmlstring(histXml)
         if hist is None or histXml is None:
             hist, histXml = self.TryHist(depot=depot, timeSpec=transaction)
             if hist is None or histXml is None:
-                return (None, None)
+                return None
 
         tr = hist.transactions[0]
         if tr.id > 1 and tr.Type != "mkstream":
             if diffXml is not None:
-                diff = accurev.obj.Diff.fromxmlstring(streamsXml)
+                diff = accurev.obj.Diff.fromxmlstring(diffXml)
             
             if diff is None or diffXml is None:
                 if streamName is not None:
                     diff, diffXml = self.TryDiff(streamName=streamName, firstTrNumber=tr.id, secondTrNumber=(tr.id - 1))
                     if diff is None or diffXml is None:
-                        return (None, None)
+                        return None
                 else:
-                    return (None, None)
+                    return None
 
-            diffFilePath = os.path.join(self.gitRepo.path, 'diff.xml')
-            with codecs.open(diffFilePath, mode='w', encoding='utf-8') as f:
-                f.write(self.NormalizeAccurevXml(diffXml))
+            infoFiles['diff.xml'] = self.NormalizeAccurevXml(diffXml)
 
-        streamsFilePath = os.path.join(path, 'streams.xml')
-        with codecs.open(streamsFilePath, mode='w', encoding='utf-8') as f:
-            f.write(self.NormalizeAccurevXml(streamsXml))
-        
-        histFilePath = os.path.join(path, 'hist.xml')
-        with codecs.open(histFilePath, mode='w', encoding='utf-8') as f:
-            f.write(self.NormalizeAccurevXml(histXml))
+        infoFiles['streams.xml'] = self.NormalizeAccurevXml(streamsXml)
+        infoFiles['hist.xml'] = self.NormalizeAccurevXml(histXml)
+
+        return infoFiles
+
+    def WriteInfoFiles(self, path, depot, transaction, streamsXml=None, histXml=None, streamName=None, diffXml=None, useCommandCache=False):
+        infoFiles = self.GetInfoFiles(depot=depot, transaction=transaction, streamsXml=streamsXml, histXml=histXml, streamName=streamName, diffXml=diffXml, useCommandCache=useCommandCache)
+        if infoFiles is None:
+            return False
+
+        for filename in infoFiles:
+            filePath = os.path.join(path, filename)
+            with codecs.open(filePath, mode='w', encoding='utf-8') as f:
+                f.write(infoFiles[filename])
+        return True
+
+    # Commits the info files (see GetInfoFiles()) for the transaction to the ref without touching the worktree or the index. The blobs, the tree
+    # and the commit are built in memory and only the objects that the first parent doesn't already have are written, with one `git hash-object`
+    # per object type (see git.repo.write_objects()). The parent's tree is read through the cat-file process. Returns the new commit hash or None.
+    # If the tree is the same as the first parent's nothing is committed and the first parent is returned, like `git commit` with nothing to commit.
+    def CommitInfoFiles(self, depot, streamName, transaction, ref, parents):
+        infoFiles = self.GetInfoFiles(depot=depot, streamName=streamName, transaction=transaction.id, useCommandCache=self.config.accurev.UseCommandCache())
+        if infoFiles is None:
+            logger.error( "Failed to retrieve the info files for transaction {trId}.".format(trId=transaction.id) )
+            return None
+
+        blobs, treeEntries = {}, {}
+        for filename in infoFiles:
+            blobHash, data = self.gitRepo.make_blob(data=infoFiles[filename])
+            blobs[blobHash] = data
+            treeEntries[filename] = ('100644', blobHash)
+        treeHash, treeData = self.gitRepo.make_tree(entries=treeEntries)
+
+        parentEntries = {}
+        if parents is not None and len(parents) > 0:
+            parentTreeHash, parentEntries = self.gitRepo.read_tree(u'{commit}^{{tree}}'.format(commit=parents[0]))
+            if parentTreeHash == treeHash:
+                logger.debug( "nothing to commit for transaction {trId}...?".format(trId=transaction.id) )
+                return parents[0]
+            if parentEntries is None:
+                parentEntries = {}
+
+        author = self.GetTransactionAuthor(tr=transaction)
+        commitHash, commitData = self.gitRepo.make_commit(tree=treeHash, parents=(parents if parents is not None else []), message='transaction {trId}'.format(trId=transaction.id), author=author, committer=author)
+
+        parentBlobs = set([ entry[1] for entry in parentEntries.values() ])
+        for objType, objects in [ ('blob', [ (blobHash, blobs[blobHash]) for blobHash in sorted(blobs) if blobHash not in parentBlobs ]), ('tree', [ (treeHash, treeData) ]), ('commit', [ (commitHash, commitData) ]) ]:
+            if self.gitRepo.write_objects(objects=objects, objType=objType) != True:
+                logger.error( "Failed to write the info {objType} objects for transaction {trId}. Error:\n{err}".format(objType=objType, trId=transaction.id, err=self.gitRepo.lastStderr) )
+                return None
+
+        if self.UpdateAndCheckoutRef(ref=ref, commitHash=commitHash, checkout=False) != True:
+            logger.error( "Failed to update ref {ref} with commit {h} for transaction {trId}".format(ref=ref, h=commitHash, trId=transaction.id) )
+            return None
+        return commitHash
 
     # GetDepotRefsNamespace
     # When depot is None it returns the git ref namespace where all depots are under.
@@ -1178,48 +1815,71 @@ class AccuRev2Git(object):
             hwmRef = '{streamNS}/hwm'.format(streamNS=streamNS) # High-water mark ref.
         return (stateRef, dataRef, hwmRef)
 
+    # Reads the <ref>:<filename> info file and parses it with the given function. Returns a tuple of (xml, parsed object), or (None, None) if the file
+    # doesn't exist. The parsed objects are kept in an LRU cache keyed by the blob hash since the same streams.xml blob is shared by long runs of
+    # transactions and by the info refs of every stream. The cache holds at most AccuRev2Git.infoCacheMaxBytes of xml.
+    # The returned object is shared with the cache and with every other caller that reads the same blob so it must be treated as read-only. Callers
+    # that need to change it, or the streams, transactions and elements that it contains, must make their own copy first.
+    def GetInfoFile(self, ref, filename, parse):
+        blobHash, blobType, data = self.gitRepo.catFile.read(u'{ref}:{filename}'.format(ref=ref, filename=filename))
+        if data is None:
+            return (None, None)
+
+        key = (blobHash, filename)
+        cached = self.infoCache.get(key)
+        if cached is not None:
+            self.infoCache.move_to_end(key)
+            self.infoCacheHits += 1
+            return cached
+        self.infoCacheMisses += 1
+
+        xml = git.decode_proc_output(data)
+        if len(xml) == 0:
+            return (xml, None)
+        obj = parse(xml)
+        if obj is not None and len(xml) <= AccuRev2Git.infoCacheMaxBytes:
+            self.infoCache[key] = (xml, obj)
+            self.infoCacheBytes += len(xml)
+            while self.infoCacheBytes > AccuRev2Git.infoCacheMaxBytes:
+                evictedKey, evicted = self.infoCache.popitem(last=False)
+                self.infoCacheBytes -= len(evicted[0])
+        return (xml, obj)
+
+    def LogInfoCacheStats(self):
+        lookups = self.infoCacheHits + self.infoCacheMisses
+        if lookups > 0:
+            logger.info( "Info file cache: {hits} hits, {misses} misses ({rate:.1f}% hit rate), {count} objects using {size} bytes of xml.".format(hits=self.infoCacheHits, misses=self.infoCacheMisses, rate=(100.0 * self.infoCacheHits / lookups), count=len(self.infoCache), size=self.infoCacheBytes) )
+
     # Gets the diff.xml contents and parsed accurev.obj.Diff object from the given \a ref (git ref or hash).
     def GetDiffInfo(self, ref):
         # Get the diff information. (if any)
-        diff = None
-        diffXml = self.gitRepo.raw_cmd(['git', 'show', '{hash}:diff.xml'.format(hash=ref)]) # Doesn't exist for the mkstream transaction (first commit)
-        if diffXml is not None and len(diffXml) != 0:
-            diff = accurev.obj.Diff.fromxmlstring(diffXml)
-        else:
-            logger.warning("Command failed! git show {hash}:diff.xml".format(hash=ref))
+        diffXml, diff = self.GetInfoFile(ref=ref, filename='diff.xml', parse=accurev.obj.Diff.fromxmlstring) # Doesn't exist for the mkstream transaction (first commit)
+        if diffXml is None or len(diffXml) == 0:
+            logger.warning("Failed to read {hash}:diff.xml".format(hash=ref))
         return (diffXml, diff)
 
     # Gets the hist.xml contents and parsed accurev.obj.History object from the given \a ref (git ref or hash).
     def GetHistInfo(self, ref):
         # Get the hist information.
-        hist = None
-        histXml = self.gitRepo.raw_cmd(['git', 'show', '{hash}:hist.xml'.format(hash=ref)])
-        if histXml is not None and len(histXml) != 0:
-            hist = accurev.obj.History.fromxmlstring(histXml)
-        else:
-            raise Exception("Command failed! git show {hash}:hist.xml".format(hash=ref))
+        histXml, hist = self.GetInfoFile(ref=ref, filename='hist.xml', parse=accurev.obj.History.fromxmlstring)
+        if histXml is None or len(histXml) == 0:
+            raise Exception("Failed to read {hash}:hist.xml".format(hash=ref))
         return (histXml, hist)
 
     # Gets the streams.xml contents and parsed accurev.obj.Show.Streams object from the given \a ref (git ref or hash).
     def GetStreamsInfo(self, ref):
         # Get the stream information.
-        streams = None
-        streamsXml = self.gitRepo.raw_cmd(['git', 'show', '{hash}:streams.xml'.format(hash=ref)])
-        if streamsXml is not None and len(streamsXml) != 0:
-            streams = accurev.obj.Show.Streams.fromxmlstring(streamsXml)
-        else:
-            raise Exception("Command failed! git show {hash}:streams.xml".format(hash=ref))
+        streamsXml, streams = self.GetInfoFile(ref=ref, filename='streams.xml', parse=accurev.obj.Show.Streams.fromxmlstring)
+        if streamsXml is None or len(streamsXml) == 0:
+            raise Exception("Failed to read {hash}:streams.xml".format(hash=ref))
         return (streamsXml, streams)
 
     # Gets the depots.xml contents and parsed accurev.obj.Show.Streams object from the given \a ref (git ref or hash).
     def GetDepotsInfo(self, ref):
         # Get the stream information.
-        depots = None
-        depotsXml = self.gitRepo.raw_cmd(['git', 'show', '{hash}:depots.xml'.format(hash=ref)])
-        if depotsXml is not None and len(depotsXml) != 0:
-            depots = accurev.obj.Show.Depots.fromxmlstring(depotsXml)
-        else:
-            raise Exception("Command failed! git show {hash}:depots.xml".format(hash=ref))
+        depotsXml, depots = self.GetInfoFile(ref=ref, filename='depots.xml', parse=accurev.obj.Show.Depots.fromxmlstring)
+        if depotsXml is None or len(depotsXml) == 0:
+            raise Exception("Failed to read {hash}:depots.xml".format(hash=ref))
         return (depotsXml, depots)
 
     def RetrieveStreamInfo(self, depot, stream, stateRef, startTransaction, endTransaction):
@@ -1229,13 +1889,13 @@ class AccuRev2Git(object):
         stateRefObj = self.gitRepo.raw_cmd(['git', 'show-ref', stateRef])
         assert stateRefObj is None or len(stateRefObj) != 0, "Invariant error! Expected non-empty string returned by git show-ref, but got '{s}'".format(s=stateRefObj)
 
-        # Either checkout last state or make the initial commit for a new stateRef.
+        # Either continue from the last state or make the initial commit for a new stateRef. The info commits are built directly from git
+        # objects (see CommitInfoFiles()) so the worktree is never checked out or cleared here.
         tr = None
         commitHash = None
-        doInitialCheckout = False
+        lastStateHash = None
         if stateRefObj is not None:
-            # This means that the ref already exists so we should switch to it.
-            doInitialCheckout = True
+            lastStateHash = self.GetLastCommitHash(ref=stateRef)
             histXml, hist = self.GetHistInfo(ref=stateRef)
             tr = hist.transactions[0]
         else:
@@ -1249,17 +1909,12 @@ class AccuRev2Git(object):
                 except:
                     destStream = None
 
-                # Delete everything in the index and working directory.
-                self.gitRepo.rm(fileList=['.'], force=True, recursive=True)
-                self.ClearGitRepo()
-
-                self.WriteInfoFiles(path=self.gitRepo.path, depot=depot, streamName=stream.name, transaction=tr.id, useCommandCache=self.config.accurev.UseCommandCache())
-
-                commitHash = self.Commit(transaction=tr, messageOverride="transaction {trId}".format(trId=tr.id), parents=[], ref=stateRef, authorIsCommitter=True)
+                commitHash = self.CommitInfoFiles(depot=depot, streamName=stream.name, transaction=tr, ref=stateRef, parents=[])
                 if commitHash is None:
                     logger.debug( "{0} first commit has failed. Is it an empty commit? Aborting!".format(stream.name) )
                     return (None, None)
                 else:
+                    lastStateHash = commitHash
                     logger.info( "stream {streamName}: tr. #{trId} {trType} -> commit {hash} on {ref}".format(streamName=stream.name, trId=tr.id, trType=tr.Type, hash=self.ShortHash(commitHash), ref=stateRef) )
             else:
                 logger.warning( "Failed to get the first transaction for {0} from accurev. Continuing...".format(stream.name) )
@@ -1282,14 +1937,19 @@ class AccuRev2Git(object):
         if self.config.method == "deep-hist":
             ignoreTimelocks=False # The code for the timelocks is not tested fully yet. Once tested setting this to false should make the resulting set of transactions smaller
                                  # at the cost of slightly larger number of upfront accurev commands called.
-            logger.debug("accurev.ext.deep_hist(depot={0}, stream={1}, timeSpec='{2}-{3}', ignoreTimelocks={4})".format(depot, stream.name, tr.id, endTr.id, ignoreTimelocks))
-            deepHist = accurev.ext.deep_hist(depot=depot, stream=stream.name, timeSpec="{0}-{1}".format(tr.id, endTr.id), ignoreTimelocks=ignoreTimelocks, useCache=self.config.accurev.UseCommandCache())
+            if self.deepHistLists is not None and stream.streamNumber in self.deepHistLists and self.deepHistStart <= tr.id:
+                deepHist = [ t for t in self.deepHistLists[stream.streamNumber] if tr.id <= t.id <= endTr.id ]
+            else:
+                logger.debug("accurev.ext.deep_hist(depot={0}, stream={1}, timeSpec='{2}-{3}', ignoreTimelocks={4})".format(depot, stream.name, tr.id, endTr.id, ignoreTimelocks))
+                deepHist = accurev.ext.deep_hist(depot=depot, stream=stream.name, timeSpec="{0}-{1}".format(tr.id, endTr.id), ignoreTimelocks=ignoreTimelocks, useCache=self.config.accurev.UseCommandCache())
             logger.info("Deep-hist returned {count} transactions to process.".format(count=len(deepHist)))
             if deepHist is None:
                 raise Exception("accurev.ext.deep_hist() failed to return a result!")
             elif len(deepHist) == 0:
                 return (None, None)
         while True:
+            if deepHist is not None and AccuRev2Git.prefetchDepth > 0:
+                self.PrefetchStreamInfo(depot=depot, streamName=stream.name, deepHist=deepHist, startTrNumber=tr.id, endTrNumber=endTr.id)
             nextTr, diff = self.FindNextChangeTransaction(streamName=stream.name, startTrNumber=tr.id, endTrNumber=endTr.id, deepHist=deepHist)
             if nextTr is None:
                 logger.debug( "FindNextChangeTransaction(streamName='{0}', startTrNumber={1}, endTrNumber={2}, deepHist={3}) failed!".format(stream.name, tr.id, endTr.id, deepHist) )
@@ -1297,19 +1957,9 @@ class AccuRev2Git(object):
 
             logger.debug( "{0}: next transaction {1} (end tr. {2})".format(stream.name, nextTr, endTr.id) )
             if nextTr <= endTr.id:
-                if doInitialCheckout:
-                    # A postponed initialization of state. If there's nothing to do we should skip this checkout because
-                    # it can be expensive. So only do it once and only when we will need to use it.
-                    self.SafeCheckout(ref=stateRef, doReset=True, doClean=True)
-                    doInitialCheckout = False
-
                 # Right now nextTr is an integer representation of our next transaction.
-                # Delete all of the files which are even mentioned in the diff so that we can do a quick populate (wouth the overwrite option)
-                if self.config.method == "pop":
-                    self.ClearGitRepo()
-                else:
-                    if diff is None:
-                        return (None, None)
+                if self.config.method != "pop" and diff is None:
+                    return (None, None)
 
                 # The accurev hist command here must be used with the depot option since the transaction that has affected us may not
                 # be a promotion into the stream we are looking at but into one of its parent streams. Hence we must query the history
@@ -1319,20 +1969,23 @@ class AccuRev2Git(object):
                     logger.debug("accurev hist -p {0} -t {1}.1 failed.".format(depot, endTransaction))
                     return (None, None)
                 tr = hist.transactions[0]
-                stream = accurev.show.streams(depot=depot, stream=stream.streamNumber, timeSpec=tr.id, useCache=self.config.accurev.UseCommandCache()).streams[0]
+                timelineStream = None
+                if self.streamTimeline is not None:
+                    timelineStream = self.streamTimeline.GetStream(stream=stream.streamNumber, transaction=tr.id)
+                if timelineStream is not None:
+                    stream = timelineStream
+                else:
+                    stream = accurev.show.streams(depot=depot, stream=stream.streamNumber, timeSpec=tr.id, useCache=self.config.accurev.UseCommandCache()).streams[0]
 
-                self.WriteInfoFiles(path=self.gitRepo.path, depot=depot, streamName=stream.name, transaction=tr.id, useCommandCache=self.config.accurev.UseCommandCache())
-                    
                 # Commit
-                commitHash = self.Commit(transaction=tr, messageOverride="transaction {trId}".format(trId=tr.id), ref=stateRef, authorIsCommitter=True)
+                parents = [ lastStateHash ] if lastStateHash is not None else []
+                commitHash = self.CommitInfoFiles(depot=depot, streamName=stream.name, transaction=tr, ref=stateRef, parents=parents)
                 if commitHash is None:
-                    if "nothing to commit" in self.gitRepo.lastStdout:
-                        logger.info("stream {streamName}: tr. #{trId} is a no-op. Potential but unlikely error. Continuing.".format(streamName=stream.name, trId=tr.id))
-                    else:
-                        break # Early return from processing this stream. Restarting should clean everything up.
+                    break # Early return from processing this stream. Restarting should clean everything up.
+                elif commitHash == lastStateHash:
+                    logger.info("stream {streamName}: tr. #{trId} is a no-op. Potential but unlikely error. Continuing.".format(streamName=stream.name, trId=tr.id))
                 else:
-                    if self.UpdateAndCheckoutRef(ref=stateRef, commitHash=commitHash) != True:
-                        return (None, None)
+                    lastStateHash = commitHash
                     logger.info( "stream {streamName}: tr. #{trId} {trType} -> commit {hash} on {ref}".format(streamName=stream.name, trId=tr.id, trType=tr.Type, hash=self.ShortHash(commitHash), ref=stateRef) )
             else:
                 logger.info( "Reached end transaction #{trId} for {streamName} -> {ref}".format(trId=endTr.id, streamName=stream.name, ref=stateRef) )
@@ -1341,6 +1994,11 @@ class AccuRev2Git(object):
         return (tr, commitHash)
 
     def GetHashForTransaction(self, ref, trNum):
+        # Look the commit up in the transaction index first, it is only missing if the ref isn't a stream ref or if the index couldn't be updated.
+        commitHash = self.LookupTransactionIndex(ref=ref, trId=trNum)
+        if commitHash is not None:
+            return commitHash
+
         # Find the commit hash on our ref that corresponds to the provided transaction number.
         cmd = ['git', 'log', '--format=%H', '--grep', '^transaction {trId}$'.format(trId=trNum), ref]
         lastCommitHash = self.gitRepo.raw_cmd(cmd)
@@ -1479,6 +2137,10 @@ class AccuRev2Git(object):
         # Notify the user what we are processing.
         logger.info( "Processing stream data for {0} : {1} - {2}".format(stream.name, lastTrId, lastStateTrId) )
 
+        lastDataHash = None
+        if self.config.git.fastImport:
+            lastDataHash = self.GetLastCommitHash(ref=dataRef)
+
         # Process all the hashes in the list
         for stateHash in reversed(stateHashList):
             assert stateHash is not None, "Invariant error! Hashes in the stateHashList cannot be none here!"
@@ -1493,7 +2155,7 @@ class AccuRev2Git(object):
             # Get the stream information.
             streamsXml, streams = self.GetStreamsInfo(ref=stateHash)
 
-            deletedPathList = None
+            deletedPathList, deletedDirList = None, None
             usePopMethod = (self.config.method == "pop")
             if diff is None:
                 logger.warning("Accurev diff is unavailable for this transaction. Fallback to `pop method`...")
@@ -1504,7 +2166,7 @@ class AccuRev2Git(object):
                     deletedPathList = self.DeleteDiffItemsFromRepo(diff=diff)
                     # Remove all the empty directories (this includes directories which contain an empty .gitignore file since that's what we is done to preserve them)
                     warning = "Error trying to delete empty directories. Fallback to `pop method`..."
-                    self.DeleteEmptyDirs()
+                    deletedDirList = self.DeleteEmptyDirs()
                 except:
                     usePopMethod = True
                     logger.warning(warning)
@@ -1541,14 +2203,19 @@ class AccuRev2Git(object):
 
             # Populate
             logger.debug( "{0} pop: {1} {2}{3}".format(stream.name, tr.Type, tr.id, " to {0}".format(destStreamName) if destStreamName is not None else "") )
-            popResult = self.TryPop(streamName=stream.name, transaction=tr, overwrite=usePopMethod)
+            popResult = self.PopTransaction(streamName=stream.name, transaction=tr, diff=diff, overwrite=usePopMethod)
             if not popResult:
                 logger.error( "accurev pop failed for {trId} on {dataRef}".format(trId=tr.id, dataRef=dataRef) )
                 return (None, None)
 
             # Make the commit. Empty commits are allowed so that we match the state ref exactly (transaction for transaction).
             # Reasoning: Empty commits are cheap and since these are not intended to be seen by the user anyway so we may as well make them to have a simpler mapping.
-            commitHash = self.Commit(transaction=tr, allowEmptyCommit=True, messageOverride="transaction {trId}".format(trId=tr.id), ref=dataRef, authorIsCommitter=True)
+            if self.config.git.fastImport:
+                isFullTree = usePopMethod or (deletedPathList is not None and self.gitRepo.path in deletedPathList)
+                commitHash = self.FastImportDataCommit(transaction=tr, ref=dataRef, parent=lastDataHash, diff=diff, deletedPathList=(deletedPathList or []) + (deletedDirList or []), fullTree=isFullTree)
+                lastDataHash = commitHash
+            else:
+                commitHash = self.Commit(transaction=tr, allowEmptyCommit=True, messageOverride="transaction {trId}".format(trId=tr.id), ref=dataRef, authorIsCommitter=True)
             if commitHash is None:
                 logger.error( "Commit failed for {trId} on {dataRef}".format(trId=tr.id, dataRef=dataRef) )
                 return (None, None)
@@ -1574,79 +2241,323 @@ class AccuRev2Git(object):
 
         logger.info( "Retrieving stream {0} info from Accurev for transaction range : {1} - {2}".format(stream.name, startTransaction, endTransaction) )
         stateTr, stateHash = self.RetrieveStreamInfo(depot=depot, stream=stream, stateRef=stateRef, startTransaction=startTransaction, endTransaction=endTransaction)
+        self.ClearPrefetched()
+        self.TrySyncTransactionIndex(stream=stream, stateRef=stateRef, dataRef=dataRef) # RetrieveStreamData() looks up the new state commits.
         logger.info( "Retrieving stream {0} data from Accurev for transaction range : {1} - {2}".format(stream.name, startTransaction if prevHwm is None else prevHwm, endTransaction) )
         dataTr,  dataHash  = self.RetrieveStreamData(stream=stream, dataRef=dataRef, stateRef=stateRef) # Note: In case the last retrieval was interrupted, we will retrieve those transactions first.
+        if self.fastImport is not None:
+            # The data ref is only updated by git fast-import on a checkpoint, which has to happen before the high-water-mark is moved.
+            try:
+                self.fastImport.checkpoint()
+            except Exception as e:
+                logger.error( "git fast-import checkpoint failed for {dataRef}: {err}".format(dataRef=dataRef, err=e) )
+                dataTr, dataHash = None, None
 
+        newHwm = None
         if stateTr is not None and dataTr is not None:
             newHwm = CallOnNonNoneArgs(max, dataTr.id, prevHwm)
             if stateTr.id != dataTr.id:
                 logger.error( "Missmatch while retrieving stream {streamName} (id: streamId), the data ref ({dataRef}) is on tr. {dataTr} while the state ref ({stateRef}) is on tr. {stateTr}.".format(streamName=stream.name, streamId=stream.streamNumber, dataTr=dataTr.id, stateTr=stateTr.id, dataRef=dataRef, stateRef=stateRef) )
             else:
                 newHwm = CallOnNonNoneArgs(max, int(endTransaction), newHwm)
-
-            # Success! Update the high water mark for the stream.
-            if hwmRef is not None:
-                metadata = { "high-water-mark": newHwm }
-                if self.WriteFileRef(ref=hwmRef, text=json.dumps(metadata)) != True:
-                    logger.error( "Failed to write the high-water-mark to ref {ref}".format(ref=hwmRef) )
-                else:
-                    logger.info( "Updated the high-water-mark to ref {ref} as {trId}".format(ref=hwmRef, trId=newHwm) )
         elif stateTr is not None and dataTr is None:
             logger.error( "Missmatch while retrieving stream {streamName} (id: {streamId}), the state ref ({stateRef}) is on tr. {stateTr} but the data ref ({dataRef}) wasn't retrieved.".format(streamName=stream.name, streamId=stream.streamNumber, stateTr=stateTr.id, dataRef=dataRef, stateRef=stateRef) )
         elif stateTr is None:
             logger.error( "While retrieving stream {streamName} (id: {streamId}), the state ref ({stateRef}) failed.".format(streamName=stream.name, streamId=stream.streamNumber, dataRef=dataRef, stateRef=stateRef) )
 
+        # Success! Update the high water mark for the stream. It is written in one ref update with the stream's entry in the depot manifest, which
+        # is updated even if the retrieval failed since the info and data refs may have moved.
+        self.BeginRefTransaction()
+        try:
+            if newHwm is not None and hwmRef is not None:
+                self.WriteFileRef(ref=hwmRef, text=json.dumps({ "high-water-mark": newHwm }))
+            self.UpdateDepotManifest(depot=depot, streamNumber=stream.streamNumber, highWaterMark=(newHwm if hwmRef is not None else None))
+        except:
+            self.AbortRefTransaction()
+            raise
+        if self.CommitRefTransaction() != True:
+            logger.error( "Failed to write the high-water-mark to ref {ref}".format(ref=hwmRef) )
+        elif newHwm is not None and hwmRef is not None:
+            logger.info( "Updated the high-water-mark to ref {ref} as {trId}".format(ref=hwmRef, trId=newHwm) )
+
+        # Index the retrieved transactions now so that processing doesn't have to.
+        self.TrySyncTransactionIndex(stream=stream, stateRef=stateRef, dataRef=dataRef)
+
         return dataTr, dataHash
 
+    # Brings the transaction index up to date after the stream's refs were moved. Not fatal, the lookups fall back to git for the transactions that
+    # aren't in the index and the index is also brought up to date by ProcessTransactions().
+    def TrySyncTransactionIndex(self, stream, stateRef, dataRef):
+        try:
+            self.SyncTransactionIndex(stateRef=stateRef, dataRef=dataRef)
+        except Exception as e:
+            logger.warning( "Failed to update the transaction index for stream {streamName} (id: {streamId}): {err}".format(streamName=stream.name, streamId=stream.streamNumber, err=e) )
+
     def RetrieveStreams(self):
         if self.config.accurev.commandCacheFilename is not None:
-            accurev.ext.enable_command_cache(self.config.accurev.commandCacheFilename)
-        
-        streamMap = self.GetStreamMap()
+            accurev.ext.enable_command_cache(self.config.accurev.commandCacheFilename, maxSize=self.config.accurev.CommandCacheMaxSizeBytes())
+        try:
+            streamMap = self.GetStreamMap()
 
-        depot  = self.config.accurev.depot
-        endTrHist = accurev.hist(depot=depot, timeSpec=self.config.accurev.endTransaction)
-        if endTrHist is None or endTrHist.transactions is None or len(endTrHist.transactions) == 0:
-            logger.error( "Failed to get end transaction for depot {0}. `accurev hist -p {0} -t {1}` returned no transactions. Please make sure the depot name is spelled correctly and that the transaction number/keyword is valid.".format(depot, self.config.accurev.endTransaction) )
-            return
-        endTr = endTrHist.transactions[0]
+            depot  = self.config.accurev.depot
+            endTrHist = accurev.hist(depot=depot, timeSpec=self.config.accurev.endTransaction)
+            if endTrHist is None or endTrHist.transactions is None or len(endTrHist.transactions) == 0:
+                logger.error( "Failed to get end transaction for depot {0}. `accurev hist -p {0} -t {1}` returned no transactions. Please make sure the depot name is spelled correctly and that the transaction number/keyword is valid.".format(depot, self.config.accurev.endTransaction) )
+                return
+            endTr = endTrHist.transactions[0]
+            self.histPageEnd = endTr.id # Allows TryHist() to retrieve the depot history in pages up to the end transaction.
+
+            # Build the stream timeline so that the streams at each transaction don't need to be queried one by one.
+            if depot is not None and len(depot) > 0:
+                self.streamTimeline = self.LoadStreamTimeline(depot=depot, streamMap=streamMap, endTr=endTr)
 
-        # Retrieve stream information from Accurev and store it inside git.
+            if self.config.method == "deep-hist" and depot is not None and len(depot) > 0:
+                self.LoadDeepHistCache(depot=depot)
+                self.PrepareDeepHist(depot=depot, streamMap=streamMap, endTr=endTr)
+
+            # Retrieve stream information from Accurev and store it inside git.
+            for stream in streamMap:
+                streamInfo = None
+                try:
+                    streamInfo = accurev.show.streams(depot=depot, stream=stream, useCache=self.config.accurev.UseCommandCache()).streams[0]
+                except IndexError:
+                    logger.error( "Failed to get stream information. `accurev show streams -p {0} -s {1}` returned no streams".format(depot, stream) )
+                    return
+                except AttributeError:
+                    logger.error( "Failed to get stream information. `accurev show streams -p {0} -s {1}` returned None".format(depot, stream) )
+                    return
+
+                if depot is None or len(depot) == 0:
+                    depot = streamInfo.depotName
+
+                stateRef, dataRef, hwmRef  = self.GetStreamRefs(depot=depot, streamNumber=streamInfo.streamNumber)
+                assert stateRef is not None and dataRef is not None and len(stateRef) != 0 and len(dataRef) != 0, "Invariant error! The state ({sr}) and data ({dr}) refs must not be None!".format(sr=stateRef, dr=dataRef)
+                tr, commitHash = self.RetrieveStream(depot=depot, stream=streamInfo, dataRef=dataRef, stateRef=stateRef, hwmRef=hwmRef, startTransaction=self.config.accurev.startTransaction, endTransaction=endTr.id)
+
+                if self.config.git.remoteMap is not None:
+                    refspec = "{dataRef}:{dataRef} {stateRef}:{stateRef}".format(dataRef=dataRef, stateRef=stateRef)
+                    for remoteName in self.config.git.remoteMap:
+                        pushOutput = None
+                        logger.info("Pushing '{refspec}' to '{remote}'...".format(remote=remoteName, refspec=refspec))
+                        try:
+                            pushCmd = "git push {remote} {refspec}".format(remote=remoteName, refspec=refspec)
+                            pushOutput = subprocess.check_output(pushCmd.split(), stderr=subprocess.STDOUT).decode('utf-8')
+                            logger.info("Push to '{remote}' succeeded:".format(remote=remoteName))
+                            logger.info(pushOutput)
+                        except subprocess.CalledProcessError as e:
+                            logger.error("Push to '{remote}' failed!".format(remote=remoteName))
+                            logger.error("'{cmd}', returned {returncode} and failed with:".format(cmd="' '".join(e.cmd), returncode=e.returncode))
+                            logger.error("{output}".format(output=e.output.decode('utf-8')))
+        finally:
+            self.SaveDeepHistCache()
+            if self.streamTimeline is not None:
+                logger.debug("Stream timeline: {0} show streams commands run, {1} served from memory.".format(self.streamTimeline.misses, self.streamTimeline.hits))
+                self.streamTimeline = None
+            self.deepHistLists = None
+            self.deepHistStart = None
+            if self.diffProbePool is not None:
+                self.diffProbePool.shutdown(wait=True)
+                self.diffProbePool = None
+            self.CloseFastImport()
+            self.ClearPrefetched()
+            if self.prefetchPool is not None:
+                self.prefetchPool.shutdown(wait=True)
+                self.prefetchPool = None
+            self.histPageEnd = None
+            self.histPages.clear()
+            if self.config.accurev.commandCacheFilename is not None:
+                self.LogCommandCacheStats()
+                accurev.ext.disable_command_cache()
+
+    # Returns the earliest transaction that this run needs for the given streams. That is the last transaction that was retrieved for each stream or,
+    # for the streams that haven't been retrieved yet, the configured start transaction. Returns None if the start transaction can't be resolved.
+    def GetRetrievalStartTransaction(self, depot, streamNumbers):
+        startTrHist = accurev.hist(depot=depot, timeSpec=self.config.accurev.startTransaction)
+        if startTrHist is None or startTrHist.transactions is None or len(startTrHist.transactions) == 0:
+            return None
+        configStartTr = startTrHist.transactions[0].id
+
+        startTr = None
+        for streamNumber in streamNumbers:
+            stateRef, dataRef, hwmRef = self.GetStreamRefs(depot=depot, streamNumber=streamNumber)
+            streamStartTr = configStartTr
+            if stateRef is not None and self.gitRepo.raw_cmd(['git', 'show-ref', stateRef]) is not None:
+                streamStartTr = self.GetTransactionForRef(ref=stateRef)
+            startTr = streamStartTr if startTr is None else min(startTr, streamStartTr)
+        return startTr
+
+    # Builds the stream timeline (see accurev.ext.StreamTimeline) for the transactions that this run retrieves, from GetRetrievalStartTransaction()
+    # up to the endTr. The streams in the stream map are resolved with one `accurev show streams -p <depot> -t <endTr>` snapshot, which also seeds
+    # the last epoch. Returns None if the timeline couldn't be built, the streams are then queried for each transaction.
+    def LoadStreamTimeline(self, depot, streamMap, endTr):
+        streams, streamsXml = self.TryStreams(depot=depot, timeSpec=endTr.id)
+        if streams is None:
+            logger.warning("Failed to get the streams of depot {0} at transaction {1}. The stream timeline won't be used.".format(depot, endTr.id))
+            return None
+
+        streamNumbers = []
         for stream in streamMap:
-            streamInfo = None
-            try:
-                streamInfo = accurev.show.streams(depot=depot, stream=stream, useCache=self.config.accurev.UseCommandCache()).streams[0]
-            except IndexError:
-                logger.error( "Failed to get stream information. `accurev show streams -p {0} -s {1}` returned no streams".format(depot, stream) )
-                return
-            except AttributeError:
-                logger.error( "Failed to get stream information. `accurev show streams -p {0} -s {1}` returned None".format(depot, stream) )
+            streamInfo = streams.getStream(stream)
+            if streamInfo is not None:
+                streamNumbers.append(streamInfo.streamNumber)
+        startTr = self.GetRetrievalStartTransaction(depot=depot, streamNumbers=streamNumbers)
+        if startTr is None or startTr > endTr.id:
+            return None
+
+        timeline = accurev.ext.StreamTimeline(depot=depot, useCache=self.config.accurev.UseCommandCache())
+        epochCount = timeline.Load(startTransaction=startTr, endTransaction=endTr.id, seedStreamsXml=streamsXml)
+        if epochCount is None:
+            logger.warning("Failed to get the stream history of depot {0} for transactions {1} - {2}. The stream timeline won't be used.".format(depot, startTr, endTr.id))
+            return None
+        logger.info("Streams of depot {0} change {1} times in transactions {2} - {3}.".format(depot, epochCount - 1, startTr, endTr.id))
+        return timeline
+
+    # Computes the deep-hist of all the streams in the stream map with a single pass over the depot history (see accurev.ext.multi_deep_hist())
+    # starting from the earliest transaction that any of them still needs to process. RetrieveStreamInfo() uses the result instead of running
+    # accurev.ext.deep_hist() for each stream. On failure the streams fall back to accurev.ext.deep_hist().
+    def PrepareDeepHist(self, depot, streamMap, endTr):
+        self.deepHistLists, self.deepHistStart = None, None
+        try:
+            streamNumbers = []
+            for stream in streamMap:
+                streamInfo = self.streamTimeline.GetStream(stream=stream, transaction=endTr.id) if self.streamTimeline is not None else None
+                if streamInfo is None:
+                    return
+                streamNumbers.append(streamInfo.streamNumber)
+
+            startTr = self.GetRetrievalStartTransaction(depot=depot, streamNumbers=streamNumbers)
+            if startTr is None or startTr > endTr.id:
                 return
 
-            if depot is None or len(depot) == 0:
-                depot = streamInfo.depotName
+            logger.info("Computing the deep-hist of {n} streams for transactions {start} - {end}.".format(n=len(streamNumbers), start=startTr, end=endTr.id))
+            histPage = lambda pageStart, pageEnd: self.GetHistPageTransactions(depot=depot, start=pageStart, end=pageEnd)
+            trLists, affected = accurev.ext.multi_deep_hist(depot=depot, streams=streamNumbers, timeSpec="{0}-{1}".format(startTr, endTr.id), timeline=self.streamTimeline, pageSize=AccuRev2Git.histPageSize, histPage=histPage, useCache=self.config.accurev.UseCommandCache())
+            if trLists is None:
+                logger.warning("Failed to compute the deep-hist for all streams at once. Falling back to per stream deep-hist.")
+                return
+            logger.info("Deep-hist found {n} transactions affecting the {s} streams.".format(n=len(affected), s=len(streamNumbers)))
+            self.deepHistLists, self.deepHistStart = trLists, startTr
+        except Exception as e:
+            logger.warning("Failed to compute the deep-hist for all streams at once ({err}). Falling back to per stream deep-hist.".format(err=e))
+            self.deepHistLists, self.deepHistStart = None, None
+
+    # Writes the worktree, as populated for the transaction, to the data ref using a long lived git fast-import process. Unless fullTree is set only the
+    # paths named in the diff, the paths deleted before the pop and the parent directories of the deleted paths (which may now need a .gitignore,
+    # see PreserveEmptyDirs()) are given to fast-import, every other path keeps what it had in the parent commit.
+    def FastImportDataCommit(self, transaction, ref, parent, diff=None, deletedPathList=[], fullTree=False):
+        if self.fastImport is None:
+            self.fastImport = git.repo.fast_import(self.gitRepo)
+
+        if fullTree or diff is None:
+            changedPaths = set([ self.gitRepo.path ])
+            parentPaths = set()
+            fullTree = True
+        else:
+            changedPaths = set(deletedPathList)
+            for element in diff.elements:
+                for change in element.changes:
+                    for stream in [ change.stream1, change.stream2 ]:
+                        if stream is not None and stream.name is not None:
+                            changedPaths.add(self.GetWorktreePath(stream.name))
+            parentPaths = set([ os.path.dirname(path) for path in deletedPathList ]) - changedPaths
+
+        # The empty directories are preserved first, the way Commit() does it before `git add`, so that their .gitignore files are listed below.
+        deletedPaths, listedPaths = [], []
+        for path in sorted(changedPaths):
+            relPath = os.path.relpath(path, self.gitRepo.path)
+            if relPath.startswith('..') or git.GetGitDirPrefix(path) is not None:
+                continue
+            if relPath != '.':
+                deletedPaths.append(ToUnixPath(relPath))
+            if os.path.isdir(path) and not os.path.islink(path):
+                if relPath != '.' and len(os.listdir(path)) == 0:
+                    self.PreserveEmptyDir(path)
+                self.PreserveEmptyDirs(path=path)
+            listedPaths.append(ToUnixPath(relPath))
+        for path in sorted(parentPaths):
+            if path != self.gitRepo.path and os.path.isdir(path) and len(os.listdir(path)) == 0:
+                listedPaths.append(ToUnixPath(os.path.relpath(self.PreserveEmptyDir(path), self.gitRepo.path)))
+
+        # Commit the files that `git add -f --all` in Commit() would stage: the ones that git lists under the changed paths (the index may still
+        # list some that were deleted), including the ignored ones since an ignored file may well be an element of the stream. Nested repositories
+        # are listed as a directory and skipped.
+        stageableFiles = self.gitRepo.ls_files(paths=listedPaths, cached=True, others=True)
+        if stageableFiles is None:
+            logger.error("Failed to list the files to commit for transaction {trId}. Error:\n{err}".format(trId=transaction.id, err=self.gitRepo.lastStderr))
+            return None
+        modifiedFiles = []
+        for relPath in sorted(set(stageableFiles)):
+            path = os.path.join(self.gitRepo.path, relPath)
+            if not relPath.endswith('/') and os.path.lexists(path):
+                modifiedFiles.append(self.GetFastImportFile(path))
 
-            stateRef, dataRef, hwmRef  = self.GetStreamRefs(depot=depot, streamNumber=streamInfo.streamNumber)
-            assert stateRef is not None and dataRef is not None and len(stateRef) != 0 and len(dataRef) != 0, "Invariant error! The state ({sr}) and data ({dr}) refs must not be None!".format(sr=stateRef, dr=dataRef)
-            tr, commitHash = self.RetrieveStream(depot=depot, stream=streamInfo, dataRef=dataRef, stateRef=stateRef, hwmRef=hwmRef, startTransaction=self.config.accurev.startTransaction, endTransaction=endTr.id)
+        author = self.GetTransactionAuthor(tr=transaction)
+        try:
+            return self.fastImport.commit(ref=ref, message="transaction {trId}".format(trId=transaction.id), author=author, committer=author, parent=parent, deleteAll=fullTree, deletedPaths=deletedPaths, modifiedFiles=modifiedFiles)
+        except Exception as e:
+            logger.error("git fast-import failed to commit transaction {trId} to {ref}: {err}".format(trId=transaction.id, ref=ref, err=e))
+            self.CloseFastImport()
+            return None
 
-            if self.config.git.remoteMap is not None:
-                refspec = "{dataRef}:{dataRef} {stateRef}:{stateRef}".format(dataRef=dataRef, stateRef=stateRef)
-                for remoteName in self.config.git.remoteMap:
-                    pushOutput = None
-                    logger.info("Pushing '{refspec}' to '{remote}'...".format(remote=remoteName, refspec=refspec))
-                    try:
-                        pushCmd = "git push {remote} {refspec}".format(remote=remoteName, refspec=refspec)
-                        pushOutput = subprocess.check_output(pushCmd.split(), stderr=subprocess.STDOUT).decode('utf-8')
-                        logger.info("Push to '{remote}' succeeded:".format(remote=remoteName))
-                        logger.info(pushOutput)
-                    except subprocess.CalledProcessError as e:
-                        logger.error("Push to '{remote}' failed!".format(remote=remoteName))
-                        logger.error("'{cmd}', returned {returncode} and failed with:".format(cmd="' '".join(e.cmd), returncode=e.returncode))
-                        logger.error("{output}".format(output=e.output.decode('utf-8')))
-        
-        if self.config.accurev.commandCacheFilename is not None:
-            accurev.ext.disable_command_cache()
+    # Returns the (path, mode, data) tuple for the file in the worktree as expected by git.repo.fast_import.commit().
+    def GetFastImportFile(self, path):
+        relPath = ToUnixPath(os.path.relpath(path, self.gitRepo.path))
+        if os.path.islink(path):
+            return (relPath, '120000', os.readlink(path).encode('utf-8'))
+        mode = '100755' if (os.stat(path).st_mode & stat.S_IXUSR) else '100644'
+        with open(path, 'rb') as f:
+            return (relPath, mode, f.read())
+
+    def CloseFastImport(self):
+        if self.fastImport is not None:
+            logger.debug("git fast-import wrote {n} commits.".format(n=self.fastImport.commitCount))
+            if not self.fastImport.close():
+                logger.error("git fast-import failed: {err}".format(err=self.gitRepo.lastStderr))
+            self.fastImport = None
+
+    def GetDeepHistCacheRef(self, depot):
+        depotObj = self.GetDepot(depot)
+        if depotObj is None:
+            return None
+        return u'{refsNS}cache/depots/{depotNumber}/deep_hist'.format(refsNS=AccuRev2Git.gitRefsNamespace, depotNumber=depotObj.number)
+
+    # Enables the accurev.ext.deep_hist() interval cache for the stream histories of the depot, restoring what previous runs have stored
+    # so that in tracking mode only the new transactions need to be retrieved.
+    def LoadDeepHistCache(self, depot):
+        cache = None
+        cacheRef = self.GetDeepHistCacheRef(depot=depot)
+        if cacheRef is not None:
+            cacheText = self.ReadFileRef(ref=cacheRef)
+            if cacheText is not None and len(cacheText) > 0:
+                try:
+                    cache = accurev.ext.HistIntervalCache.fromjson(cacheText)
+                    if cache.depot != depot:
+                        cache = None
+                except Exception:
+                    logger.warning("Failed to load the deep-hist cache from {ref}, it will be rebuilt.".format(ref=cacheRef))
+                    cache = None
+        if cache is None:
+            cache = accurev.ext.HistIntervalCache(depot=depot)
+        else:
+            logger.debug("Loaded the deep-hist cache for {n} streams from {ref}.".format(n=len(cache.streams), ref=cacheRef))
+        accurev.ext.enable_hist_interval_cache(cache=cache)
+
+    def SaveDeepHistCache(self):
+        cache = accurev.ext.disable_hist_interval_cache()
+        if cache is not None:
+            logger.debug("Deep-hist cache: {hits} stream history requests served from memory, {misses} needed accurev.".format(hits=cache.hits, misses=cache.misses))
+            if cache.misses > 0:
+                cacheRef = self.GetDeepHistCacheRef(depot=cache.depot)
+                if cacheRef is not None:
+                    self.WriteFileRef(ref=cacheRef, text=cache.tojson())
+
+    def LogCommandCacheStats(self):
+        stats = accurev.ext.command_cache_stats()
+        if stats is not None:
+            lookups = stats.hits + stats.misses
+            hitRate = stats.hitRate()
+            logger.info("Command cache: {hits} hits, {misses} misses ({rate}), {inserts} inserts in {commits} commits, {evictions} evictions.".format(hits=stats.hits, misses=stats.misses, rate="n/a" if hitRate is None else "{0:.1f}% hit rate".format(hitRate * 100.0), inserts=stats.inserts, commits=stats.commits, evictions=stats.evictions))
+            logger.info("Command cache: lookups {lt:.3f}s (avg. {avg:.3f}ms), inserts {it:.3f}s, commits {ct:.3f}s.".format(lt=stats.lookupTime, avg=(stats.lookupTime * 1000.0 / lookups) if lookups > 0 else 0.0, it=stats.insertTime, ct=stats.commitTime))
 
     # Lists the .git/... directory that contains all the stream refs and returns the file list as its result
     def GetAllKnownStreamRefs(self, depot):
@@ -1690,7 +2601,13 @@ class AccuRev2Git(object):
         else:
             logger.info("Not logged into Accurev. Searching for stream '{0}' by name (the slow way)...".format(streamName))
 
-        # Without using Accurev we can search for it in our Git history but this is really slow...
+        # Without using Accurev we can look it up in the stream names recorded in the transaction index.
+        s = self.LookupStreamName(depotNumber=depot.number, streamName=streamName)
+        if s is not None:
+            logger.debug("Found stream '{name}' in the transaction index.".format(name=streamName))
+            return s
+
+        # Otherwise we can search for it in our Git history but this is really slow...
         streamNamesRefspec = u'{refsNS}cache/depots/{depotNumber}/stream_names'.format(refsNS=AccuRev2Git.gitRefsNamespace, depotNumber=depot.number)
         streamNames = {} # This is so we cache the stream name to stream number mapping which can take about 10 seconds to compute in a large-ish repo...
         streamNamesText = self.ReadFileRef(ref=streamNamesRefspec)
@@ -1780,6 +2697,202 @@ class AccuRev2Git(object):
 
         return refMap
 
+    # The transaction index is an sqlite3 database in the .git/ac2git/ directory which maps each (depot, stream, transaction) to its commits on the
+    # stream's info (state) and data refs so that ProcessTransactions() doesn't have to walk the history of every stream ref on startup. It also
+    # records, for every stream name, the first transaction of each info ref whose streams.xml names it (the stream's rename history), so that
+    # GetStreamByName() works without accurev and without searching the history of the info refs. The tip that
+    # each ref had when it was indexed is recorded alongside, so a ref that moved is indexed incrementally and one that was rewritten (or deleted)
+    # is indexed again from scratch. The refs remain the source of truth, the index can always be deleted.
+    def OpenTransactionIndex(self):
+        if self.transactionIndex is None:
+            gitDir = self.gitRepo.git_dir()
+            if gitDir is None:
+                raise Exception("Failed to find the git directory. Err: {err}".format(err=self.gitRepo.lastStderr))
+            indexDir = os.path.join(gitDir, u'ac2git')
+            if not os.path.isdir(indexDir):
+                os.makedirs(indexDir)
+            self.transactionIndex = sqlite3.connect(os.path.join(indexDir, AccuRev2Git.transactionIndexFilename))
+            self.transactionIndex.executescript(AccuRev2Git.transactionIndexTableQuery)
+            if self.transactionIndex.execute('PRAGMA user_version;').fetchone()[0] < 1:
+                self.transactionIndex.execute('DELETE FROM indexed_refs;') # Indexes the refs again so that their stream names are recorded.
+                self.transactionIndex.execute('PRAGMA user_version = 1;')
+            self.transactionIndex.commit()
+        return self.transactionIndex
+
+    def CloseTransactionIndex(self):
+        if self.transactionIndex is not None:
+            self.transactionIndex.close()
+            self.transactionIndex = None
+
+    # Stops the long lived git processes (fast-import and cat-file) and closes the files that are kept open while converting. Called by Start()
+    # once it is done, whether it succeeded or not.
+    def Close(self):
+        self.CloseFastImport()
+        self.CloseStateJournal()
+        self.CloseTransactionIndex()
+        if self.gitRepo is not None:
+            self.gitRepo.close()
+
+    # Returns a dictionary of { <ref>: <hash> } for the given refs that exist.
+    def GetRefTips(self, refs):
+        refList = self.gitRepo.raw_cmd([ u'git', u'for-each-ref', u'--format=%(refname) %(objectname)' ] + list(refs))
+        if refList is None:
+            raise Exception("Failed to list the refs {refs}. Err: {err}".format(refs=', '.join(refs), err=self.gitRepo.lastStderr))
+        tips = {}
+        for line in refList.strip().split('\n'):
+            columns = line.split(' ')
+            if len(columns) == 2:
+                tips[columns[0]] = columns[1]
+        return tips
+
+    # Brings the index of the stream's info (stateRef) and data (dataRef) refs up to date. The refTips are as returned by GetRefTips() and are
+    # looked up if not given.
+    def SyncTransactionIndex(self, stateRef, dataRef, refTips=None):
+        depotNumber, streamNumber, remainder = self.ParseStreamRef(ref=stateRef)
+        if refTips is None:
+            refTips = self.GetRefTips(refs=[ stateRef, dataRef ])
+
+        index = self.OpenTransactionIndex()
+        cursor = index.cursor()
+        try:
+            for ref, isStateRef in [ (stateRef, True), (dataRef, False) ]:
+                tip = refTips.get(ref)
+                cursor.execute('SELECT tip FROM indexed_refs WHERE ref = ?;', (ref,))
+                row = cursor.fetchone()
+                indexedTip = row[0] if row is not None else None
+                if tip == indexedTip:
+                    continue
+
+                cmd = [ u'git', u'log', u'--format=%H %s %T' ]
+                if isStateRef:
+                    cmd.extend([ u'--raw', u'--root', u'--no-abbrev' ]) # Lists the commits that changed the streams.xml.
+                if indexedTip is not None and tip is not None and self.gitRepo.raw_cmd([ u'git', u'merge-base', u'--is-ancestor', indexedTip, tip ]) is not None:
+                    cmd.extend([ tip, u'^{0}'.format(indexedTip) ])
+                else:
+                    if indexedTip is not None:
+                        logger.info("Rebuilding the transaction index for {ref}.".format(ref=ref))
+                    if isStateRef:
+                        cursor.execute('DELETE FROM transactions WHERE depot = ? AND stream = ?;', (depotNumber, streamNumber))
+                        cursor.execute('DELETE FROM stream_names WHERE depot = ? AND source_stream = ?;', (depotNumber, streamNumber))
+                        cursor.execute('DELETE FROM indexed_refs WHERE ref = ? OR ref = ?;', (stateRef, dataRef)) # The data ref is indexed again as well.
+                    else:
+                        cursor.execute('UPDATE transactions SET data_hash = NULL, data_tree_hash = NULL WHERE depot = ? AND stream = ?;', (depotNumber, streamNumber))
+                        cursor.execute('DELETE FROM indexed_refs WHERE ref = ?;', (ref,))
+                    cmd.append(tip)
+
+                if tip is not None:
+                    commitList = self.gitRepo.raw_cmd(cmd)
+                    if commitList is None:
+                        raise Exception("Failed to index the transactions on {ref}. Command `{cmd}` failed. Err: {err}".format(ref=ref, cmd=' '.join(cmd), err=self.gitRepo.lastStderr))
+                    rows = []
+                    streamsChanges = []
+                    for line in commitList.strip().split('\n'):
+                        columns = line.split(' ')
+                        if len(columns) == 4:
+                            rows.append( (int(columns[2]), columns[0], columns[3]) )
+                        elif len(columns) == 5 and columns[4].endswith('\tstreams.xml') and not columns[4].startswith('D') and len(rows) > 0:
+                            streamsChanges.append(rows[-1])
+
+                    cursor.executemany('INSERT OR IGNORE INTO transactions (depot, stream, tr) VALUES (?, ?, ?);', [ (depotNumber, streamNumber, trId) for trId, commitHash, treeHash in rows ])
+                    if isStateRef:
+                        cursor.executemany('UPDATE transactions SET state_hash = ? WHERE depot = ? AND stream = ? AND tr = ?;', [ (commitHash, depotNumber, streamNumber, trId) for trId, commitHash, treeHash in rows ])
+                    else:
+                        cursor.executemany('UPDATE transactions SET data_hash = ?, data_tree_hash = ? WHERE depot = ? AND stream = ? AND tr = ?;', [ (commitHash, treeHash, depotNumber, streamNumber, trId) for trId, commitHash, treeHash in rows ])
+                    # The log lists the newest commits first and earlier batches are older, so ignoring the existing names keeps the first transaction.
+                    for trId, commitHash, treeHash in reversed(streamsChanges):
+                        streamsXml, streams = self.GetStreamsInfo(ref=commitHash)
+                        if streams is None:
+                            logger.warning("Failed to parse {hash}:streams.xml, its stream names won't be indexed.".format(hash=commitHash))
+                            continue
+                        cursor.executemany('INSERT OR IGNORE INTO stream_names (depot, name, stream, source_stream, tr, state_hash) VALUES (?, ?, ?, ?, ?, ?);', [ (depotNumber, s.name, s.streamNumber, streamNumber, trId, commitHash) for s in streams.streams if s.name is not None ])
+                    cursor.execute('INSERT OR REPLACE INTO indexed_refs (ref, tip) VALUES (?, ?);', (ref, tip))
+                    logger.debug("Indexed {count} transactions on {ref}.".format(count=len(rows), ref=ref))
+        except:
+            index.rollback()
+            raise
+        index.commit()
+
+    # Brings the index of all of the depot's stream refs up to date, once per run. Afterwards the index is kept up to date by the ref updates that
+    # this script makes (see TrySyncTransactionIndex()) so that the lookups below don't have to run git.
+    def SyncDepotTransactionIndex(self, depotNumber):
+        if depotNumber in self.transactionIndexSynced:
+            return
+        refTips = self.GetRefTips(refs=[ self.GetStreamRefsNamespace(depot=depotNumber) ])
+        for ref in refTips:
+            refDepotNumber, streamNumber, remainder = self.ParseStreamRef(ref=ref)
+            if streamNumber is not None and remainder == 'info':
+                stateRef, dataRef, hwmRef = self.GetStreamRefs(depot=depotNumber, streamNumber=streamNumber)
+                self.SyncTransactionIndex(stateRef=stateRef, dataRef=dataRef, refTips=refTips)
+        self.transactionIndexSynced.add(depotNumber)
+
+    # Returns the commit for the transaction on the stream's info or data ref from the transaction index or None if the ref isn't a stream ref or
+    # the transaction isn't in the index.
+    def LookupTransactionIndex(self, ref, trId):
+        depotNumber, streamNumber, remainder = self.ParseStreamRef(ref=ref)
+        if streamNumber is None or remainder not in [ 'info', 'data' ]:
+            return None
+        try:
+            self.SyncDepotTransactionIndex(depotNumber=depotNumber)
+        except Exception as e:
+            logger.warning("Failed to update the transaction index for {ref}: {err}".format(ref=ref, err=e))
+            return None
+
+        cursor = self.OpenTransactionIndex().cursor()
+        cursor.execute('SELECT {column} FROM transactions WHERE depot = ? AND stream = ? AND tr = ?;'.format(column=('state_hash' if remainder == 'info' else 'data_hash')), (depotNumber, streamNumber, trId))
+        row = cursor.fetchone()
+        return row[0] if row is not None else None
+
+    # Returns the stream with the given name, as it was the first time that the name appears in a retrieved streams.xml, or None if the name
+    # isn't in the transaction index.
+    def LookupStreamName(self, depotNumber, streamName):
+        try:
+            self.SyncDepotTransactionIndex(depotNumber=depotNumber)
+
+            cursor = self.OpenTransactionIndex().cursor()
+            cursor.execute('SELECT state_hash FROM stream_names WHERE depot = ? AND name = ? ORDER BY tr, source_stream;', (depotNumber, streamName))
+            for stateHash, in cursor.fetchall():
+                streamsXml, streams = self.GetStreamsInfo(ref=stateHash)
+                s = streams.getStream(streamName) if streams is not None else None
+                if s is not None:
+                    return s
+        except Exception as e:
+            logger.warning("Failed to look up stream '{name}' in the transaction index: {err}".format(name=streamName, err=e))
+        return None
+
+    # Returns a TransactionMap with the transactions of the given streams from the last one at or before afterTransaction, which is needed for the
+    # prevAffectedStreamMap, up to endTransaction.
+    def LoadTransactionIndex(self, depotNumber, streamNumbers, afterTransaction, endTransaction=None):
+        streamRefs = [ self.GetStreamRefs(depot=depotNumber, streamNumber=streamNumber) for streamNumber in streamNumbers ]
+        refTips = self.GetRefTips(refs=[ ref for stateRef, dataRef, hwmRef in streamRefs for ref in (stateRef, dataRef) ])
+        for stateRef, dataRef, hwmRef in streamRefs:
+            if stateRef not in refTips:
+                raise Exception("Failed to retrieve the state map for stream {id}, {ref} doesn't exist.".format(id=self.ParseStreamRef(ref=stateRef)[1], ref=stateRef))
+            elif dataRef not in refTips:
+                raise Exception("Couldn't get the commit hash list to process from the Accurev data ref {dataRef}.".format(dataRef=dataRef))
+            self.SyncTransactionIndex(stateRef=stateRef, dataRef=dataRef, refTips=refTips)
+
+        transactionsMap = TransactionMap()
+        if len(streamNumbers) == 0:
+            return transactionsMap
+        streamsCondition = 'depot = ? AND stream IN ({0})'.format(', '.join([ '?' ] * len(streamNumbers)))
+        streamsArgs = [ depotNumber ] + list(streamNumbers)
+
+        cursor = self.OpenTransactionIndex().cursor()
+        cursor.execute('SELECT MAX(tr) FROM transactions WHERE {0} AND tr <= ?;'.format(streamsCondition), streamsArgs + [ afterTransaction ])
+        row = cursor.fetchone()
+        firstTransaction = row[0] if row is not None and row[0] is not None else afterTransaction
+        query = 'SELECT tr, stream, state_hash, data_hash, data_tree_hash FROM transactions WHERE {0} AND tr >= ?'.format(streamsCondition)
+        args = streamsArgs + [ firstTransaction ]
+        if endTransaction is not None:
+            query += ' AND tr <= ?'
+            args.append(endTransaction)
+        cursor.execute(query + ' ORDER BY tr, stream;', args)
+        for trId, streamNumber, stateHash, dataHash, dataTreeHash in cursor:
+            if stateHash is None:
+                raise Exception("Invariant error! The data ref of stream {s} has transaction {tr} which isn't on its state ref. The data ref should contain a subset of the state ref information, not a superset!".format(s=streamNumber, tr=trId))
+            transactionsMap.Append(trId=trId, streamNumber=streamNumber, stateHash=stateHash, dataHash=dataHash, dataTreeHash=dataTreeHash)
+        return transactionsMap
+
     def ShortHash(self, commitHash):
         if commitHash is None:
             return None
@@ -1788,6 +2901,16 @@ class AccuRev2Git(object):
         return commitHash[:8]
 
     def AddNote(self, transaction, commitHash, ref, note, committerName=None, committerEmail=None, committerDate=None, committerTimezone=None):
+        if note is not None and self.refTransaction is not None:
+            # Written in one notes commit together with the other ref updates of the transaction, see WriteNotes().
+            if ref not in self.pendingNotes:
+                self.pendingNotes[ref] = OrderedDict()
+            self.pendingNotes[ref][commitHash] = note
+            if transaction is not None:
+                self.pendingNotesTransaction = transaction
+            logger.debug( "Queued{ref} note for {hash}.".format(ref='' if ref is None else ' '+str(ref), hash=self.ShortHash(commitHash)) )
+            return ''
+
         notesFilePath = None
         if note is not None:
             with tempfile.NamedTemporaryFile(mode='w+', prefix='ac2git_note_', encoding='utf-8', delete=False) as notesFile:
@@ -1815,6 +2938,30 @@ class AccuRev2Git(object):
         
         return None
 
+    # Writes the notes queued by AddNote() with a single notes commit per notes ref (see git.repo.notes.write()) and adds the notes ref updates to the
+    # ref transaction. The notes are the same as the ones `git notes add` would have written, only the notes commits are fewer.
+    def WriteNotes(self, refTransaction):
+        pendingNotes, self.pendingNotes = self.pendingNotes, OrderedDict()
+        transaction, self.pendingNotesTransaction = self.pendingNotesTransaction, None
+        for ref in pendingNotes:
+            author = None
+            if transaction is not None:
+                author = self.GetTransactionAuthor(tr=transaction)
+            else:
+                author = (None, None, time.time(), None)
+
+            try:
+                commitHash, parent = self.gitRepo.notes.write(notes=pendingNotes[ref], ref=ref, author=author)
+            except Exception as e:
+                commitHash, parent = None, None
+                logger.error( "Failed to write the {ref} notes: {err}".format(ref=ref, err=e) )
+            if commitHash is None:
+                logger.error( "Failed to write {count} {ref} notes. Error:\n{err}".format(count=len(pendingNotes[ref]), ref=ref, err=self.gitRepo.lastStderr) )
+                return False
+            refTransaction.update(ref=git.repo.notes.full_ref(ref), newValue=commitHash, oldValue=parent)
+            logger.debug( "Wrote {count} {ref} notes in commit {hash}.".format(count=len(pendingNotes[ref]), ref=ref, hash=self.ShortHash(commitHash)) )
+        return True
+
     def ProcessStream(self, stream, branchName, startTrId=None, endTrId=None, streamMap=None):
         if stream is not None:
             stateRef, dataRef, hwmRef = self.GetStreamRefs(depot=stream.depotName, streamNumber=stream.streamNumber)
@@ -2180,6 +3327,32 @@ class AccuRev2Git(object):
             return u'{refsNS}state/depots/{depotNumber}/streams/{streamNumber}/commit_history'.format(refsNS=AccuRev2Git.gitRefsNamespace, depotNumber=depot.number, streamNumber=streamNumber)
         return None
 
+    # Returns the author of the transaction as a (name, email, timestamp, timezone) tuple for git.repo.make_commit().
+    def GetTransactionAuthor(self, tr):
+        authorName, authorEmail = self.GetGitUserFromAccuRevUser(tr.user)
+        authorDate, authorTimezone = self.GetGitDatetime(accurevUsername=tr.user, accurevDatetime=tr.time)
+        timestamp = (tr.time - datetime(1970, 1, 1)).total_seconds()
+        return (authorName, authorEmail, timestamp, authorTimezone)
+
+    # Builds an empty tree commit for the transaction on the commit_history refs in memory and returns its hash. The commits are written to the
+    # repository by WriteCommitHistory().
+    def MakeCommitHistoryCommit(self, tr, parents):
+        author = self.GetTransactionAuthor(tr=tr)
+        commitHash, data = self.gitRepo.make_commit(tree=self.commitHistoryEmptyTree, parents=parents, message='transaction {trId}'.format(trId=tr.id), author=author, committer=author)
+        self.commitHistoryObjects.append( (commitHash, data) )
+        return commitHash
+
+    # Writes the commit_history commits built by MakeCommitHistoryCommit() with a single git command. Must be done before the refs that point to them
+    # are updated.
+    def WriteCommitHistory(self):
+        if len(self.commitHistoryObjects) == 0:
+            return True
+        objects, self.commitHistoryObjects = self.commitHistoryObjects, []
+        if self.gitRepo.write_objects(objects=objects, objType='commit') != True:
+            logger.error("Failed to write {count} commit history commits. Error:\n{err}".format(count=len(objects), err=self.gitRepo.lastStderr))
+            return False
+        return True
+
     def LogBranchState(self, stream, tr, commitHash):
         assert stream is not None and commitHash is not None and tr is not None, "LogBranchState(stream={s}, tr={t}, commitHash={h}) does not accept None arguments.".format(s=stream, t=tr, h=commitHash)
 
@@ -2189,23 +3362,126 @@ class AccuRev2Git(object):
             raise Exception("Failed to get hidden ref for stream {streamName} (id: {streamNumber}) depot {depotName}".format(streamName=stream.name, streamNumber=stream.streamNumber, depotName=stream.depotName))
 
         # Write the empty tree to the git repository to ensure there is one.
-        emptyTree = self.gitRepo.empty_tree(write=True)
-        if emptyTree is None or len(emptyTree) == 0:
-            raise Exception("Failed to write empty tree to git repository!")
-
-        # Get the last known state
-        lastStateCommitHash = self.GetLastCommitHash(ref=streamStateRefspec)
+        if self.commitHistoryEmptyTree is None:
+            emptyTree = self.gitRepo.empty_tree(write=True)
+            if emptyTree is None or len(emptyTree) == 0:
+                raise Exception("Failed to write empty tree to git repository!")
+            self.commitHistoryEmptyTree = emptyTree
+
+        # Get the last known state. The tip of each commit_history ref is kept in memory since we are the only ones writing to it, LoadBranchPositions()
+        # reads it the first time (a new ref has no tip, there's no need to retry the lookup).
+        positions = self.LoadBranchPositions(ref=streamStateRefspec)
+        lastStateCommitHash = self.commitHistoryTips.get(streamStateRefspec, positions["tip"])
+        oldStateCommitHash = lastStateCommitHash
+        timestamp = int((tr.time - datetime(1970, 1, 1)).total_seconds()) # The committer date of the commit_history commits.
         if lastStateCommitHash is None:
             # Since we will use git log --first-parent a lot we need to make sure we have a parentless commit to start off with.
-            lastStateCommitHash = self.Commit(transaction=tr, allowEmptyCommit=True, messageOverride='transaction {trId}'.format(trId=tr.id), parents=[], treeHash=emptyTree, ref=streamStateRefspec, checkout=False, authorIsCommitter=True)
-            if lastStateCommitHash is None:
-                raise Exception("Failed to add empty state commit for stream {streamName} (id: {streamNumber})".format(streamName=stream.name, streamNumber=stream.streamNumber))
+            lastStateCommitHash = self.MakeCommitHistoryCommit(tr=tr, parents=[])
+            positions["orphan_timestamp"] = timestamp
             logger.debug("Created state branch for stream {streamName} as {ref} - tr. {trType} {trId} - commit {h}".format(trType=tr.Type, trId=tr.id, streamName=stream.name, ref=streamStateRefspec, h=self.ShortHash(lastStateCommitHash)))
-        stateCommitHash = self.Commit(transaction=tr, allowEmptyCommit=True, messageOverride='transaction {trId}'.format(trId=tr.id), parents=[ lastStateCommitHash, commitHash ], treeHash=emptyTree, ref=streamStateRefspec, checkout=False, authorIsCommitter=True)
-        if stateCommitHash is None:
+        stateCommitHash = self.MakeCommitHistoryCommit(tr=tr, parents=[ lastStateCommitHash, commitHash ])
+
+        # Without a ref transaction (see BeginRefTransaction()) the ref is updated straight away so the commits must be written first.
+        if self.refTransaction is None and self.WriteCommitHistory() != True:
+            raise Exception("Failed to write the commit history for {Type} {tr} to hidden state ref {ref}".format(Type=tr.Type, tr=tr.id, ref=streamStateRefspec))
+        if self.UpdateAndCheckoutRef(ref=streamStateRefspec, commitHash=stateCommitHash, checkout=False, oldCommitHash=oldStateCommitHash) != True:
             raise Exception("Failed to commit {Type} {tr} to hidden state ref {ref} with commit {h}".format(Type=tr.Type, tr=tr.id, ref=streamStateRefspec, h=self.ShortHash(commitHash)))
+        self.commitHistoryTips[streamStateRefspec] = stateCommitHash
+        self.AddBranchPosition(positions=positions, timestamp=timestamp, commitHash=commitHash, tip=stateCommitHash)
         logger.debug("Committed stream state for {streamName} to {ref} - tr. {trType} {trId} - commit {h}".format(trType=tr.Type, trId=tr.id, streamName=stream.name, ref=streamStateRefspec, h=self.ShortHash(stateCommitHash)))
 
+    # The persisted positions of a commit_history ref, so that restarts only need to read the commits added since they were last saved.
+    def GetBranchPositionsRef(self, commitHistoryRef):
+        return u'{ref}_positions'.format(ref=commitHistoryRef)
+
+    # Returns the positions of the branch recorded on the commit_history ref, oldest first, as a dictionary with the keys:
+    #   tip:              the commit_history commit that the positions were read up to.
+    #   orphan_timestamp: the timestamp of the parentless first commit, i.e. the earliest time for which we know the position of the branch.
+    #   timestamps:       the committer timestamps of the commit_history commits.
+    #   commits:          the branch commits (second parents) recorded by the commit_history commits.
+    # They are loaded once, from the persisted positions (see SaveBranchPositions()) and the commits added since, and kept up to date by LogBranchState().
+    def LoadBranchPositions(self, ref):
+        positions = self.branchPositions.get(ref)
+        if positions is not None:
+            return positions
+
+        positions = { "tip": None, "orphan_timestamp": None, "timestamps": [], "commits": [], "sorted": True, "dirty": False }
+        self.branchPositions[ref] = positions
+
+        tip = self.gitRepo.raw_cmd([ u'git', u'rev-parse', u'--verify', u'--quiet', u'{ref}^{{commit}}'.format(ref=ref) ])
+        if tip is None or len(tip.strip()) == 0:
+            return positions # A new commit_history ref.
+        tip = tip.strip()
+
+        positionsText = self.ReadFileRef(ref=self.GetBranchPositionsRef(commitHistoryRef=ref))
+        if positionsText is not None and len(positionsText) > 0:
+            try:
+                persisted = json.loads(positionsText)
+                if persisted["tip"] == tip or self.gitRepo.merge_base(commits=[ persisted["tip"], tip ], is_ancestor=True):
+                    positions["tip"] = persisted["tip"]
+                    positions["orphan_timestamp"] = persisted["orphan_timestamp"]
+                    for timestamp, commitHash in persisted["positions"]:
+                        self.AddBranchPosition(positions=positions, timestamp=timestamp, commitHash=commitHash)
+            except Exception:
+                logger.warning("Failed to load the branch positions for {ref}, they will be rebuilt.".format(ref=ref))
+                positions["tip"], positions["orphan_timestamp"], positions["timestamps"], positions["commits"], positions["sorted"] = None, None, [], [], True
+
+        if positions["tip"] != tip:
+            cmd = [ u'git', u'log', u'--first-parent', u'--format=%ct %P', tip ]
+            if positions["tip"] is not None:
+                cmd.append(u'^{h}'.format(h=positions["tip"]))
+            commitList = self.gitRepo.raw_cmd(cmd)
+            if commitList is None:
+                raise Exception("Failed to read the branch positions from {ref}. Err: {err}".format(ref=ref, err=self.gitRepo.lastStderr))
+            for line in reversed(commitList.strip().split('\n')):
+                columns = line.split()
+                if len(columns) == 1:
+                    positions["orphan_timestamp"] = int(columns[0])
+                elif len(columns) > 2:
+                    self.AddBranchPosition(positions=positions, timestamp=int(columns[0]), commitHash=columns[2])
+            positions["tip"] = tip
+            positions["dirty"] = True
+
+        return positions
+
+    def AddBranchPosition(self, positions, timestamp, commitHash, tip=None):
+        if len(positions["timestamps"]) > 0 and timestamp < positions["timestamps"][-1]:
+            positions["sorted"] = False
+        positions["timestamps"].append(timestamp)
+        positions["commits"].append(commitHash)
+        if tip is not None:
+            positions["tip"] = tip
+            positions["dirty"] = True
+
+    # Returns the branch commit recorded on the commit_history ref by the newest commit_history commit at or before the timestamp (see git log --before),
+    # the last recorded one if the timestamp is None, or None if there isn't one.
+    def GetBranchPosition(self, ref, timestamp=None):
+        positions = self.LoadBranchPositions(ref=ref)
+        timestamps, commits = positions["timestamps"], positions["commits"]
+        if len(commits) == 0:
+            return None
+        elif timestamp is None:
+            return commits[-1]
+        elif positions["sorted"]:
+            i = bisect.bisect_right(timestamps, timestamp)
+            return commits[i - 1] if i > 0 else None
+        for i in range(len(timestamps) - 1, -1, -1):
+            # Timelocks and clock skew can put the timestamps out of order, in which case git log returns the first match walking back from the tip.
+            if timestamps[i] <= timestamp:
+                return commits[i]
+        return None
+
+    def SaveBranchPositions(self):
+        for ref in self.branchPositions:
+            positions = self.branchPositions[ref]
+            if positions["dirty"] and positions["tip"] is not None:
+                persisted = OrderedDict()
+                persisted["tip"] = positions["tip"]
+                persisted["orphan_timestamp"] = positions["orphan_timestamp"]
+                persisted["positions"] = list(zip(positions["timestamps"], positions["commits"]))
+                self.WriteFileRef(ref=self.GetBranchPositionsRef(commitHistoryRef=ref), text=json.dumps(persisted))
+                positions["dirty"] = False
+
     def TagTransaction(self, tagName, objHash, tr, stream, title=None, friendlyMessage=None, force=False):
         tagMessage, notes = self.GenerateCommitMessage(transaction=tr, stream=stream, title=title, friendlyMessage=friendlyMessage)
         
@@ -2258,6 +3534,9 @@ class AccuRev2Git(object):
                 logger.error("Failed to tag {trType} {trId}. Tag points to {commitHash} instead of {objHash}".format(trType=tr.Type, trId=tr.id, commitHash=commitHash, objHash=objHash))
                 return False
 
+        if self.branchTags is not None and tagName in self.branchHeads:
+            self.branchTags[tagName] = objHash
+
         return True
         
     def CommitTransaction(self, tr, stream, parents=None, treeHash=None, branchName=None, title=None, srcStream=None, dstStream=None, friendlyMessage=None, cherryPickSrcHash=None, refNamespace='refs/heads/'):
@@ -2282,6 +3561,9 @@ class AccuRev2Git(object):
 
     def GitRevParse(self, ref):
         if ref is not None:
+            pendingHash = self.GetPendingRef(name=str(ref))
+            if pendingHash is not None:
+                return pendingHash
             commitHash = self.gitRepo.rev_parse(args=[str(ref)], verify=True)
             if commitHash is None:
                 raise Exception("Failed to parse git revision {ref}. Err: {err}.".format(ref=ref, err=self.gitRepo.lastStderr))
@@ -2421,6 +3703,10 @@ class AccuRev2Git(object):
         return None
 
     def GetOrphanCommit(self, ref, customFormat='%H'):
+        pendingHash = self.GetPendingRef(name=ref)
+        if pendingHash is not None:
+            self.WriteCommitHistory() # The pending commit may be a commit_history commit that only exists in memory.
+            ref = pendingHash
         cmd = [u'git', u'log', u'-1', u'--format=format:{format}'.format(format=customFormat), u'--first-parent', u'--max-parents=0', ref]
         return self.TryGitCommand(cmd=cmd)
 
@@ -2458,46 +3744,42 @@ class AccuRev2Git(object):
 
         if basisBranchName is not None:
             basisBranchHistoryRef = self.GetStreamCommitHistoryRef(basisStream.depotName, basisStream.streamNumber)
-
             timelockMessage = ''
             timelockISO8601Str = None
             if minTime is not None and accurev.GetTimestamp(minTime) != 0: # A timestamp of 0 indicates that a timelock was removed.
                 timelockISO8601Str = "{datetime}Z".format(datetime=minTime.isoformat('T')) # The time is in UTC and ISO8601 requires us to specify Z for UTC.
                 timelockMessage = ", before {s}".format(s=timelockISO8601Str)
 
-            parentHashes = None
-            earliestAllowedTimestamp = self.GetOrphanCommit(ref=basisBranchHistoryRef, customFormat='%at')
+            # The positions of the basis branch over time are kept in memory (see LoadBranchPositions()) instead of walking the commit_history ref.
+            basisCommitHash = None
+            earliestAllowedTimestamp = self.LoadBranchPositions(ref=basisBranchHistoryRef)["orphan_timestamp"]
             if earliestAllowedTimestamp is None:
                 logger.error("Failed to retrieve first commit hash for {ref}".format(ref=basisBranchHistoryRef))
                 return None, None, None, None
 
-            cmd = []
             if minTime is not None and (accurev.GetTimestamp(minTime) < int(earliestAllowedTimestamp)):
                 # The timelock has been created before the creation date of the stream. We cannot return its
                 # state before this time so we must return its first known/possible state.
-                cmd = [u'git', u'log', u'-1', u'--format=format:%P', u'--reverse', u'--min-parents=1', u'--first-parent', basisBranchHistoryRef]
-                parentHashes = self.TryGitCommand(cmd=cmd)
+                # Note: this has always been the result of `git log -1 --reverse --min-parents=1 --first-parent <ref>`, which limits the output to
+                #       one commit before reversing it, i.e. the last recorded position.
+                basisCommitHash = self.GetBranchPosition(ref=basisBranchHistoryRef)
                 logger.warning("Currently processed transaction requested its basis commit hash before its basis existed.")
                 logger.warning("  - Earliest time available: {t}.".format(t=accurev.UTCDateTimeOrNone(earliestAllowedTimestamp)))
                 logger.warning("  - Time requested:          {t}.".format(t=minTime))
                 logger.warning(" Returning the earliest time available instead. TODO: What does Accurev actually do here? Should we look at the next basis in the chain?")
+            elif timelockISO8601Str is not None:
+                basisCommitHash = self.GetBranchPosition(ref=basisBranchHistoryRef, timestamp=accurev.GetTimestamp(minTime))
             else:
-                cmd = [u'git', u'log', u'-1', u'--format=format:%P', u'--first-parent']
-                if timelockISO8601Str is not None:
-                    cmd.append(u'--before={before}'.format(before=timelockISO8601Str))
-                cmd.append(basisBranchHistoryRef)
-                parentHashes = self.TryGitCommand(cmd=cmd)
-
-            if parentHashes is None:
-                logger.error("Failed to retrieve last git commit hash. Command `{0}` failed.".format(' '.join(cmd)))
-                return None, None, None, None
+                basisCommitHash = self.GetBranchPosition(ref=basisBranchHistoryRef)
 
-            parents = parentHashes.split()
+            if basisCommitHash is None:
+                logger.error("Failed to retrieve the position of the basis branch from {ref}{timelockMsg}.".format(ref=basisBranchHistoryRef, timelockMsg=timelockMessage))
+                return None, None, None, None
 
-            logger.debug("GetBasisCommitHash: Basis stream {basisName} (id: {basisSN}) at commit hash {h} is the basis for stream {name} (id: {sn}){timelockMsg}. (Retrieved from {ref})".format(name=streamName, sn=streamNumber, basisName=basisStream.name, basisSN=basisStream.streamNumber, ref=basisBranchHistoryRef, timelockMsg=timelockMessage, h=self.ShortHash(parents[1])))
+            logger.debug("GetBasisCommitHash: Basis stream {basisName} (id: {basisSN}) at commit hash {h} is the basis for stream {name} (id: {sn}){timelockMsg}. (Retrieved from {ref})".format(name=streamName, sn=streamNumber, basisName=basisStream.name, basisSN=basisStream.streamNumber, ref=basisBranchHistoryRef, timelockMsg=timelockMessage, h=self.ShortHash(basisCommitHash)))
 
             logger.debug("GetBasisCommitHash: Commit hash for stream {name} (id: {sn}) was not found.".format(name=streamName, sn=streamNumber))
-            return basisStream, basisBranchName, parents[1], minTime
+            return basisStream, basisBranchName, basisCommitHash, minTime
 
         logger.debug("GetBasisCommitHash: Commit hash for stream {name} (id: {sn}) was not found.".format(name=streamName, sn=streamNumber))
         return None, None, None, None
@@ -2569,7 +3851,7 @@ class AccuRev2Git(object):
         return None, None
 
     # Processes a single transaction whose id is the trId (int) and which has been recorded against the streams outlined in the affectedStreamMap.
-    # affectedStreamMap is a dictionary with the following format { <key:stream_num_str>: { "state_hash": <val:state_ref_commit_hash>, "data_hash": <val:data_ref_commit_hash> } }
+    # affectedStreamMap is a read-only mapping (see TransactionMap.Transaction) with the following format { <key:stream_num>: { "state_hash": <val:state_ref_commit_hash>, "data_hash": <val:data_ref_commit_hash>, "data_tree_hash": <val:data_tree_hash> } }
     # The streamMap is used so that we can translate streams and their basis into branch names { <key:stream_num_str>: { "stream": <val:config_strem_name>, "branch": <val:config_branch_name> } }
     def ProcessTransaction(self, streamMap, trId, affectedStreamMap, prevAffectedStreamMap):
         # For all affected streams the streams.xml and hist.xml contents should be the same for the same transaction id so get it from any one of them.
@@ -2888,6 +4170,9 @@ class AccuRev2Git(object):
 
     def ReadFileRef(self, ref):
         rv = None
+        pendingHash = self.GetPendingRef(name=ref)
+        if pendingHash is not None:
+            ref = pendingHash
         for i in range(0, AccuRev2Git.commandFailureRetryCount):
             rv = self.gitRepo.raw_cmd([u'git', u'show', ref])
             if rv is None:
@@ -2912,9 +4197,15 @@ class AccuRev2Git(object):
                     tryCount += 1
                 os.remove(filePath)
                 updateRefRetr = None
-                if objHash is not None:
+                if objHash is not None and self.refTransaction is not None:
+                    self.refTransaction.update(ref=ref, newValue=objHash)
+                    self.SetBranchHead(ref=ref, commitHash=objHash, queued=True)
+                    updateRefRetr = ''
+                elif objHash is not None:
                     cmd = [ u'git', u'update-ref', ref, objHash ]
                     updateRefRetr = self.gitRepo.raw_cmd(cmd)
+                    if updateRefRetr is not None:
+                        self.SetBranchHead(ref=ref, commitHash=objHash)
                 if objHash is None or updateRefRetr is None:
                     logger.debug("Error! Command {cmd}".format(cmd=' '.join(str(x) for x in cmd)))
                     logger.debug("  Failed with: {err}".format(err=self.gitRepo.lastStderr))
@@ -2926,18 +4217,143 @@ class AccuRev2Git(object):
             return True
         return False
 
+    # The full conversion state is only written to the state ref (a checkpoint) every config.git.checkpointInterval transactions. In between, the changes
+    # to the branches are appended to a journal file in the git directory, which starts with the hash of the checkpoint that it continues, so that
+    # LoadStateJournal() can replay them on top of that checkpoint after an interruption.
+    def GetStateJournalPath(self, depotNumber):
+        gitDir = self.gitRepo.git_dir()
+        if gitDir is None:
+            raise Exception("Failed to find the git directory. Err: {err}".format(err=self.gitRepo.lastStderr))
+        return os.path.join(gitDir, u'ac2git', u'depot_{depotNumber}_state.journal'.format(depotNumber=depotNumber))
+
+    # Writes the state to the ref and starts a new journal for it.
+    def WriteStateCheckpoint(self, ref, state, journalPath):
+        stateHash = self.gitRepo.hash_object(json.dumps(state))
+        if stateHash is None or self.gitRepo.raw_cmd([ u'git', u'update-ref', ref, stateHash ]) is None:
+            raise Exception("Failed to write state to {ref}. Err: {err}".format(ref=ref, err=self.gitRepo.lastStderr))
+
+        self.CloseStateJournal()
+        journalDir = os.path.dirname(journalPath)
+        if not os.path.isdir(journalDir):
+            os.makedirs(journalDir)
+        self.stateJournal = open(journalPath, 'w', encoding='utf-8')
+        self.stateJournal.write(u'{0}\n'.format(json.dumps({ "checkpoint": stateHash })))
+        self.stateJournal.flush()
+        return stateHash
+
+    # Records that the transaction was processed and moved the branches in the list (in the "branch_list" format).
+    def AppendStateJournal(self, trId, branchList):
+        self.stateJournal.write(u'{0}\n'.format(json.dumps({ "last_transaction": trId, "branch_list": branchList })))
+        self.stateJournal.flush()
+
+    def CloseStateJournal(self):
+        if self.stateJournal is not None:
+            self.stateJournal.close()
+            self.stateJournal = None
+
+    # Returns the state with the transactions in the journal replayed on top of it, provided that the journal continues the checkpoint with the given hash.
+    def LoadStateJournal(self, journalPath, stateHash, state):
+        if not os.path.isfile(journalPath):
+            return state
+        with open(journalPath, 'r', encoding='utf-8') as f:
+            lines = f.read().split('\n')
+
+        try:
+            header = json.loads(lines[0])
+        except ValueError:
+            header = None
+        if header is None or header.get("checkpoint") != stateHash:
+            logger.debug("Ignoring state journal {path}, it doesn't continue the state {hash}.".format(path=journalPath, hash=stateHash))
+            return state
+
+        branchList = OrderedDict()
+        for br in (state["branch_list"] or []):
+            branchList[br["name"]] = br
+        replayCount = 0
+        for line in lines[1:]:
+            if len(line) == 0:
+                continue
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                logger.warning("Stopped replaying the state journal {path} at a partially written entry.".format(path=journalPath))
+                break
+            if entry["last_transaction"] <= state["last_transaction"]:
+                continue
+            for br in entry["branch_list"]:
+                branchList[br["name"]] = br
+            state["last_transaction"] = entry["last_transaction"]
+            replayCount += 1
+
+        if replayCount > 0:
+            logger.info("Replayed {count} transactions from the state journal, last transaction #{tr}.".format(count=replayCount, tr=state["last_transaction"]))
+            state["branch_list"] = list(branchList.values())
+        return state
+
+    # The depot manifest is a json blob in the refs/ac2git/depots/<depot number>/manifest ref which records, for every retrieved stream of the depot,
+    # its high-water-mark, the last transactions on its info and data refs and the commits that those refs point to, in the format
+    # { "streams": { <key:stream_num_str>: { "high-water-mark": <tr>, "info": <tr>, "info-hash": <hash>, "data": <tr>, "data-hash": <hash> } } }.
+    # RetrieveStream() updates it together with the stream's hwm ref so that GetDepotHighWaterMark() and PrintStatus() only need to read it.
+    def GetDepotManifestRef(self, depot):
+        depotNS = self.GetDepotRefsNamespace(depot=depot)
+        if depotNS is None:
+            return None
+        return u'{depotNS}manifest'.format(depotNS=depotNS)
+
+    # Returns the streams of the depot manifest. A missing manifest, e.g. for a repository that was retrieved before it existed, is built from the
+    # stream refs and written.
+    def ReadDepotManifest(self, depot):
+        manifestRef = self.GetDepotManifestRef(depot=depot)
+        if manifestRef is None:
+            raise Exception("Failed to find the refs namespace for depot {depot}.".format(depot=depot))
+        text = self.ReadFileRef(ref=manifestRef)
+        if text is not None:
+            return json.loads(text)["streams"]
+
+        logger.info("Building the manifest of depot {depot} from its stream refs.".format(depot=depot))
+        manifest = {}
+        self.UpdateDepotManifestEntries(manifest=manifest, refs=[ self.GetStreamRefsNamespace(depot=depot) ])
+        self.WriteFileRef(ref=manifestRef, text=json.dumps({ "streams": manifest }))
+        return manifest
+
+    # Reads the given stream refs (or namespaces) with a single git command and records the ones that moved in the manifest. The info and data
+    # transactions are taken from the subjects ("transaction <tr>") of the commits that the refs point to.
+    def UpdateDepotManifestEntries(self, manifest, refs):
+        refList = self.gitRepo.raw_cmd([ u'git', u'for-each-ref', u'--format=%(refname) %(objectname) %(subject)' ] + list(refs))
+        if refList is None:
+            raise Exception("Failed to list the stream refs {refs}. Err: {err}".format(refs=', '.join(refs), err=self.gitRepo.lastStderr))
+        for line in refList.strip().split('\n'):
+            columns = line.split(' ')
+            depotNumber, streamNumber, remainder = self.ParseStreamRef(ref=columns[0])
+            if streamNumber is None or len(columns) < 2:
+                continue
+            entry = manifest.setdefault(str(streamNumber), {})
+            if remainder in [ "info", "data" ] and len(columns) == 4 and entry.get(remainder + "-hash") != columns[1]:
+                entry[remainder] = int(columns[3])
+                entry[remainder + "-hash"] = columns[1]
+            elif remainder == "hwm":
+                blobHash, blobType, data = self.gitRepo.catFile.read(columns[1])
+                if data is None:
+                    raise Exception("Failed to read ref {r}!".format(r=columns[0]))
+                entry["high-water-mark"] = json.loads(git.decode_proc_output(data)).get("high-water-mark")
+
+    # Updates the stream's entry in the depot manifest with the new high-water-mark (None if it didn't change) and with the info and data refs
+    # that moved since the entry was written.
+    def UpdateDepotManifest(self, depot, streamNumber, highWaterMark=None):
+        manifest = self.ReadDepotManifest(depot=depot)
+        stateRef, dataRef, hwmRef = self.GetStreamRefs(depot=depot, streamNumber=streamNumber)
+        self.UpdateDepotManifestEntries(manifest=manifest, refs=[ stateRef, dataRef ])
+        if highWaterMark is not None:
+            manifest.setdefault(str(streamNumber), {})["high-water-mark"] = highWaterMark
+        self.WriteFileRef(ref=self.GetDepotManifestRef(depot=depot), text=json.dumps({ "streams": manifest }))
+
     def GetDepotHighWaterMark(self, depot):
-        streamRefs = self.GetAllKnownStreamRefs(depot)
+        manifest = self.ReadDepotManifest(depot=depot)
         lowestHwm = None
-        for sRef in streamRefs:
-            depotNumber, streamNumber, remainder = self.ParseStreamRef(sRef)
-            if streamNumber is not None and remainder == "hwm":
-                text = self.ReadFileRef(ref=sRef)
-                if text is None:
-                    logger.error("Failed to read ref {r}!".format(r=sRef))
-                hwm = json.loads(text)
-                if lowestHwm is None or hwm["high-water-mark"] < lowestHwm:
-                    lowestHwm = hwm["high-water-mark"]
+        for streamNumberStr in manifest:
+            hwm = manifest[streamNumberStr].get("high-water-mark")
+            if hwm is not None and (lowestHwm is None or hwm < lowestHwm):
+                lowestHwm = hwm
         return lowestHwm
 
     def ProcessTransactions(self):
@@ -2964,9 +4380,11 @@ class AccuRev2Git(object):
             streamMap[str(stream.streamNumber)] = { "stream": configStream, "branch": branchName }
 
         # Load the last known state of the conversion repository.
+        stateJournalPath = self.GetStateJournalPath(depotNumber=depot.number)
         stateText = self.ReadFileRef(ref=stateRefspec)
         if stateText is not None:
             state = json.loads(stateText)
+            state = self.LoadStateJournal(journalPath=stateJournalPath, stateHash=self.GitRevParse(stateRefspec), state=state)
             # Restore the last known git repository state. We could have been interrupted in the middle of merges or other things so we need to be
             # able to restore all branches.
             if state["branch_list"] is not None and len(state["branch_list"]) > 0:
@@ -3058,51 +4476,6 @@ class AccuRev2Git(object):
                       "last_transaction": (int(self.config.accurev.startTransaction) - 1),
                       "branch_list": None }
 
-        # Get the list of transactions that we are processing, and build a list of known branch names for maintaining their states between processing stages.
-        transactionsMap = {} # is a dictionary with the following format { <key:tr_num>: { <key:stream_num>: { "state_hash": <val:commit_hash>, "data_hash": <val:data_hash> } } }
-        for streamNumberStr in state["stream_map"]:
-            streamNumber = int(streamNumberStr)
-
-            # Initialize the state that we load every time.
-            stateRef, dataRef, hwmRef = self.GetStreamRefs(depot=state["depot_number"], streamNumber=streamNumber)
-
-            # Get the state ref's known transactions list.
-            logger.info("Getting transaction to info commit mapping for stream number {s}. Ref: {ref}".format(s=streamNumber, ref=stateRef))
-            stateMap = self.GetRefMap(ref=stateRef, mapType="tr2commit")
-            if stateMap is None:
-                raise Exception("Failed to retrieve the state map for stream {s} (id: {id}).".format(s=state["stream_map"][streamNumberStr]["stream"], id=streamNumber))
-
-            logger.info("Merging transaction to info commit mapping for stream number {s} with previous mappings. Ref: {ref}".format(s=streamNumber, ref=stateRef))
-            for tr in reversed(stateMap):
-                if tr not in transactionsMap:
-                    transactionsMap[tr] = {}
-                assert streamNumber not in transactionsMap[tr], "Invariant error! This should be the first time we are adding the stream {s} (id: {id})!".format(s=state["stream_map"][streamNumberStr]["stream"], id=streamNumber)
-                transactionsMap[tr][streamNumber] = { "state_hash": stateMap[tr] }
-            del stateMap # Make sure we free this, it could get big...
-
-            # Get the data ref's known transactions list.
-            logger.info("Getting transaction to data commit mapping for stream number {s}. Ref: {ref}".format(s=streamNumber, ref=stateRef))
-            dataMap = None
-            dataHashList = self.GetGitLogList(ref=dataRef, gitLogFormat='%H %s %T')
-            if dataHashList is None:
-                raise Exception("Couldn't get the commit hash list to process from the Accurev data ref {dataRef}.".format(dataRef=dataRef))
-            else:
-                dataMap = OrderedDict()
-                for line in reversed(dataHashList):
-                    columns = line.split(' ')
-                    trId, commitHash, treeHash = int(columns[2]), columns[0], columns[3]
-                    dataMap[trId] = { "data_hash": commitHash, "data_tree_hash": treeHash }
-
-            if dataMap is None:
-                raise Exception("Failed to retrieve the data map for stream {s} (id: {id}).".format(s=state["stream_map"][streamNumberStr], id=streamNumber))
-
-            logger.info("Merging transaction to data commit mapping for stream number {s} with previous mappings. Ref: {ref}".format(s=streamNumber, ref=stateRef))
-            for tr in reversed(dataMap):
-                assert tr in transactionsMap and streamNumber in transactionsMap[tr], "Invariant error! The data ref should contain a subset of the state ref information, not a superset!"
-                transactionsMap[tr][streamNumber]["data_hash"] = dataMap[tr]["data_hash"]
-                transactionsMap[tr][streamNumber]["data_tree_hash"] = dataMap[tr]["data_tree_hash"]
-            del dataMap # Make sure we free this, it could get big...
-                
         # Other state variables
         endTransaction = self.GetDepotHighWaterMark(self.config.accurev.depot)
         logger.info("{depot} depot high-water mark is {hwm}.".format(depot=self.config.accurev.depot, hwm=endTransaction))
@@ -3113,39 +4486,60 @@ class AccuRev2Git(object):
                  # that the configured end transaction is lower than the lowest high-water-mark we
                  # have for the depot.
 
+        # Get the list of transactions that we are processing from the transaction index, which is brought up to date with the stream refs first.
+        logger.info("Loading the transactions to process from the transaction index.")
+        transactionsMap = self.LoadTransactionIndex(depotNumber=state["depot_number"], streamNumbers=[ int(x) for x in state["stream_map"] ], afterTransaction=state["last_transaction"], endTransaction=endTransaction)
+        logger.info("Loaded {count} transactions.".format(count=len(transactionsMap)))
+
         logger.info("Processing transactions for {depot} depot.".format(depot=self.config.accurev.depot))
         knownBranchSet = set([ state["stream_map"][x]["branch"] for x in state["stream_map"] ]) # Get the list of all branches that we will create.
+        self.LoadBranchHeads(branchNames=knownBranchSet) # After the branches were restored and renamed above.
+
+        # Start from a checkpoint of the restored state since the stream map may have changed. The journal then only needs the branch changes.
+        state["branch_list"] = self.GetBranchHeadList()
+        self.WriteStateCheckpoint(ref=stateRefspec, state=state, journalPath=stateJournalPath)
+        lastBranches = dict([ (br["name"], br) for br in state["branch_list"] ])
+        uncheckpointedCount = 0
+
         prevAffectedStreamMap = None
-        for tr in sorted(transactionsMap):
+        for tr in transactionsMap: # Sorted by transaction.
             if tr <= state["last_transaction"]:
                 prevAffectedStreamMap = transactionsMap[tr]
-                del transactionsMap[tr] # ok since sorted returns a sorted list by copy.
                 continue
             elif tr > endTransaction:
                 break
 
-            # Process the transaction!
-            self.ProcessTransaction(streamMap=state["stream_map"], trId=tr, affectedStreamMap=transactionsMap[tr], prevAffectedStreamMap=prevAffectedStreamMap)
+            # Process the transaction! All of the branch and commit history ref updates are applied together once it is done so that an interrupted
+            # transaction leaves none of them behind.
+            self.BeginRefTransaction()
+            try:
+                self.ProcessTransaction(streamMap=state["stream_map"], trId=tr, affectedStreamMap=transactionsMap[tr], prevAffectedStreamMap=prevAffectedStreamMap)
+            except:
+                self.AbortRefTransaction()
+                raise
+            if self.CommitRefTransaction() != True:
+                raise Exception("Failed to update the refs for transaction {trId}.".format(trId=tr))
 
             # Store the state of the branches in the repo at this point in time so that we can restore it on next restart.
-            state["branch_list"] = []
-            for br in self.gitRepo.branch_list():
-                if br is None:
-                    logger.error("Error: git.py failed to parse a branch name! Please ensure that the git.repo.branch_list() returns a list with no None items. Non-fatal, continuing.")
-                    continue
-                elif br.name in knownBranchSet:
-                    # We only care about the branches that we are processing, i.e. the branches that are in the streamMap.
-                    brHash = OrderedDict()
-                    brHash["name"] = br.name
-                    brHash["commit"] = br.shortHash
-                    brHash["is_current"] = br.isCurrent
-                    state["branch_list"].append(brHash)
-
+            # We only care about the branches that we are processing, i.e. the branches that are in the streamMap.
+            state["branch_list"] = self.GetBranchHeadList()
             state["last_transaction"] = tr
-            if self.WriteFileRef(ref=stateRefspec, text=json.dumps(state)) != True:
-                raise Exception("Failed to write state to {ref}.".format(ref=stateRefspec))
+
+            uncheckpointedCount += 1
+            if uncheckpointedCount >= self.config.git.checkpointInterval:
+                self.WriteStateCheckpoint(ref=stateRefspec, state=state, journalPath=stateJournalPath)
+                uncheckpointedCount = 0
+            else:
+                self.AppendStateJournal(trId=tr, branchList=[ br for br in state["branch_list"] if lastBranches.get(br["name"]) != br ]) # Moved or checked out/left.
+            lastBranches = dict([ (br["name"], br) for br in state["branch_list"] ])
 
             prevAffectedStreamMap = transactionsMap[tr]
+
+        if uncheckpointedCount > 0:
+            self.WriteStateCheckpoint(ref=stateRefspec, state=state, journalPath=stateJournalPath)
+        self.CloseStateJournal()
+        self.branchHeads, self.branchTags = None, None
+        self.SaveBranchPositions()
         return True
 
             
@@ -3230,149 +4624,155 @@ class AccuRev2Git(object):
         
         # This try/catch/finally block is here to ensure that we change directory back to self.cwd in order
         # to allow other scripts to safely call into this method.
-        if self.InitGitRepo(self.config.git.repoPath):
-            self.gitRepo = git.open(self.config.git.repoPath)
-            status = self.gitRepo.status()
-            if status is None:
-                raise Exception("git state failed. Aborting! err: {err}".format(err=self.gitRepo.lastStderr))
-            elif status.initial_commit:
-                logger.debug( "New git repository. Initial commit on branch {br}".format(br=status.branch) )
-            else:
-                logger.debug( "Opened git repository on branch {br}".format(br=status.branch) )
- 
-            # Configure the remotes
-            if self.config.git.remoteMap is not None and len(self.config.git.remoteMap) > 0:
-                remoteList = self.gitRepo.remote_list()
-                remoteAddList = [x for x in self.config.git.remoteMap.keys()]
-                for remote in remoteList:
-                    if remote.name in self.config.git.remoteMap:
-                        r = self.config.git.remoteMap[remote.name]
-                        pushUrl1 = r.url if r.pushUrl is None else r.pushUrl
-                        pushUrl2 = remote.url if remote.pushUrl is None else remote.pushUrl
-                        if r.url != remote.url or pushUrl1 != pushUrl2:
-                            raise Exception("Configured remote {r}'s urls don't match.\nExpected:\n{r1}\nGot:\n{r2}".format(r=remote.name, r1=r, r2=remote))
-                        remoteAddList.remove(remote.name)
-                    else:
-                        logger.debug( "Unspecified remote {remote} ({url}) found. Ignoring...".format(remote=remote.name, url=remote.url) )
-                for remote in remoteAddList:
-                    r = self.config.git.remoteMap[remote]
-                    if self.gitRepo.remote_add(name=r.name, url=r.url) is None:
-                        raise Exception("Failed to add remote {remote} ({url})!".format(remote=r.name, url=r.url))
-                    logger.info( "Added remote: {remote} ({url}).".format(remote=r.name, url=r.url) )
-                    if r.pushUrl is not None and r.url != r.pushUrl:
-                        if self.gitRepo.remote_set_url(name=r.name, url=r.pushUrl, isPushUrl=True) is None:
-                            raise Exception("Failed to set push url {url} for {remote}!".format(url=r.pushUrl, remote=r.name))
-                        logger.info( "Added push url: {remote} ({url}).".format(remote=r.name, url=r.pushUrl) )
-
-            doLogout = False
-            if self.config.method != 'skip':
-                acInfo = accurev.info()
-                isLoggedIn = False
-                if self.config.accurev.username is None:
-                    # When a username isn't specified we will use any logged in user for the conversion.
-                    isLoggedIn = accurev.ext.is_loggedin(infoObj=acInfo)
+        try:
+            if self.InitGitRepo(self.config.git.repoPath):
+                self.gitRepo = git.open(self.config.git.repoPath)
+                status = self.gitRepo.status()
+                if status is None:
+                    raise Exception("git state failed. Aborting! err: {err}".format(err=self.gitRepo.lastStderr))
+                elif status.initial_commit:
+                    logger.debug( "New git repository. Initial commit on branch {br}".format(br=status.branch) )
                 else:
-                    # When a username is specified that specific user must be logged in.
-                    isLoggedIn = (acInfo.principal == self.config.accurev.username)
-
-                if not isLoggedIn:
-                    # Login the requested user
-                    if accurev.ext.is_loggedin(infoObj=acInfo):
-                        # Different username, logout the other user first.
-                        logoutSuccess = accurev.logout()
-                        logger.info("Accurev logout for '{0}' {1}".format(acInfo.principal, 'succeeded' if logoutSuccess else 'failed'))
-
-                    loginResult = accurev.login(self.config.accurev.username, self.config.accurev.password)
-                    if loginResult:
-                        logger.info("Accurev login for '{0}' succeeded.".format(self.config.accurev.username))
+                    logger.debug( "Opened git repository on branch {br}".format(br=status.branch) )
+ 
+                # Configure the remotes
+                if self.config.git.remoteMap is not None and len(self.config.git.remoteMap) > 0:
+                    remoteList = self.gitRepo.remote_list()
+                    remoteAddList = [x for x in self.config.git.remoteMap.keys()]
+                    for remote in remoteList:
+                        if remote.name in self.config.git.remoteMap:
+                            r = self.config.git.remoteMap[remote.name]
+                            pushUrl1 = r.url if r.pushUrl is None else r.pushUrl
+                            pushUrl2 = remote.url if remote.pushUrl is None else remote.pushUrl
+                            if r.url != remote.url or pushUrl1 != pushUrl2:
+                                raise Exception("Configured remote {r}'s urls don't match.\nExpected:\n{r1}\nGot:\n{r2}".format(r=remote.name, r1=r, r2=remote))
+                            remoteAddList.remove(remote.name)
+                        else:
+                            logger.debug( "Unspecified remote {remote} ({url}) found. Ignoring...".format(remote=remote.name, url=remote.url) )
+                    for remote in remoteAddList:
+                        r = self.config.git.remoteMap[remote]
+                        if self.gitRepo.remote_add(name=r.name, url=r.url) is None:
+                            raise Exception("Failed to add remote {remote} ({url})!".format(remote=r.name, url=r.url))
+                        logger.info( "Added remote: {remote} ({url}).".format(remote=r.name, url=r.url) )
+                        if r.pushUrl is not None and r.url != r.pushUrl:
+                            if self.gitRepo.remote_set_url(name=r.name, url=r.pushUrl, isPushUrl=True) is None:
+                                raise Exception("Failed to set push url {url} for {remote}!".format(url=r.pushUrl, remote=r.name))
+                            logger.info( "Added push url: {remote} ({url}).".format(remote=r.name, url=r.pushUrl) )
+
+                doLogout = False
+                if self.config.method != 'skip':
+                    acInfo = accurev.info()
+                    isLoggedIn = False
+                    if self.config.accurev.username is None:
+                        # When a username isn't specified we will use any logged in user for the conversion.
+                        isLoggedIn = accurev.ext.is_loggedin(infoObj=acInfo)
                     else:
-                        logger.error("AccuRev login for '{0}' failed.\n".format(self.config.accurev.username))
-                        logger.error("AccuRev message:\n{0}".format(loginResult.errorMessage))
-                        return 1
+                        # When a username is specified that specific user must be logged in.
+                        isLoggedIn = (acInfo.principal == self.config.accurev.username)
+
+                    if not isLoggedIn:
+                        # Login the requested user
+                        if accurev.ext.is_loggedin(infoObj=acInfo):
+                            # Different username, logout the other user first.
+                            logoutSuccess = accurev.logout()
+                            logger.info("Accurev logout for '{0}' {1}".format(acInfo.principal, 'succeeded' if logoutSuccess else 'failed'))
+
+                        loginResult = accurev.login(self.config.accurev.username, self.config.accurev.password)
+                        if loginResult:
+                            logger.info("Accurev login for '{0}' succeeded.".format(self.config.accurev.username))
+                        else:
+                            logger.error("AccuRev login for '{0}' failed.\n".format(self.config.accurev.username))
+                            logger.error("AccuRev message:\n{0}".format(loginResult.errorMessage))
+                            return 1
 
-                    doLogout = True
-                else:
-                    logger.info("Accurev user '{0}', already logged in.".format(acInfo.principal))
+                        doLogout = True
+                    else:
+                        logger.info("Accurev user '{0}', already logged in.".format(acInfo.principal))
                 
-                # If this script is being run on a replica then ensure that it is up-to-date before processing the streams.
-                accurev.replica.sync()
+                    # If this script is being run on a replica then ensure that it is up-to-date before processing the streams.
+                    accurev.replica.sync()
 
-            self.gitRepo.raw_cmd([u'git', u'config', u'--local', u'gc.auto', u'0'])
+                self.gitRepo.raw_cmd([u'git', u'config', u'--local', u'gc.auto', u'0'])
 
-            if self.config.method in [ "deep-hist", "diff", "pop" ]:
-                logger.info("Retrieveing stream information from Accurev into hidden refs.")
-                self.RetrieveStreams()
-            elif self.config.method in [ "skip" ]:
-                logger.info("Skipping retrieval of stream information from Accurev.")
-            else:
-                raise Exception("Unrecognized method '{method}'".format(method=self.config.method))
-
-            if not isRestart and isSoftRestart:
-                logger.info( "Restarting the processing operation." )
-                if self.gitRepo.raw_cmd([ u'git', u'checkout', u'--orphan', u'__ac2git_temp__' ]) is None:
-                    raise Exception("Failed to checkout empty branch.")
-                if self.gitRepo.raw_cmd([ u'git', u'read-tree', u'--empty' ]) is None:
-                    raise Exception("Failed to clear the index.")
-                if self.gitRepo.raw_cmd([ u'git', u'clean', u'-dfx' ]) is None:
-                    raise Exception("Failed to remove untracked files.")
-                refOutput = self.gitRepo.raw_cmd([ u'git', u'show-ref' ])
-                if refOutput is None:
-                    raise Exception("Failed to retrieve refs.")
-
-                # Delete all the branches and refs that we won't need any more.
-                streamMap = self.GetStreamMap()
-                branchList = [streamMap[x] for x in streamMap]
-                deleteCmd = [ u'git', u'update-ref', u'-d' ]
-                for refEntry in refOutput.strip().split('\n'):
-                    refEntry = refEntry.strip()
-                    ref = refEntry.strip().split()[1]
-                    delete = False
-                    if ref.startswith('refs/heads/'):
-                        # Find out if it is a tracked branch that we should delete.
-                        branchName = ref[len('refs/heads/'):]
-                        if branchName in branchList:
+                if self.config.method in [ "deep-hist", "diff", "pop" ]:
+                    logger.info("Retrieveing stream information from Accurev into hidden refs.")
+                    self.RetrieveStreams()
+                elif self.config.method in [ "skip" ]:
+                    logger.info("Skipping retrieval of stream information from Accurev.")
+                else:
+                    raise Exception("Unrecognized method '{method}'".format(method=self.config.method))
+
+                if not isRestart and isSoftRestart:
+                    logger.info( "Restarting the processing operation." )
+                    if self.gitRepo.raw_cmd([ u'git', u'checkout', u'--orphan', u'__ac2git_temp__' ]) is None:
+                        raise Exception("Failed to checkout empty branch.")
+                    if self.gitRepo.raw_cmd([ u'git', u'read-tree', u'--empty' ]) is None:
+                        raise Exception("Failed to clear the index.")
+                    if self.gitRepo.raw_cmd([ u'git', u'clean', u'-dfx' ]) is None:
+                        raise Exception("Failed to remove untracked files.")
+                    refOutput = self.gitRepo.raw_cmd([ u'git', u'show-ref' ])
+                    if refOutput is None:
+                        raise Exception("Failed to retrieve refs.")
+
+                    # Delete all the branches and refs that we won't need any more.
+                    streamMap = self.GetStreamMap()
+                    branchList = [streamMap[x] for x in streamMap]
+                    deleteTransaction = git.repo.ref_transaction(self.gitRepo)
+                    for refEntry in refOutput.strip().split('\n'):
+                        refEntry = refEntry.strip()
+                        ref = refEntry.strip().split()[1]
+                        delete = False
+                        if ref.startswith('refs/heads/'):
+                            # Find out if it is a tracked branch that we should delete.
+                            branchName = ref[len('refs/heads/'):]
+                            if branchName in branchList:
+                                delete = True
+                        elif ref.startswith('refs/ac2git/state/') or ref in [ 'refs/notes/ac2git', 'refs/notes/accurev' ]:
                             delete = True
-                    elif ref.startswith('refs/ac2git/state/') or ref in [ 'refs/notes/ac2git', 'refs/notes/accurev' ]:
-                        delete = True
+                        elif self.ParseDepotRef(ref=ref)[1] == 'manifest':
+                            delete = True # Rebuilt from the stream refs when it is next read, see ReadDepotManifest().
 
-                    if delete:
-                        if self.gitRepo.raw_cmd( deleteCmd + [ ref ] ) is None:
-                            raise Exception("Failed to delete ref {r}.".format(ref))
-                        logger.debug("Deleting ref {r}".format(r=ref))
-                    else:
-                        #logger.debug("Skipping ref {r}".format(r=ref))
-                        pass
-                # Checkout the master branch or an empty master branch if it doesn't exist.
-                if self.gitRepo.raw_cmd([ u'git', u'checkout', u'--orphan', u'master' ]) is None:
-                    if self.gitRepo.raw_cmd([ u'git', u'checkout', u'master' ]) is None:
-                        raise Exception("Failed to checkout master branch.")
-
-            if self.config.mergeStrategy in [ "normal" ]:
-                logger.info("Processing transactions from hidden refs. Merge strategy '{strategy}'.".format(strategy=self.config.mergeStrategy))
-                self.ProcessTransactions()
-            elif self.config.mergeStrategy in [ "orphanage" ]:
-                logger.info("Processing streams from hidden refs. Merge strategy '{strategy}'.".format(strategy=self.config.mergeStrategy))
-                self.ProcessStreams(orderByStreamNumber=False)
-            elif self.config.mergeStrategy in [ "skip", None ]:
-                logger.info("Skipping processing of Accurev data. No git branches will be generated/updated. Merge strategy '{strategy}'.".format(strategy=self.config.mergeStrategy))
-                pass # Skip the merge step.
-            else:
-                raise Exception("Unrecognized merge strategy '{strategy}'".format(strategy=self.config.mergeStrategy))
+                        if delete:
+                            deleteTransaction.delete(ref=ref)
+                            logger.debug("Deleting ref {r}".format(r=ref))
+                        else:
+                            #logger.debug("Skipping ref {r}".format(r=ref))
+                            pass
+                    if deleteTransaction.commit() != True:
+                        raise Exception("Failed to delete {count} refs. Err: {err}".format(count=len(deleteTransaction), err=self.gitRepo.lastStderr))
+                    # Checkout the master branch or an empty master branch if it doesn't exist.
+                    if self.gitRepo.raw_cmd([ u'git', u'checkout', u'--orphan', u'master' ]) is None:
+                        if self.gitRepo.raw_cmd([ u'git', u'checkout', u'master' ]) is None:
+                            raise Exception("Failed to checkout master branch.")
+
+                if self.config.mergeStrategy in [ "normal" ]:
+                    logger.info("Processing transactions from hidden refs. Merge strategy '{strategy}'.".format(strategy=self.config.mergeStrategy))
+                    self.ProcessTransactions()
+                elif self.config.mergeStrategy in [ "orphanage" ]:
+                    logger.info("Processing streams from hidden refs. Merge strategy '{strategy}'.".format(strategy=self.config.mergeStrategy))
+                    self.ProcessStreams(orderByStreamNumber=False)
+                elif self.config.mergeStrategy in [ "skip", None ]:
+                    logger.info("Skipping processing of Accurev data. No git branches will be generated/updated. Merge strategy '{strategy}'.".format(strategy=self.config.mergeStrategy))
+                    pass # Skip the merge step.
+                else:
+                    raise Exception("Unrecognized merge strategy '{strategy}'".format(strategy=self.config.mergeStrategy))
 
-            self.gitRepo.raw_cmd([u'git', u'config', u'--local', u'--unset-all', u'gc.auto'])
+                self.LogInfoCacheStats()
+                self.gitRepo.raw_cmd([u'git', u'config', u'--local', u'--unset-all', u'gc.auto'])
               
-            if doLogout:
-                if accurev.logout():
-                    logger.info( "Accurev logout successful." )
-                else:
-                    logger.error("Accurev logout failed.\n")
-                    return 1
-        else:
-            logger.error( "Could not create git repository." )
+                if doLogout:
+                    if accurev.logout():
+                        logger.info( "Accurev logout successful." )
+                    else:
+                        logger.error("Accurev logout failed.\n")
+                        return 1
+            else:
+                logger.error( "Could not create git repository." )
+        finally:
+            # Stop the git processes and close the files that were kept open for the run and restore the working directory.
+            self.Close()
+            os.chdir(self.cwd)
 
-        # Restore the working directory.
-        os.chdir(self.cwd)
-        
         return 0
             
 # ################################################################################################ #
@@ -3388,6 +4788,10 @@ def DumpExampleConfigFile(outputFilename):
             start-transaction:    The conversion will start at this transaction. If interrupted the next time it starts it will continue from where it stopped.
             end-transaction:      Stop at this transaction. This can be the keword "now" if you want it to convert the repo up to the latest transaction.
             command-cache-filename: The filename which will be given to the accurev.py script to use as a local command result cache for the accurev hist, accurev diff and accurev show streams commands.
+            command-cache-max-size: Optional. The maximum size, in megabytes, of the compressed command results stored in the command cache. When exceeded, the results that are cheapest
+                                    to retrieve again are evicted first (accurev diff and hist range results are kept the longest). Use the --cache-stats option to see how the space is used.
+            targeted-pop:         Optional. When "true" the diff and deep-hist methods only populate the elements listed in the transaction's diff (using an accurev pop list file)
+                                  instead of the whole stream, falling back to populating the whole stream if that fails. Defaults to "false".
     -->
     <accurev 
         username="joe_bloggs" 
@@ -3431,6 +4835,11 @@ def DumpExampleConfigFile(outputFilename):
                                                             ended up being the same as the child stream it is highly likely that this child stream is the source of the promote.
             new-basis-is-first-parent: [ "true", "false" ] - If set to true, for a chstream transaction, the new basis transaction will be made the corresponding commit's first parent, while
                                                              the previous transaction made in the stream will be the second parent. If set to false the order of the two parents is reversed.
+            fast-import: [ "true", "false" ] - Optional. If set to true the commits on the hidden data refs are written by a single `git fast-import` process, which is given only the
+                                               paths named in the transaction's diff, instead of staging and committing the whole worktree for each transaction. Defaults to false.
+            checkpoint-interval: Optional. The number of processed transactions after which the full conversion state is written to the hidden state ref. In between, the changes
+                                 to the branches are appended to a journal in the .git/ac2git/ directory which is replayed on top of the last state after an interruption.
+                                 Setting it to 1 writes the full state after every transaction. Defaults to 100.
     -->
     <git 
         repo-path="/put/the/git/repo/here" 
@@ -3559,6 +4968,10 @@ def AutoConfigFile(filename, args, preserveConfig=False):
             start-transaction:    The conversion will start at this transaction. If interrupted the next time it starts it will continue from where it stopped.
             end-transaction:      Stop at this transaction. This can be the keword "now" if you want it to convert the repo up to the latest transaction.
             command-cache-filename: The filename which will be given to the accurev.py script to use as a local command result cache for the accurev hist, accurev diff and accurev show streams commands.
+            command-cache-max-size: Optional. The maximum size, in megabytes, of the compressed command results stored in the command cache. When exceeded, the results that are cheapest
+                                    to retrieve again are evicted first (accurev diff and hist range results are kept the longest). Use the --cache-stats option to see how the space is used.
+            targeted-pop:         Optional. When "true" the diff and deep-hist methods only populate the elements listed in the transaction's diff (using an accurev pop list file)
+                                  instead of the whole stream, falling back to populating the whole stream if that fails. Defaults to "false".
     -->
     <accurev 
         username="{accurev_username}" 
@@ -3619,6 +5032,11 @@ def AutoConfigFile(filename, args, preserveConfig=False):
                                                             ended up being the same as the child stream it is highly likely that this child stream is the source of the promote.
             new-basis-is-first-parent: [ "true", "false" ] - If set to true, for a chstream transaction, the new basis transaction will be made the corresponding commit's first parent, while
                                                              the previous transaction made in the stream will be the second parent. If set to false the order of the two parents is reversed.
+            fast-import: [ "true", "false" ] - Optional. If set to true the commits on the hidden data refs are written by a single `git fast-import` process, which is given only the
+                                               paths named in the transaction's diff, instead of staging and committing the whole worktree for each transaction. Defaults to false.
+            checkpoint-interval: Optional. The number of processed transactions after which the full conversion state is written to the hidden state ref. In between, the changes
+                                 to the branches are appended to a journal in the .git/ac2git/ directory which is replayed on top of the last state after an interruption.
+                                 Setting it to 1 writes the full state after every transaction. Defaults to 100.
     -->
     <git 
         repo-path="{git_repo_path}" 
@@ -3853,6 +5271,10 @@ def PrintConfigSummary(config, filename):
         logger.info('    end tran.:   #{0}'.format(config.accurev.endTransaction))
         logger.info('    username: {0}'.format(config.accurev.username))
         logger.info('    command cache: {0}'.format(config.accurev.commandCacheFilename))
+        if config.accurev.commandCacheMaxSize is not None:
+            logger.info('    command cache max size: {0} MB'.format(config.accurev.commandCacheMaxSize))
+        if config.accurev.targetedPop:
+            logger.info('    targeted pop: enabled')
         logger.info('    ignored transaction types (hard-coded): {0}'.format(", ".join(ignored_transaction_types)))
         if config.accurev.excludeStreamTypes is not None:
             logger.info('    excluded stream types: {0}'.format(", ".join(config.accurev.excludeStreamTypes)))
@@ -3909,26 +5331,14 @@ def PrintStatus(state):
     accurev.replica.sync()
     # end TODO
 
-    # Get all of the streams that have been recorded in Git's hidden refs.
-    logger.info("Parsing hidden refs for downloaded AccuRev streams.")
-    refList = state.GetAllKnownStreamRefs(state.config.accurev.depot)
+    # Get all of the streams that have been recorded in Git's hidden refs from the depot manifest.
+    logger.info("Reading the depot manifest for downloaded AccuRev streams.")
+    manifest = state.ReadDepotManifest(depot=state.config.accurev.depot)
     refMap = {}
-    for ref in refList:
-        depotNumber, streamNumber, remainder = state.ParseStreamRef(ref=ref)
-        if streamNumber not in refMap:
-            refMap[streamNumber] = { "depot": depotNumber }
-        if remainder in [ "info", "data" ]:
-            lastTrId = state.GetTransactionForRef(ref=ref)
-            refMap[streamNumber][remainder] = lastTrId
-            refMap[streamNumber][remainder + "-ref"] = ref
-        elif remainder == "hwm":
-            hwmRefText = state.ReadFileRef(ref=ref)
-            if hwmRefText is not None and len(hwmRefText) > 0:
-                hwmMetadata = json.loads(hwmRefText)
-                hwm = hwmMetadata.get("high-water-mark")
-                refMap[streamNumber][remainder] = int(hwm)
-        else:
-            logger.warning("Unknown ref: {0}".format(ref))
+    for streamNumberStr, entry in manifest.items():
+        refMap[int(streamNumberStr)] = { "info": entry.get("info"), "data": entry.get("data"), "hwm": entry.get("high-water-mark") }
+        if entry.get("info-hash") is not None:
+            refMap[int(streamNumberStr)]["info-ref"] = entry["info-hash"]
 
     # Get the configured streams list
     logger.info("Parsing configured AccuRev streams.")
@@ -3956,10 +5366,10 @@ def PrintStatus(state):
         streamName = '[unknown]'
         if "info-ref" in refData:
             if streams is None:
-                streamsXml, streams = self.GetStreamsInfo(ref=refData["info-ref"])
+                streamsXml, streams = state.GetStreamsInfo(ref=refData["info-ref"])
             stream = streams.getStream(streamNumber)
             if stream is None:
-                streamsXml, streams = self.GetStreamsInfo(ref=refData["info-ref"])
+                streamsXml, streams = state.GetStreamsInfo(ref=refData["info-ref"])
                 stream = streams.getStream(streamNumber)
             if stream is not None:
                 streamName = stream.name
@@ -3968,6 +5378,27 @@ def PrintStatus(state):
     if doLogout:
         accurev.logout()
 
+def PrintCommandCacheStats(config):
+    if config.accurev.commandCacheFilename is None:
+        logger.error("No command cache configured. Set the command-cache-filename attribute of the accurev element in the config file.")
+        return 1
+    elif not os.path.exists(config.accurev.commandCacheFilename):
+        logger.error("Command cache {0} doesn't exist.".format(config.accurev.commandCacheFilename))
+        return 1
+
+    report = accurev.ext.command_cache_report(config.accurev.commandCacheFilename)
+    totalCount, totalSize, totalRawSize = 0, 0, 0
+    logger.info("Command cache {0}:".format(config.accurev.commandCacheFilename))
+    logger.info("  {kind: <16} {count: >10} {size: >14} {rawSize: >14} {ratio: >7}".format(kind="kind", count="entries", size="stored (B)", rawSize="output (B)", ratio="ratio"))
+    for kind, count, size, rawSize in report:
+        logger.info("  {kind: <16} {count: >10d} {size: >14d} {rawSize: >14d} {ratio: >6.1f}%".format(kind=kind, count=count, size=size, rawSize=rawSize, ratio=(100.0 * size / rawSize) if rawSize > 0 else 100.0))
+        totalCount += count
+        totalSize += size
+        totalRawSize += rawSize
+    logger.info("  {kind: <16} {count: >10d} {size: >14d} {rawSize: >14d} {ratio: >6.1f}%".format(kind="total", count=totalCount, size=totalSize, rawSize=totalRawSize, ratio=(100.0 * totalSize / totalRawSize) if totalRawSize > 0 else 100.0))
+    logger.info("  file size: {0} bytes".format(os.path.getsize(config.accurev.commandCacheFilename)))
+    return 0
+
 def PrintRunningTime(referenceTime):
     outMessage = ''
     # Custom formatting of the timestamp
@@ -4016,6 +5447,7 @@ def AccuRev2GitMain(argv):
     parser.add_argument('-T', '--track',    dest='track', action='store_const', const=True, help="Tracking mode. Sets the 'tracking' flag which makes the script run continuously in a loop. The configuration file is reloaded on each iteration so changes are picked up. Only makes sense for when you want this script to continuously track the accurev depot's newest transactions (i.e. you're using 'highest' or 'now' as your end transactions).")
     parser.add_argument('-I', '--tracking-intermission', nargs='?', dest='intermission', type=int, const=300, default=0, metavar='<intermission-sec>', help="Sets the intermission (in seconds) between consecutive iterations of the script in 'tracking' mode. The script sleeps for <intermission-sec> seconds before continuing the next conversion. This is useless if the --track option is not used.")
     parser.add_argument('-s', '--status', dest='status', action='store_true', default=False, help="Print the status of the conversion and exit.")
+    parser.add_argument('--cache-stats', dest='cacheStats', action='store_true', default=False, help="Print how much space each kind of accurev command (hist, diff, show streams, ...) takes up in the configured command cache and exit.")
     
     args = parser.parse_args()
     
@@ -4072,6 +5504,8 @@ def AccuRev2GitMain(argv):
                 PrintMissingUsers(state.config)
                 PrintStatus(state)
                 return 0
+            if args.cacheStats:
+                return PrintCommandCacheStats(state.config)
             if args.checkMissingUsers in [ "warn", "strict" ]:
                 if PrintMissingUsers(state.config) and args.checkMissingUsers == "strict":
                     sys.stderr.write("Found missing users. Exiting.\n")
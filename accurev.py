@@ -10,11 +10,19 @@
 # ################################################################################################ #
 
 import sys
+import ast
+import bisect
+import collections
+import json
 import subprocess
 import xml.etree.ElementTree as ElementTree
+import xml.parsers.expat
 import datetime
 import re
 import sqlite3
+import threading
+import time
+import zlib
 
 # ################################################################################################ #
 # Script Globals                                                                                   #
@@ -677,6 +685,126 @@ class obj:
                 # Invalid XML for an AccuRev hist command response.
                 return None
 
+        # Splits the XML output of a multi-transaction hist command (i.e. `accurev hist -p Depot -t 10-500 -fexv`) into
+        # a list of (transactionId, History, xmlText) tuples, one per transaction, where each History object and XML
+        # fragment look as if only that transaction was queried. The <streams> element of each fragment only keeps the
+        # streams that the transaction refers to. When that can't be worked out reliably (see History.fromStream() for
+        # why the streams list matters) the History and xmlText are None and the transaction should be queried on its own.
+        # The fragments are cut out of the xmlText as they are, including the whitespace between the elements, so that
+        # they match the output of the single transaction hist byte for byte.
+        @classmethod
+        def splitxmlstring(cls, xmlText):
+            try:
+                xmlRoot = ElementTree.fromstring(xmlText)
+                rootSpan = obj.History.xmlspans(xmlText)
+            except (ElementTree.ParseError, xml.parsers.expat.ExpatError):
+                return None
+
+            if xmlRoot is None or xmlRoot.tag != "AcResponse" or xmlRoot.get("Command") != "hist":
+                return None
+
+            xmlBytes = xmlText.encode('utf-8')
+            def xmlslice(start, end):
+                return xmlBytes[start:end].decode('utf-8')
+
+            rootChildren = rootSpan[4]
+            transactionSpans = [ span for span in rootChildren if span[0] == 'transaction' ]
+            streamsSpan = None
+            for span in rootChildren:
+                if span[0] == 'streams':
+                    streamsSpan = span
+
+            streamSpanMap = {}
+            streamsElement = xmlRoot.find('streams')
+            if streamsElement is not None and streamsSpan is not None:
+                for streamElement, streamSpan in zip(streamsElement, streamsSpan[4]):
+                    stream = obj.Stream.fromxmlelement(streamElement)
+                    if stream is not None and stream.streamNumber is not None:
+                        streamSpanMap[stream.streamNumber] = streamSpan
+
+            rv = []
+            for transactionElement, transactionSpan in zip(xmlRoot.findall('transaction'), transactionSpans):
+                tr = obj.Transaction.fromxmlelement(transactionElement)
+
+                streamNumbers = []
+                for streamNumber in [ tr.streamNumber, tr.fromStreamNumber ]:
+                    if streamNumber is not None:
+                        streamNumbers.append(streamNumber)
+                for version in tr.versions:
+                    if version.virtual is not None and isinstance(version.virtual.stream, int):
+                        streamNumbers.append(version.virtual.stream)
+                streamNumbers = sorted(set(streamNumbers))
+
+                isSelfContained = len(streamNumbers) > 0 and all([ sn in streamSpanMap for sn in streamNumbers ])
+                if isSelfContained and tr.Type == "promote" and tr.fromStreamNumber is None:
+                    # Older accurev versions don't include the fromStreamNumber and the source stream is inferred from the
+                    # streams list of a single transaction hist, which we can't reproduce here.
+                    isSelfContained = False
+
+                if isSelfContained:
+                    # Each element is copied together with the whitespace that precedes it in the page and the streams keep their page order.
+                    fragmentStreamSpans = [ streamSpanMap[sn] for sn in streamNumbers ]
+                    fragmentXml = xmlslice(0, rootChildren[0][1])
+                    fragmentXml += xmlslice(transactionSpan[1], transactionSpan[3])
+                    previousEnd = rootSpan[2]
+                    for span in rootChildren:
+                        if span is streamsSpan:
+                            break
+                        previousEnd = span[3]
+                    fragmentXml += xmlslice(previousEnd, streamsSpan[2])
+                    previousEnd = streamsSpan[2]
+                    for span in streamsSpan[4]:
+                        if any([ span is fragmentSpan for fragmentSpan in fragmentStreamSpans ]):
+                            fragmentXml += xmlslice(previousEnd, span[3])
+                        previousEnd = span[3]
+                    fragmentXml += xmlslice(previousEnd, streamsSpan[3])
+                    fragmentXml += xmlslice(rootChildren[-1][3], len(xmlBytes))
+                    rv.append( (tr.id, cls.fromxmlstring(fragmentXml), fragmentXml) )
+                else:
+                    rv.append( (tr.id, None, None) )
+
+            return rv
+
+        # Returns the position of the root element of the xmlText and of its children, down to maxDepth levels, in the utf-8 encoded
+        # xmlText as a [ tag, start, startTagEnd, end, children ] list. The end of an element includes its end tag but not the whitespace
+        # that follows it. Raises xml.parsers.expat.ExpatError if the xmlText isn't well formed.
+        @staticmethod
+        def xmlspans(xmlText, maxDepth=2):
+            parser = xml.parsers.expat.ParserCreate()
+            stack = []
+            rootSpan = []
+            pending = [] # (span, field) pairs that are set to the position of the next parser event.
+
+            def mark():
+                for span, field in pending:
+                    span[field] = parser.CurrentByteIndex
+                del pending[:]
+            def startElement(tag, attrs):
+                mark()
+                span = [ tag, parser.CurrentByteIndex, None, None, [] ]
+                if len(stack) == 0:
+                    rootSpan.extend(span)
+                    span = rootSpan
+                elif len(stack) <= maxDepth:
+                    stack[-1][4].append(span)
+                stack.append(span)
+                pending.append( (span, 2) )
+            def endElement(tag):
+                mark()
+                span = stack.pop()
+                pending.append( (span, 3) )
+            def characterData(data):
+                mark()
+
+            parser.StartElementHandler = startElement
+            parser.EndElementHandler = endElement
+            parser.CharacterDataHandler = characterData
+            parser.Parse(xmlText, True)
+            for span, field in pending:
+                span[field] = len(xmlText.encode('utf-8'))
+
+            return rootSpan
+
         # Returns a list of (streamName, streamNumber) tuples that directly correspond to the
         # destination streams of the transactions. i.e. If there are 5 transactions there would
         # be 5 tuples (even if they are all for the same stream). The 4th tuple is the destination
@@ -1473,21 +1601,74 @@ class obj:
 # The raw class namespaces raw accurev commands that return text output directly from the terminal #
 # ################################################################################################ #
 class raw(object):
-    # The __lastCommand is used to access the return code that the last command had generated in most
-    # cases.
-    _lastCommand = None
+    # The lastCommand is used to access the return code that the last command had generated in most
+    # cases. It is kept per thread since the prefetching threads in ac2git run commands concurrently
+    # with the main thread.
+    class CommandState(threading.local):
+        def __init__(self):
+            self.lastCommand = None
+    _commandState = CommandState()
     _accurevCmd = "accurev"
     _commandCacheFilename = None
-
+    _commandCache = None
+
+    # The CommandCache is a long lived sqlite3 backed store of accurev command results. It is opened once by
+    # ext.enable_command_cache() and closed by ext.disable_command_cache(). The database is run in WAL mode
+    # with a busy timeout so that several ac2git processes can share the same cache file, and inserts are
+    # grouped into transactions which are committed every `commitInterval` inserts (or on Flush()/Close()).
+    # The stdout of each command is stored zlib compressed (with the TaskId normalized so that identical
+    # results compress identically) and if a `maxSize` (in bytes) is given the cheapest commands to re-run are
+    # evicted first whenever the stored payloads exceed it.
     class CommandCache(object):
         createTableQuery = '''
 CREATE TABLE IF NOT EXISTS command_cache (
-  command TEXT PRIMARY KEY NOT NULL,
-  result  INT NOT NULL,
-  stdout  TEXT NOT NULL,
-  stderr  TEXT
+  command  TEXT PRIMARY KEY NOT NULL,
+  result   INT NOT NULL,
+  stdout   TEXT NOT NULL,
+  stderr   TEXT,
+  kind     TEXT,
+  cost     INT,
+  size     INT,
+  raw_size INT
 );
 '''
+        # Columns that were added after the first version of the table. Old cache files are upgraded on Open().
+        addedColumns = [ ('kind', 'TEXT'), ('cost', 'INT'), ('size', 'INT'), ('raw_size', 'INT') ]
+        busyTimeout = 60.0 # seconds to wait for a lock held by another process before giving up.
+        defaultCommitInterval = 64
+        compressionLevel = 6
+        taskIdRe = re.compile(r'TaskId="[0-9]+"')
+        # Relative cost of re-running each kind of command against the accurev server. Higher cost entries are evicted last.
+        commandCost = { "diff": 3, "hist range": 2, "hist": 1, "show streams": 1 }
+
+        class Stats(object):
+            def __init__(self):
+                self.hits = 0
+                self.misses = 0
+                self.inserts = 0
+                self.commits = 0
+                self.evictions = 0
+                self.lookupTime = 0.0
+                self.insertTime = 0.0
+                self.commitTime = 0.0
+
+            def __repr__(self):
+                str = "CommandCache.Stats(hits=" + repr(self.hits)
+                str += ", misses=" + repr(self.misses)
+                str += ", inserts=" + repr(self.inserts)
+                str += ", commits=" + repr(self.commits)
+                str += ", evictions=" + repr(self.evictions)
+                str += ", lookupTime=" + repr(self.lookupTime)
+                str += ", insertTime=" + repr(self.insertTime)
+                str += ", commitTime=" + repr(self.commitTime)
+                str += ")"
+                return str
+
+            def hitRate(self):
+                lookups = self.hits + self.misses
+                if lookups == 0:
+                    return None
+                return float(self.hits) / float(lookups)
 
         def __enter__(self):
             self.Close()
@@ -1499,59 +1680,213 @@ CREATE TABLE IF NOT EXISTS command_cache (
             self.Close()
             return False
 
-        def __init__(self, filepath):
+        def __init__(self, filepath, commitInterval=None, maxSize=None):
             self.filepath = filepath
+            self.maxSize = maxSize
+            self.totalSize = 0
             self.connection = None
             self.cursor = None
+            self.commitInterval = commitInterval if commitInterval is not None else raw.CommandCache.defaultCommitInterval
+            self.pendingCount = 0
+            self.stats = raw.CommandCache.Stats()
+            self.lock = threading.RLock()
 
         def Open(self):
-            self.connection = sqlite3.connect(self.filepath)
-            self.cursor = self.connection.cursor()
-            self.cursor.execute(raw.CommandCache.createTableQuery)
-            self.connection.commit()
+            with self.lock:
+                self.connection = sqlite3.connect(self.filepath, timeout=raw.CommandCache.busyTimeout, check_same_thread=False)
+                self.cursor = self.connection.cursor()
+                self.cursor.execute('PRAGMA journal_mode=WAL;')
+                self.cursor.execute('PRAGMA synchronous=NORMAL;')
+                self.cursor.execute(raw.CommandCache.createTableQuery)
+                self.cursor.execute('PRAGMA table_info(command_cache);')
+                existingColumns = set([ row[1] for row in self.cursor.fetchall() ])
+                for column, columnType in raw.CommandCache.addedColumns:
+                    if column not in existingColumns:
+                        self.cursor.execute('ALTER TABLE command_cache ADD COLUMN {0} {1};'.format(column, columnType))
+                self.connection.commit()
+                self.pendingCount = 0
+                self.totalSize = self.StoredSize()
 
         def Close(self):
-            if self.cursor is not None:
-                self.cursor.close()
-                self.cursor = None
-            if self.connection is not None:
-                self.connection.close()
-                self.connection = None
-        
+            with self.lock:
+                if self.connection is not None:
+                    self.Flush()
+                if self.cursor is not None:
+                    self.cursor.close()
+                    self.cursor = None
+                if self.connection is not None:
+                    self.connection.close()
+                    self.connection = None
+
+        def IsOpen(self):
+            return self.connection is not None
+
+        # Commits any inserts that have been batched up since the last commit.
+        def Flush(self):
+            with self.lock:
+                if self.connection is not None and self.pendingCount > 0:
+                    startTime = time.perf_counter()
+                    self.connection.commit()
+                    self.stats.commitTime += time.perf_counter() - startTime
+                    self.stats.commits += 1
+                    self.pendingCount = 0
+                if self.maxSize is not None and self.totalSize > self.maxSize:
+                    self.Evict()
+
+        # Returns the kind of the command (e.g. "hist", "hist range", "diff", "show streams") used for the eviction
+        # policy and the statistics report.
+        @staticmethod
+        def CommandKind(cmd):
+            if isinstance(cmd, list) and len(cmd) > 1:
+                kind = cmd[1]
+                if kind == "show":
+                    # The options take arguments (e.g. -p <depot>) so the subcommand, which raw.show always appends last, is the last token.
+                    if len(cmd) > 2 and not cmd[-1].startswith('-'):
+                        kind = "show {0}".format(cmd[-1])
+                elif kind == "hist" and "-t" in cmd:
+                    tsIndex = cmd.index("-t") + 1
+                    if tsIndex < len(cmd):
+                        ts = obj.TimeSpec.fromstring(cmd[tsIndex])
+                        if ts is not None and ts.end is not None and ts.start != ts.end:
+                            kind = "hist range"
+                return kind
+            return None
+
+        @staticmethod
+        def CommandCost(kind):
+            return raw.CommandCache.commandCost.get(kind, 0)
+
+        @staticmethod
+        def Compress(text):
+            text = raw.CommandCache.taskIdRe.sub('TaskId="0"', text)
+            return zlib.compress(text.encode('utf-8'), raw.CommandCache.compressionLevel)
+
+        @staticmethod
+        def Decompress(data):
+            if isinstance(data, bytes):
+                return zlib.decompress(data).decode('utf-8')
+            return data # Uncompressed entry written by an older version of this script.
+
         def Get(self, cmd):
-            self.cursor.execute('SELECT * FROM command_cache WHERE command = ?;', (str(cmd),))
-            row = self.cursor.fetchone()
-            if row is not None:
-                row2 = self.cursor.fetchone()
-                if row2 is not None:
-                    raise Exception("Invariant violation! The cache should not contain duplicate commands!")
-            return row
+            with self.lock:
+                startTime = time.perf_counter()
+                self.cursor.execute('SELECT command, result, stdout, stderr FROM command_cache WHERE command = ?;', (str(cmd),))
+                row = self.cursor.fetchone()
+                if row is not None:
+                    row2 = self.cursor.fetchone()
+                    if row2 is not None:
+                        raise Exception("Invariant violation! The cache should not contain duplicate commands!")
+                    row = (row[0], row[1], raw.CommandCache.Decompress(row[2]), row[3])
+                    self.stats.hits += 1
+                else:
+                    self.stats.misses += 1
+                self.stats.lookupTime += time.perf_counter() - startTime
+                return row
 
         def Add(self, cmd, result, stdout, stderr=None):
-            self.cursor.execute('INSERT INTO command_cache (command, result, stdout, stderr) VALUES (?, ?, ?, ?);', (str(cmd), int(result), stdout, stderr))
-            self.connection.commit()
+            with self.lock:
+                startTime = time.perf_counter()
+                kind = raw.CommandCache.CommandKind(cmd)
+                data = raw.CommandCache.Compress(stdout)
+                values = (int(result), data, stderr, kind, raw.CommandCache.CommandCost(kind), len(data), len(stdout), str(cmd))
+                self.cursor.execute('INSERT OR IGNORE INTO command_cache (result, stdout, stderr, kind, cost, size, raw_size, command) VALUES (?, ?, ?, ?, ?, ?, ?, ?);', values)
+                if self.cursor.rowcount == 0:
+                    # The command is already stored, either by Update() or by another process sharing this cache. Only then
+                    # do we need the size of the old entry.
+                    self.totalSize -= self.EntrySize(cmd)
+                    self.cursor.execute('UPDATE command_cache SET result = ?, stdout = ?, stderr = ?, kind = ?, cost = ?, size = ?, raw_size = ? WHERE command = ?;', values)
+                self.totalSize += len(data)
+                self.stats.insertTime += time.perf_counter() - startTime
+                self.stats.inserts += 1
+                self.pendingCount += 1
+                if self.pendingCount >= self.commitInterval:
+                    self.Flush()
 
         def Remove(self, cmd):
-            self.cursor.execute('DELETE FROM command_cache WHERE command = ?;', (str(cmd),))
-            self.connection.commit()
+            with self.lock:
+                self.totalSize -= self.EntrySize(cmd)
+                self.cursor.execute('DELETE FROM command_cache WHERE command = ?;', (str(cmd),))
+                self.pendingCount += 1
+                self.Flush()
 
         def Update(self, cmd, result, stdout, stderr=None):
-            self.Remove(cmd)
             self.Add(cmd=cmd, result=result, stdout=stdout, stderr=stderr)
+
+        # Returns the number of bytes taken up by the stored output of the command or 0 if it isn't stored.
+        def EntrySize(self, cmd):
+            with self.lock:
+                self.cursor.execute('SELECT COALESCE(size, LENGTH(stdout)) FROM command_cache WHERE command = ?;', (str(cmd),))
+                row = self.cursor.fetchone()
+                if row is None or row[0] is None:
+                    return 0
+                return int(row[0])
+
+        # Returns the number of bytes taken up by the stored command output.
+        def StoredSize(self):
+            with self.lock:
+                self.cursor.execute('SELECT SUM(COALESCE(size, LENGTH(stdout))) FROM command_cache;')
+                row = self.cursor.fetchone()
+                if row is None or row[0] is None:
+                    return 0
+                return int(row[0])
+
+        # Deletes entries until the stored output is below 90% of the maxSize. The cheapest commands are evicted first
+        # and within the same cost the oldest entries go first.
+        def Evict(self):
+            with self.lock:
+                if self.maxSize is None:
+                    return 0
+                self.totalSize = self.StoredSize() # Other processes could have added or evicted entries.
+                targetSize = int(self.maxSize * 0.9)
+                if self.totalSize <= targetSize:
+                    return 0
+
+                self.cursor.execute('SELECT rowid, COALESCE(size, LENGTH(stdout)) FROM command_cache ORDER BY COALESCE(cost, 0) ASC, rowid ASC;')
+                evictList = []
+                size = self.totalSize
+                for rowid, rowSize in self.cursor.fetchall():
+                    if size <= targetSize:
+                        break
+                    evictList.append((rowid,))
+                    size -= rowSize
+                self.cursor.executemany('DELETE FROM command_cache WHERE rowid = ?;', evictList)
+                self.connection.commit()
+                self.totalSize = size
+                self.stats.evictions += len(evictList)
+                return len(evictList)
+
+        # Returns a list of (kind, count, size, rawSize) tuples describing how much space each kind of command occupies.
+        def Report(self):
+            with self.lock:
+                self.Flush()
+                self.cursor.execute('SELECT command, kind, COALESCE(size, LENGTH(stdout)), COALESCE(raw_size, LENGTH(stdout)) FROM command_cache;')
+                kindMap = {}
+                for command, kind, size, rawSize in self.cursor.fetchall():
+                    if kind is None:
+                        # Entries from older versions of the cache don't have a kind so we work it out from the command.
+                        try:
+                            kind = raw.CommandCache.CommandKind(ast.literal_eval(command))
+                        except:
+                            kind = None
+                    if kind is None:
+                        kind = "unknown"
+                    count, totalSize, totalRawSize = kindMap.get(kind, (0, 0, 0))
+                    kindMap[kind] = (count + 1, totalSize + size, totalRawSize + rawSize)
+                return [ (kind, count, size, rawSize) for kind, (count, size, rawSize) in sorted(kindMap.items(), key=lambda x: x[1][1], reverse=True) ]
  
     @staticmethod
     def _runCommand(cmd, outputFilename=None, useCache=False):
         outputFile = None
+        cache = raw._commandCache if useCache else None
         
         # Try and see if we are able to use the command cache.
-        if outputFilename is None and raw._commandCacheFilename is not None and useCache:
-            with raw.CommandCache(raw._commandCacheFilename) as cc:
-                row = cc.Get(cmd=cmd)
-                if row is not None:
-                    # Cache hit!
-                    cmd, returncode, output, error = row
-                    raw._lastCommand = None
-                    return output
+        if outputFilename is None and cache is not None:
+            row = cache.Get(cmd=cmd)
+            if row is not None:
+                # Cache hit!
+                cmd, returncode, output, error = row
+                raw._commandState.lastCommand = None
+                return output
 
         if outputFilename is not None:
             outputFile = open(outputFilename, "w")
@@ -1569,11 +1904,10 @@ CREATE TABLE IF NOT EXISTS command_cache (
                 output += stdoutdata.decode('utf8', 'strict')
             accurevCommand.poll()
         
-        raw._lastCommand = accurevCommand
+        raw._commandState.lastCommand = accurevCommand
 
-        if raw._commandCacheFilename is not None and useCache:
-            with raw.CommandCache(raw._commandCacheFilename) as cc:
-               cc.Add(cmd=cmd, result=accurevCommand.returncode, stdout=output, stderr=error)
+        if cache is not None:
+            cache.Add(cmd=cmd, result=accurevCommand.returncode, stdout=output, stderr=error)
         
         if outputFile is None:
             return output
@@ -1615,7 +1949,7 @@ CREATE TABLE IF NOT EXISTS command_cache (
                     error  += stderrdata
                 accurevCommand.poll()
             
-            raw._lastCommand = accurevCommand
+            raw._commandState.lastCommand = accurevCommand
             
             return obj.Login(errorMessage=error)
         
@@ -1626,7 +1960,7 @@ CREATE TABLE IF NOT EXISTS command_cache (
         accurevCommand = subprocess.Popen([ "accurev", "logout" ], universal_newlines=True)
         accurevCommand.wait()
         
-        raw._lastCommand = accurevCommand
+        raw._commandState.lastCommand = accurevCommand
         
         return (accurevCommand.returncode == 0)
 
@@ -1729,6 +2063,14 @@ CREATE TABLE IF NOT EXISTS command_cache (
             , allElementsFlag=False, elementId=None, transactionKind=None, commentString=None, username=None
             , expandedMode=False, showIssues=False, verboseMode=False, listMode=False, showStatus=False, transactionMode=False
             , isXmlOutput=False, outputFilename=None, useCache=False):
+        return raw._runCommand(*raw._histCommand(depot=depot, stream=stream, timeSpec=timeSpec, listFile=listFile, isListFileXml=isListFileXml, elementList=elementList, allElementsFlag=allElementsFlag, elementId=elementId, transactionKind=transactionKind, commentString=commentString, username=username, expandedMode=expandedMode, showIssues=showIssues, verboseMode=verboseMode, listMode=listMode, showStatus=showStatus, transactionMode=transactionMode, isXmlOutput=isXmlOutput, outputFilename=outputFilename, useCache=useCache))
+
+    # Returns a tuple of (cmd, outputFilename, useCache) for the hist() command so that raw._runCommand() and aio._runCommand() can run it.
+    @staticmethod
+    def _histCommand( depot=None, stream=None, timeSpec=None, listFile=None, isListFileXml=False, elementList=None
+            , allElementsFlag=False, elementId=None, transactionKind=None, commentString=None, username=None
+            , expandedMode=False, showIssues=False, verboseMode=False, listMode=False, showStatus=False, transactionMode=False
+            , isXmlOutput=False, outputFilename=None, useCache=False):
         # Check the useCache flag for violations! It isn't safe to use the cache for commands that use the now or highest keywords!
         if useCache:
             if timeSpec is None:
@@ -1797,13 +2139,21 @@ CREATE TABLE IF NOT EXISTS command_cache (
         if len(formatFlags) > 0:
             cmd.append("-f{0}".format(formatFlags))
         
-        return raw._runCommand(cmd, outputFilename, useCache=useCache)
+        return cmd, outputFilename, useCache
 
     @staticmethod
     def diff( verSpec1=None, verSpec2=None, transactionRange=None, toBacking=False, toOtherBasisVersion=False, toPrevious=False
             , all=False, onlyDefaultGroup=False, onlyKept=False, onlyModified=False, onlyExtModified=False, onlyOverlapped=False, onlyPending=False
             , ignoreBlankLines=False, isContextDiff=False, informationOnly=False, ignoreCase=False, ignoreWhitespace=False, ignoreAmountOfWhitespace=False, useGUI=False
             , extraParams=None, isXmlOutput=False, useCache=False):
+        return raw._runCommand(*raw._diffCommand(verSpec1=verSpec1, verSpec2=verSpec2, transactionRange=transactionRange, toBacking=toBacking, toOtherBasisVersion=toOtherBasisVersion, toPrevious=toPrevious, all=all, onlyDefaultGroup=onlyDefaultGroup, onlyKept=onlyKept, onlyModified=onlyModified, onlyExtModified=onlyExtModified, onlyOverlapped=onlyOverlapped, onlyPending=onlyPending, ignoreBlankLines=ignoreBlankLines, isContextDiff=isContextDiff, informationOnly=informationOnly, ignoreCase=ignoreCase, ignoreWhitespace=ignoreWhitespace, ignoreAmountOfWhitespace=ignoreAmountOfWhitespace, useGUI=useGUI, extraParams=extraParams, isXmlOutput=isXmlOutput, useCache=useCache))
+
+    # Returns a tuple of (cmd, outputFilename, useCache) for the diff() command so that raw._runCommand() and aio._runCommand() can run it.
+    @staticmethod
+    def _diffCommand( verSpec1=None, verSpec2=None, transactionRange=None, toBacking=False, toOtherBasisVersion=False, toPrevious=False
+            , all=False, onlyDefaultGroup=False, onlyKept=False, onlyModified=False, onlyExtModified=False, onlyOverlapped=False, onlyPending=False
+            , ignoreBlankLines=False, isContextDiff=False, informationOnly=False, ignoreCase=False, ignoreWhitespace=False, ignoreAmountOfWhitespace=False, useGUI=False
+            , extraParams=None, isXmlOutput=False, useCache=False):
         # Validate the useCache command. It isn't safe to use the cache for keywords highest or now.
         if useCache:
             if transactionRange is None:
@@ -1869,11 +2219,16 @@ CREATE TABLE IF NOT EXISTS command_cache (
         if extraParams is not None:
             cmd.extend([ '--', extraParams ])
         
-        return raw._runCommand(cmd=cmd, useCache=useCache)
+        return cmd, None, useCache
         
     # AccuRev populate command
     @staticmethod
     def pop(isRecursive=False, isOverride=False, verSpec=None, location=None, dontBuildDirTree=False, timeSpec=None, isXmlOutput=False, listFile=None, elementList=None):
+        return raw._runCommand(*raw._popCommand(isRecursive=isRecursive, isOverride=isOverride, verSpec=verSpec, location=location, dontBuildDirTree=dontBuildDirTree, timeSpec=timeSpec, isXmlOutput=isXmlOutput, listFile=listFile, elementList=elementList))
+
+    # Returns a tuple of (cmd, outputFilename, useCache) for the pop() command so that raw._runCommand() and aio._runCommand() can run it.
+    @staticmethod
+    def _popCommand(isRecursive=False, isOverride=False, verSpec=None, location=None, dontBuildDirTree=False, timeSpec=None, isXmlOutput=False, listFile=None, elementList=None):
         cmd = [ raw._accurevCmd, "pop" ]
         
         if isOverride:
@@ -1908,7 +2263,7 @@ CREATE TABLE IF NOT EXISTS command_cache (
             else:
                 cmd.append(elementList)
         
-        return raw._runCommand(cmd)
+        return cmd, None, False
 
     # AccuRev checkout command
     @staticmethod
@@ -1939,6 +2294,11 @@ CREATE TABLE IF NOT EXISTS command_cache (
         
     @staticmethod
     def cat(elementId=None, element=None, depotName=None, verSpec=None, outputFilename=None, useCache=False):
+        return raw._runCommand(*raw._catCommand(elementId=elementId, element=element, depotName=depotName, verSpec=verSpec, outputFilename=outputFilename, useCache=useCache))
+
+    # Returns a tuple of (cmd, outputFilename, useCache) for the cat() command so that raw._runCommand() and aio._runCommand() can run it.
+    @staticmethod
+    def _catCommand(elementId=None, element=None, depotName=None, verSpec=None, outputFilename=None, useCache=False):
         cmd = [ raw._accurevCmd, "cat" ]
         
         if verSpec is not None:
@@ -1953,7 +2313,7 @@ CREATE TABLE IF NOT EXISTS command_cache (
         else:
             raise Exception('accurev cat command needs either an <element> or an <eid> to be specified')
             
-        return raw._runCommand(cmd=cmd, outputFilename=outputFilename, useCache=useCache)
+        return cmd, outputFilename, useCache
         
     @staticmethod
     def purge(comment=None, stream=None, issueNumber=None, elementList=None, listFile=None, elementId=None):
@@ -2125,6 +2485,11 @@ CREATE TABLE IF NOT EXISTS command_cache (
 
         @staticmethod
         def streams(depot=None, timeSpec=None, stream=None, matchType=None, listFile=None, listPathAndChildren=False, listChildren=False, listImmediateChildren=False, nonEmptyDefaultGroupsOnly=False, isXmlOutput=False, includeDeactivatedItems=False, includeOldDefinitions=False, includeHasDefaultGroupAttribute=False, useCache=False):
+            return raw._runCommand(*raw.show._streamsCommand(depot=depot, timeSpec=timeSpec, stream=stream, matchType=matchType, listFile=listFile, listPathAndChildren=listPathAndChildren, listChildren=listChildren, listImmediateChildren=listImmediateChildren, nonEmptyDefaultGroupsOnly=nonEmptyDefaultGroupsOnly, isXmlOutput=isXmlOutput, includeDeactivatedItems=includeDeactivatedItems, includeOldDefinitions=includeOldDefinitions, includeHasDefaultGroupAttribute=includeHasDefaultGroupAttribute, useCache=useCache))
+
+        # Returns a tuple of (cmd, outputFilename, useCache) for the streams() command so that raw._runCommand() and aio._runCommand() can run it.
+        @staticmethod
+        def _streamsCommand(depot=None, timeSpec=None, stream=None, matchType=None, listFile=None, listPathAndChildren=False, listChildren=False, listImmediateChildren=False, nonEmptyDefaultGroupsOnly=False, isXmlOutput=False, includeDeactivatedItems=False, includeOldDefinitions=False, includeHasDefaultGroupAttribute=False, useCache=False):
             # Analise the useCache variable and make sure that we can use the cache for this command!
             # For commands that use the 'now' or 'highest' keywords we can't use it (which is also implied with a timeSpec of None).
             if useCache:
@@ -2161,7 +2526,7 @@ CREATE TABLE IF NOT EXISTS command_cache (
                 
             cmd.append("streams")
             
-            return raw._runCommand(cmd=cmd, useCache=useCache)
+            return cmd, None, useCache
     
     class replica(object):
         @staticmethod
@@ -2201,7 +2566,7 @@ def stat(all=False, inBackingStream=False, dispBackingChain=False, defaultGroupO
         , underlapedElementsOnly=underlapedElementsOnly, pendingElementsOnly=pendingElementsOnly, dontOptimizeSearch=dontOptimizeSearch
         , directoryTreePath=directoryTreePath, stream=stream, externalOnly=externalOnly, showExcluded=showExcluded
         , timeSpec=timeSpec, ignorePatternsList=ignorePatternsList, listFile=listFile, elementList=elementList, outputFilename=outputFilename)
-    if raw._lastCommand.returncode == 0:
+    if raw._commandState.lastCommand.returncode == 0:
         return obj.Stat.fromxmlstring(outputXml)
     else:
         return None
@@ -2236,22 +2601,22 @@ def pop(isRecursive=False, isOverride=False, verSpec=None, location=None, dontBu
 # AccuRev checkout command
 def co(comment=None, selectAllModified=False, verSpec=None, isRecursive=False, transactionNumber=None, elementId=None, listFile=None, elementList=None):
     output = raw.oo(comment=comment, selectAllModified=selectAllModified, verSpec=verSpec, isRecursive=isRecursive, transactionNumber=transactionNumber, elementId=elementId, listFile=listFile, elementList=elementList)
-    if raw._lastCommand is not None:
-        return (raw._lastCommand.returncode == 0)
+    if raw._commandState.lastCommand is not None:
+        return (raw._commandState.lastCommand.returncode == 0)
     return None
 
 def cat(elementId=None, element=None, depotName=None, verSpec=None, outputFilename=None, useCache=False):
     if useCache:
         useCache = useCache and outputFilename is None
     output = raw.cat(elementId=elementId, element=element, depotName=depotName, verSpec=verSpec, outputFilename=outputFilename, useCache=useCache)
-    if raw._lastCommand is not None:
+    if raw._commandState.lastCommand is not None:
         return output
     return None
 
 def purge(comment=None, stream=None, issueNumber=None, elementList=None, listFile=None, elementId=None):
     output = raw.purge(comment=comment, stream=stream, issueNumber=issueNumber, elementList=elementList, listFile=listFile, elementId=elementId)
-    if raw._lastCommand is not None:
-        return (raw._lastCommand.returncode == 0)
+    if raw._commandState.lastCommand is not None:
+        return (raw._commandState.lastCommand.returncode == 0)
     return None
 
 # AccuRev ancestor command
@@ -2261,14 +2626,14 @@ def anc(element, commonAncestor=False, versionId=None, basisVersion=False, commo
     
 def chstream(stream, newBackingStream=None, timeSpec=None, newName=None):
     raw.chstream(stream=stream, newBackingStream=newBackingStream, timeSpec=timeSpec, newName=newName)
-    if raw._lastCommand is not None:
-        return (raw._lastCommand.returncode == 0)
+    if raw._commandState.lastCommand is not None:
+        return (raw._commandState.lastCommand.returncode == 0)
     return None
     
 def chws(workspace, newBackingStream=None, newLocation=None, newMachine=None, kind=None, eolType=None, isMyWorkspace=True, newName=None):
     raw.chws(workspace=workspace, newBackingStream=newBackingStream, newLocation=newLocation, newMachine=newMachine, kind=kind, eolType=eolType, isMyWorkspace=isMyWorkspace, newName=newName)
-    if raw._lastCommand is not None:
-        return (raw._lastCommand.returncode == 0)
+    if raw._commandState.lastCommand is not None:
+        return (raw._commandState.lastCommand.returncode == 0)
     return None
         
 def update(refTree=None, doPreview=False, transactionNumber=None, mergeOnUpdate=False, isOverride=False, outputFilename=None):
@@ -2324,8 +2689,8 @@ class replica(object):
     @staticmethod
     def sync():
         raw.replica.sync()
-        if raw._lastCommand is not None:
-            return (raw._lastCommand.returncode == 0)
+        if raw._commandState.lastCommand is not None:
+            return (raw._commandState.lastCommand.returncode == 0)
         return None
         
 # ################################################################################################ #
@@ -2338,14 +2703,41 @@ class ext(object):
             infoObj = info()
         return (infoObj.principal != "(not logged in)")
 
+    # Opens the command cache once for the lifetime of the run. Calling it again with the same filename is a no-op.
     @staticmethod
-    def enable_command_cache(cacheFilename):
+    def enable_command_cache(cacheFilename, commitInterval=None, maxSize=None):
+        if raw._commandCache is not None:
+            if raw._commandCacheFilename == cacheFilename:
+                raw._commandCache.maxSize = maxSize
+                return raw._commandCache
+            ext.disable_command_cache()
+        cache = raw.CommandCache(cacheFilename, commitInterval=commitInterval, maxSize=maxSize)
+        cache.Open()
         raw._commandCacheFilename = cacheFilename
+        raw._commandCache = cache
+        return cache
 
+    # Commits any pending inserts and closes the command cache.
     @staticmethod
     def disable_command_cache():
+        if raw._commandCache is not None:
+            raw._commandCache.Close()
+        raw._commandCache = None
         raw._commandCacheFilename = None
 
+    # Returns a list of (kind, count, size, rawSize) tuples for the given cache file. See raw.CommandCache.Report().
+    @staticmethod
+    def command_cache_report(cacheFilename):
+        with raw.CommandCache(cacheFilename) as cache:
+            return cache.Report()
+
+    # Returns the raw.CommandCache.Stats object for the currently open command cache or None if it isn't enabled.
+    @staticmethod
+    def command_cache_stats():
+        if raw._commandCache is not None:
+            return raw._commandCache.stats
+        return None
+
 
 
     # Get the mkstream transaction for the stream. This can sometimes be a non-trivial operation depending on how old the depot is (version of accurev).
@@ -2462,6 +2854,114 @@ class ext(object):
 
         return streamDict
 
+    # The StreamTimeline answers "which streams existed at transaction T" for a depot without running `accurev show streams -t T`
+    # for every transaction. The stream definitions only change on the definitionTransactionTypes: mkstream, chstream (which also
+    # records reparenting, renaming and the removal or reactivation of a stream) and defcomp (the incl/excl/incldo/clear rules).
+    # Their history, retrieved with one `accurev hist -k <type>` per type for the loaded range, splits the range into epochs
+    # during which the stream definitions are the same. Only one `show streams -fixg` command is run per epoch, the first time that
+    # it is needed, unless the epoch was seeded with a snapshot (see Load()), and the XML returned for any transaction is the XML
+    # that accurev returned for the start of its epoch. The hasDefaultGroup attributes in it are those at the start of the epoch.
+    class StreamTimeline(object):
+        definitionTransactionTypes = [ "mkstream", "chstream", "defcomp" ]
+        maxCachedEpochs = 32
+
+        def __init__(self, depot, useCache=False):
+            self.depot = depot
+            self.useCache = useCache
+            self.startTransaction = None
+            self.endTransaction = None
+            self.epochs = [] # Sorted list of the transactions at which the stream definitions changed. Empty until loaded.
+            self.snapshots = collections.OrderedDict() # epoch -> (obj.Show.Streams, xml), least recently used first.
+            self.hits = 0
+            self.misses = 0
+
+        # Returns True if a transaction of the given type can change the stream definitions.
+        @staticmethod
+        def IsEpochBoundary(transactionType):
+            return transactionType in ext.StreamTimeline.definitionTransactionTypes
+
+        # Loads the stream definition changes between the startTransaction and endTransaction (inclusive) and optionally seeds the epoch
+        # that contains the endTransaction with the given `show streams -p <depot> -t <endTransaction> -fixg` output. Returns the number of
+        # epochs or None if the history couldn't be retrieved, in which case the timeline is left unloaded and answers None for every
+        # transaction so that the callers fall back to querying accurev.
+        def Load(self, startTransaction, endTransaction, seedStreamsXml=None):
+            startTransaction, endTransaction = int(startTransaction), int(endTransaction)
+            self.Unload()
+
+            epochs = set([ startTransaction ])
+            for transactionType in ext.StreamTimeline.definitionTransactionTypes:
+                history = hist(depot=self.depot, timeSpec='{0}-{1}'.format(endTransaction, startTransaction), transactionKind=transactionType, useCache=self.useCache)
+                if history is None or history.transactions is None:
+                    return None
+                for tr in history.transactions:
+                    if tr.id is not None and startTransaction <= tr.id <= endTransaction and ext.StreamTimeline.IsEpochBoundary(tr.Type):
+                        epochs.add(tr.id)
+
+            self.startTransaction = startTransaction
+            self.endTransaction = endTransaction
+            self.epochs = sorted(epochs)
+
+            if seedStreamsXml is not None:
+                seedStreams = obj.Show.Streams.fromxmlstring(seedStreamsXml)
+                if seedStreams is not None:
+                    self.snapshots[self.epochs[-1]] = (seedStreams, seedStreamsXml)
+
+            return len(self.epochs)
+
+        def Unload(self):
+            self.startTransaction = None
+            self.endTransaction = None
+            self.epochs = []
+            self.snapshots.clear()
+
+        def IsLoaded(self):
+            return len(self.epochs) > 0
+
+        # Returns the transaction at which the stream tree that was current at the given transaction came into effect or None
+        # if the transaction is outside of the loaded range.
+        def Epoch(self, transaction):
+            try:
+                transaction = int(transaction)
+            except (TypeError, ValueError):
+                return None
+            if len(self.epochs) == 0 or transaction < self.startTransaction or transaction > self.endTransaction:
+                return None
+            return self.epochs[bisect.bisect_right(self.epochs, transaction) - 1]
+
+        # Returns a tuple of (obj.Show.Streams, xml) as would be returned by `accurev show streams -p <depot> -t <transaction> -fixg`
+        # or (None, None) if the transaction is outside of the loaded range or the command failed.
+        def Streams(self, transaction):
+            epoch = self.Epoch(transaction)
+            if epoch is None:
+                return None, None
+
+            snapshot = self.snapshots.get(epoch)
+            if snapshot is not None:
+                self.hits += 1
+                self.snapshots.move_to_end(epoch)
+                return snapshot
+
+            self.misses += 1
+            streamsXml = raw.show.streams(depot=self.depot, timeSpec=epoch, isXmlOutput=True, includeDeactivatedItems=True, includeHasDefaultGroupAttribute=True, useCache=self.useCache)
+            if streamsXml is None:
+                return None, None
+            streams = obj.Show.Streams.fromxmlstring(streamsXml)
+            if streams is None:
+                return None, None
+
+            self.snapshots[epoch] = (streams, streamsXml)
+            while len(self.snapshots) > ext.StreamTimeline.maxCachedEpochs:
+                self.snapshots.popitem(last=False)
+            return streams, streamsXml
+
+        # Returns the obj.Stream for the stream name or number at the given transaction or None if it didn't exist (or the
+        # transaction is outside of the loaded range).
+        def GetStream(self, stream, transaction):
+            streams, streamsXml = self.Streams(transaction)
+            if streams is None:
+                return None
+            return streams.getStream(stream)
+
     # Returns a list of parents of the given stream in the following format
     #   [ stream, parent, parent's parent, ... ]
     # where each item in the list is an object of type obj.Stream
@@ -2566,6 +3066,139 @@ class ext(object):
 
         return timeSpec
 
+    # The HistIntervalCache stores the results of `accurev hist -p <depot> -s <stream> -t <start>-<end>` keyed by the stream number and
+    # the transaction range. Overlapping and adjacent ranges are merged so that a request for a range that is partly cached only asks
+    # accurev for the missing parts. The deep_hist() function uses it, when enabled via ext.enable_hist_interval_cache(), to avoid
+    # re-running the history of the same parent streams for each of their children. It can be saved to and loaded from a JSON string.
+    # Only the id, type, time and user of each transaction are kept (not the comment or the versions), which is all that deep_hist() needs.
+    # The JSON is capped at maxTransactions transactions, the intervals that end the earliest are dropped first.
+    class HistIntervalCache(object):
+        maxTransactions = 250000
+
+        class Interval(object):
+            def __init__(self, start, end, transactions=None):
+                self.start = start
+                self.end = end
+                self.transactions = transactions if transactions is not None else [] # Sorted in ascending order.
+
+            def __repr__(self):
+                return 'HistIntervalCache.Interval(start={0}, end={1}, transactions={2})'.format(self.start, self.end, len(self.transactions))
+
+        def __init__(self, depot):
+            self.depot = depot
+            self.streams = {} # streamNumber -> list of Interval objects sorted by start.
+            self.hits = 0
+            self.misses = 0
+
+        # Returns the transaction with only the details that the cache keeps.
+        @staticmethod
+        def _strip(tr):
+            return obj.Transaction(id=tr.id, Type=tr.Type, time=tr.time, user=tr.user, comment=None)
+
+        def _merge(self, streamNumber, newInterval):
+            intervals = self.streams.get(streamNumber, [])
+            intervals.append(newInterval)
+            intervals.sort(key=lambda i: i.start)
+            merged = []
+            for interval in intervals:
+                if len(merged) > 0 and interval.start <= merged[-1].end + 1:
+                    last = merged[-1]
+                    trDict = dict([ (tr.id, tr) for tr in last.transactions ])
+                    trDict.update([ (tr.id, tr) for tr in interval.transactions ])
+                    merged[-1] = ext.HistIntervalCache.Interval(start=last.start, end=max(last.end, interval.end), transactions=[ trDict[trId] for trId in sorted(trDict) ])
+                else:
+                    merged.append(interval)
+            self.streams[streamNumber] = merged
+
+        # Returns the ascending list of (start, end) ranges of the requested range that are not in the cache.
+        def Gaps(self, streamNumber, start, end):
+            gaps = []
+            cursor = start
+            for interval in self.streams.get(streamNumber, []):
+                if interval.end < cursor:
+                    continue
+                elif interval.start > end:
+                    break
+                if interval.start > cursor:
+                    gaps.append( (cursor, interval.start - 1) )
+                cursor = interval.end + 1
+                if cursor > end:
+                    break
+            if cursor <= end:
+                gaps.append( (cursor, end) )
+            return gaps
+
+        # Returns an obj.History with the transactions, in ascending order, that `accurev hist -p <depot> -s <stream> -t <start>-<end>`
+        # would have returned (with the details described above) or None if accurev failed to return the history for one of the missing ranges.
+        def hist(self, stream, streamNumber, start, end, useCache=False):
+            gaps = self.Gaps(streamNumber=streamNumber, start=start, end=end)
+            if len(gaps) == 0:
+                self.hits += 1
+            else:
+                self.misses += 1
+            for gapStart, gapEnd in gaps:
+                histXml = raw.hist(depot=self.depot, stream=stream, timeSpec='{0}-{1}'.format(gapStart, gapEnd), expandedMode=True, isXmlOutput=True, useCache=useCache)
+                history = obj.History.fromxmlstring(histXml)
+                if history is None or history.transactions is None:
+                    return None
+                transactions = sorted([ ext.HistIntervalCache._strip(tr) for tr in history.transactions if gapStart <= tr.id <= gapEnd ], key=lambda tr: tr.id)
+                self._merge(streamNumber, ext.HistIntervalCache.Interval(start=gapStart, end=gapEnd, transactions=transactions))
+
+            for interval in self.streams[streamNumber]:
+                if interval.start <= start and end <= interval.end:
+                    return obj.History(transactions=[ tr for tr in interval.transactions if start <= tr.id <= end ])
+            raise Exception("Invariant error! The range {0}-{1} for stream {2} should be cached by now!".format(start, end, streamNumber))
+
+        # Drops the intervals that end the earliest until at most maxTransactions transactions are left. Returns the number of dropped intervals.
+        def Trim(self, maxTransactions):
+            intervals = sorted([ (interval.end, streamNumber, interval) for streamNumber in self.streams for interval in self.streams[streamNumber] ], key=lambda item: item[0])
+            count = sum([ len(interval.transactions) for end, streamNumber, interval in intervals ])
+            dropped = 0
+            for end, streamNumber, interval in intervals:
+                if count <= maxTransactions:
+                    break
+                self.streams[streamNumber].remove(interval)
+                if len(self.streams[streamNumber]) == 0:
+                    del self.streams[streamNumber]
+                count -= len(interval.transactions)
+                dropped += 1
+            return dropped
+
+        def tojson(self):
+            self.Trim(maxTransactions=ext.HistIntervalCache.maxTransactions)
+            streams = {}
+            for streamNumber in self.streams:
+                streams[str(streamNumber)] = [ [ i.start, i.end, [ [ tr.id, tr.Type, GetTimestamp(tr.time), tr.user ] for tr in i.transactions ] ] for i in self.streams[streamNumber] ]
+            return json.dumps({ "depot": self.depot, "streams": streams })
+
+        @classmethod
+        def fromjson(cls, jsonText):
+            data = json.loads(jsonText)
+            cache = cls(depot=data["depot"])
+            for streamNumberStr in data["streams"]:
+                streamNumber = int(streamNumberStr)
+                for start, end, transactions in data["streams"][streamNumberStr]:
+                    transactions = [ obj.Transaction(id=trId, Type=trType, time=trTime, user=trUser, comment=None) for trId, trType, trTime, trUser in transactions ]
+                    cache._merge(streamNumber, ext.HistIntervalCache.Interval(start=start, end=end, transactions=sorted(transactions, key=lambda tr: tr.id)))
+            return cache
+
+    _histIntervalCache = None
+
+    # Makes deep_hist() use the given ext.HistIntervalCache (or a new one for the depot) for the history of each stream. The transactions that
+    # deep_hist() returns then only have their id, type, time and user set.
+    @staticmethod
+    def enable_hist_interval_cache(depot=None, cache=None):
+        if cache is None:
+            cache = ext.HistIntervalCache(depot=depot)
+        ext._histIntervalCache = cache
+        return cache
+
+    @staticmethod
+    def disable_hist_interval_cache():
+        cache = ext._histIntervalCache
+        ext._histIntervalCache = None
+        return cache
+
     @staticmethod
     # Retrieves a list of _all transactions_ which affect the given stream, directly or indirectly (via parent promotes).
     # Returns a list of obj.Transaction(object) types.
@@ -2655,7 +3288,12 @@ class ext(object):
         trList = []
 
         # Get the history for the requested stream in the requested transaction range _ts_.
-        history = hist(depot=depot, stream=stream, timeSpec=str(ts), useCache=useCache)
+        history = None
+        intervalCache = ext._histIntervalCache
+        if intervalCache is not None and intervalCache.depot == streamInfo.depotName and isinstance(ts.start, int) and isinstance(ts.end, int):
+            history = intervalCache.hist(stream=stream, streamNumber=streamInfo.streamNumber, start=ts.start, end=ts.end, useCache=useCache)
+        if history is None:
+            history = hist(depot=depot, stream=stream, timeSpec=str(ts), useCache=useCache)
 
         # This is the core algorithm. Here we look for `chstream` transactions and _timelocks_ which affect
         # the result of a deep history inspection.
@@ -2723,6 +3361,112 @@ class ext(object):
 
         return rv
 
+    @staticmethod
+    # Computes the deep-hist for several streams at once. Instead of running the recursive deep_hist() algorithm for each stream, which
+    # asks accurev for the history of every stream in each of their parent hierarchies, the depot history for the time-spec is retrieved
+    # once (in pages of _pageSize_ transactions) and every transaction is matched against the basis chain of each of the requested streams
+    # as it was at that transaction. The chains are taken from the _timeline_ (an ext.StreamTimeline), which is built if not provided or
+    # if it doesn't cover the time-spec, and are worked out once per epoch of the timeline. If _histPage_ is given it is called as
+    # histPage(pageStart, pageEnd) instead of running `accurev hist` for each page, so that the caller can share its copy of the depot
+    # history, and must return the list of obj.Transaction objects in that range or None on failure.
+    # The same rules as for deep_hist() apply: snapshot streams don't inherit their parent's transactions, passthrough streams are
+    # transparent (neither their transactions nor their timelocks count) and, unless _ignoreTimelocks_ is set, a transaction in a parent
+    # stream only affects a child if it happened before the timelocks of all the streams in between.
+    # Returns a tuple of (dict, dict) where the first maps the stream number of each requested stream to the ascending list of
+    # obj.Transaction objects which could have affected it and the second maps each transaction number to the set of stream numbers of
+    # the requested streams that it affects. Returns (None, None) on failure.
+    def multi_deep_hist(depot, streams, timeSpec, timeline=None, ignoreTimelocks=False, pageSize=500, histPage=None, useCache=False):
+        ts = ext.normalize_timespec(depot=depot, timeSpec=timeSpec)
+        if ts is None or not isinstance(ts.start, int) or not isinstance(ts.end, int):
+            return None, None
+        if not ts.is_asc():
+            ts = ts.reversed()
+
+        if timeline is None or timeline.Epoch(ts.start) is None or timeline.Epoch(ts.end) is None:
+            timeline = ext.StreamTimeline(depot=depot, useCache=useCache)
+            if timeline.Load(startTransaction=ts.start, endTransaction=ts.end) is None:
+                return None, None
+
+        # Resolve the requested streams to stream numbers. Names are resolved at the end of the range, like deep_hist() does.
+        streamNumbers = []
+        for stream in streams:
+            if isinstance(stream, obj.Stream):
+                stream = stream.streamNumber
+            elif not isinstance(stream, int):
+                streamInfo = timeline.GetStream(stream=stream, transaction=ts.end)
+                if streamInfo is None:
+                    return None, None
+                stream = streamInfo.streamNumber
+            if stream not in streamNumbers:
+                streamNumbers.append(stream)
+
+        # For each stream and epoch, maps the streams whose transactions affect it to the earliest timelock between them (or None).
+        chains = {}
+        def getChain(epoch, streamList, streamNumber):
+            key = (epoch, streamNumber)
+            chain = chains.get(key)
+            if chain is None:
+                chain = {}
+                timelock = None
+                stream = streamList.getStream(streamNumber)
+                while stream is not None and stream.streamNumber not in chain:
+                    isPassthrough = (stream.Type == "passthrough")
+                    if not isPassthrough:
+                        chain[stream.streamNumber] = timelock
+                        if stream.Type == "snapshot":
+                            break
+                        if stream.time is not None and GetTimestamp(stream.time) != 0:
+                            timelock = stream.time if timelock is None else min(timelock, stream.time)
+                    stream = streamList.getStream(stream.basisStreamNumber)
+                chains[key] = chain
+            return chain
+
+        trLists = {}
+        for streamNumber in streamNumbers:
+            trLists[streamNumber] = []
+        affected = {}
+
+        epoch, streamList = None, None
+        pageStart = ts.start
+        while pageStart <= ts.end:
+            pageEnd = min(pageStart + pageSize - 1, ts.end)
+            if histPage is not None:
+                transactions = histPage(pageStart, pageEnd)
+            else:
+                history = hist(depot=depot, timeSpec='{0}-{1}'.format(pageEnd, pageStart), useCache=useCache)
+                transactions = history.transactions if history is not None else None
+            if transactions is None:
+                return None, None
+            for tr in sorted(transactions, key=lambda t: t.id):
+                trEpoch = timeline.Epoch(tr.id)
+                if trEpoch is None:
+                    return None, None
+                if trEpoch != epoch:
+                    epoch = trEpoch
+                    streamList, streamListXml = timeline.Streams(epoch)
+                    if streamList is None:
+                        return None, None
+                destStreamName, destStreamNumber = tr.affectedStream()
+                if destStreamNumber is None:
+                    destStream = streamList.getStream(destStreamName)
+                    if destStream is None:
+                        continue
+                    destStreamNumber = destStream.streamNumber
+
+                trAffected = set()
+                for streamNumber in streamNumbers:
+                    chain = getChain(epoch, streamList, streamNumber)
+                    if destStreamNumber in chain:
+                        timelock = chain[destStreamNumber]
+                        if ignoreTimelocks or timelock is None or tr.time is None or tr.time <= timelock:
+                            trLists[streamNumber].append(tr)
+                            trAffected.add(streamNumber)
+                if len(trAffected) > 0:
+                    affected[tr.id] = trAffected
+            pageStart = pageEnd + 1
+
+        return trLists, affected
+
     @staticmethod
     # Returns a list of streams which are affected by the given transaction.
     # The transaction must be of type obj.Transaction which is obtained from the obj.History.transactions
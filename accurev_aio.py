@@ -0,0 +1,137 @@
+#!/usr/bin/python3
+
+# ################################################################################################ #
+# AccuRev asyncio utility script                                                                   #
+#                                                                                                  #
+# Coroutine versions of the accurev.py commands. This module needs Python 3.7 or newer (async def, #
+# asyncio.get_running_loop()) and is kept apart from accurev.py, which still runs on Python 3.4,   #
+# so that only the scripts which use it need the newer Python.                                     #
+# ################################################################################################ #
+
+import asyncio
+
+from accurev import raw, obj
+
+# ################################################################################################ #
+# AccuRev asyncio commands                                                                         #
+# The aio class namespaces coroutine versions of the accurev commands. They build the same command #
+# lines as the raw class, share the command cache and limit the number of accurev commands that    #
+# run at once to aio.maxConcurrentCommands.                                                        #
+# ################################################################################################ #
+class aio(object):
+    maxConcurrentCommands = 8
+    _semaphore = None
+    _semaphoreLoop = None
+
+    # Sets the maximum number of accurev commands that the aio functions run concurrently. Takes effect for commands started afterwards.
+    @staticmethod
+    def set_max_concurrent_commands(count):
+        aio.maxConcurrentCommands = max(1, int(count))
+        aio._semaphore = None
+        aio._semaphoreLoop = None
+
+    @staticmethod
+    def _getSemaphore():
+        loop = asyncio.get_running_loop()
+        if aio._semaphore is None or aio._semaphoreLoop is not loop:
+            aio._semaphore = asyncio.Semaphore(aio.maxConcurrentCommands)
+            aio._semaphoreLoop = loop
+        return aio._semaphore
+
+    # The coroutine equivalent of raw._runCommand(). Note that the raw._commandState.lastCommand isn't set since several commands can be running at once.
+    @staticmethod
+    async def _runCommand(cmd, outputFilename=None, useCache=False):
+        cache = raw._commandCache if useCache else None
+
+        if outputFilename is None and cache is not None:
+            row = cache.Get(cmd=cmd)
+            if row is not None:
+                cmd, returncode, output, error = row
+                return output
+
+        async with aio._getSemaphore():
+            outputFile = None
+            if outputFilename is not None:
+                outputFile = open(outputFilename, "w")
+                accurevCommand = await asyncio.create_subprocess_exec(*cmd, stdout=outputFile, stdin=asyncio.subprocess.PIPE)
+            else:
+                accurevCommand = await asyncio.create_subprocess_exec(*cmd, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE, stdin=asyncio.subprocess.PIPE)
+            try:
+                stdoutdata, stderrdata = await accurevCommand.communicate()
+            finally:
+                if outputFile is not None:
+                    outputFile.close()
+
+        output = stdoutdata.decode('utf8', 'strict') if stdoutdata is not None else ''
+        error = stderrdata.decode('utf8', 'strict') if stderrdata is not None else ''
+
+        if cache is not None:
+            cache.Add(cmd=cmd, result=accurevCommand.returncode, stdout=output, stderr=error)
+
+        if outputFilename is None:
+            return output
+        else:
+            return 'Written to ' + outputFilename
+
+    # The coroutine versions of the raw class functions, they take the same arguments and return the same text output.
+    class raw(object):
+        @staticmethod
+        async def hist(*args, **kwargs):
+            return await aio._runCommand(*raw._histCommand(*args, **kwargs))
+
+        @staticmethod
+        async def diff(*args, **kwargs):
+            return await aio._runCommand(*raw._diffCommand(*args, **kwargs))
+
+        @staticmethod
+        async def pop(*args, **kwargs):
+            return await aio._runCommand(*raw._popCommand(*args, **kwargs))
+
+        @staticmethod
+        async def cat(*args, **kwargs):
+            return await aio._runCommand(*raw._catCommand(*args, **kwargs))
+
+        class show(object):
+            @staticmethod
+            async def streams(*args, **kwargs):
+                return await aio._runCommand(*raw.show._streamsCommand(*args, **kwargs))
+
+    # The coroutine versions of the module level functions which parse the XML output into the obj classes.
+    @staticmethod
+    async def hist( depot=None, stream=None, timeSpec=None, listFile=None, isListFileXml=False, elementList=None
+            , allElementsFlag=False, elementId=None, transactionKind=None, commentString=None, username=None
+            , expandedMode=True, showIssues=False, verboseMode=False, listMode=False, showStatus=False, transactionMode=False
+            , outputFilename=None, useCache=False):
+        xmlOutput = await aio.raw.hist(depot=depot, stream=stream, timeSpec=timeSpec, listFile=listFile, isListFileXml=isListFileXml, elementList=elementList
+            , allElementsFlag=allElementsFlag, elementId=elementId, transactionKind=transactionKind, commentString=commentString, username=username
+            , expandedMode=expandedMode, showIssues=showIssues, verboseMode=verboseMode, listMode=listMode, showStatus=showStatus, transactionMode=transactionMode
+            , isXmlOutput=True, outputFilename=outputFilename, useCache=useCache)
+        return obj.History.fromxmlstring(xmlOutput)
+
+    @staticmethod
+    async def diff(verSpec1=None, verSpec2=None, transactionRange=None, toBacking=False, toOtherBasisVersion=False, toPrevious=False
+            , all=False, onlyDefaultGroup=False, onlyKept=False, onlyModified=False, onlyExtModified=False, onlyOverlapped=False, onlyPending=False
+            , ignoreBlankLines=False, isContextDiff=False, informationOnly=False, ignoreCase=False, ignoreWhitespace=False, ignoreAmountOfWhitespace=False, useGUI=False
+            , extraParams=None, useCache=False):
+        xmlOutput = await aio.raw.diff(verSpec1=verSpec1, verSpec2=verSpec2, transactionRange=transactionRange, toBacking=toBacking, toOtherBasisVersion=toOtherBasisVersion, toPrevious=toPrevious
+            , all=all, onlyDefaultGroup=onlyDefaultGroup, onlyKept=onlyKept, onlyModified=onlyModified, onlyExtModified=onlyExtModified, onlyOverlapped=onlyOverlapped, onlyPending=onlyPending
+            , ignoreBlankLines=ignoreBlankLines, isContextDiff=isContextDiff, informationOnly=informationOnly, ignoreCase=ignoreCase, ignoreWhitespace=ignoreWhitespace, ignoreAmountOfWhitespace=ignoreAmountOfWhitespace, useGUI=useGUI
+            , extraParams=extraParams, isXmlOutput=True, useCache=useCache)
+        return obj.Diff.fromxmlstring(xmlOutput)
+
+    @staticmethod
+    async def pop(isRecursive=False, isOverride=False, verSpec=None, location=None, dontBuildDirTree=False, timeSpec=None, listFile=None, elementList=None):
+        output = await aio.raw.pop(isRecursive=isRecursive, isOverride=isOverride, verSpec=verSpec, location=location, dontBuildDirTree=dontBuildDirTree, timeSpec=timeSpec, isXmlOutput=True, listFile=listFile, elementList=elementList)
+        return obj.Pop.fromxmlstring(output)
+
+    @staticmethod
+    async def cat(elementId=None, element=None, depotName=None, verSpec=None, outputFilename=None, useCache=False):
+        if useCache:
+            useCache = useCache and outputFilename is None
+        return await aio.raw.cat(elementId=elementId, element=element, depotName=depotName, verSpec=verSpec, outputFilename=outputFilename, useCache=useCache)
+
+    class show(object):
+        @staticmethod
+        async def streams(depot=None, timeSpec=None, stream=None, matchType=None, listFile=None, listPathAndChildren=False, listChildren=False, listImmediateChildren=False, nonEmptyDefaultGroupsOnly=False, includeDeactivatedItems=False, includeOldDefinitions=False, includeHasDefaultGroupAttribute=False, useCache=False):
+            xmlOutput = await aio.raw.show.streams(depot=depot, timeSpec=timeSpec, stream=stream, matchType=matchType, listFile=listFile, listPathAndChildren=listPathAndChildren, listChildren=listChildren, listImmediateChildren=listImmediateChildren, nonEmptyDefaultGroupsOnly=nonEmptyDefaultGroupsOnly, isXmlOutput=True, includeDeactivatedItems=includeDeactivatedItems, includeOldDefinitions=includeOldDefinitions, includeHasDefaultGroupAttribute=includeHasDefaultGroupAttribute, useCache=useCache)
+            return obj.Show.Streams.fromxmlstring(xmlOutput)
@@ -12,6 +12,11 @@
 import sys
 import os
 import subprocess
+import tempfile
+import threading
+import hashlib
+import binascii
+import io
 import xml.etree.ElementTree as ElementTree
 import datetime
 import re
@@ -402,6 +407,25 @@ def getDatetimeString(date, timezone=None):
     
     return dateStr
 
+# Cleans up a message the way `git stripspace` does (without removing comments), which is what `git notes add -F` does to the note: trailing
+# whitespace is removed from each line, consecutive empty lines are collapsed into one, leading and trailing empty lines are removed and the
+# result ends with a newline unless it is empty.
+def stripspace(text):
+    lines = []
+    emptyLines = 0
+    for line in text.split(u'\n'):
+        line = line.rstrip(u' \t\r')
+        if len(line) == 0:
+            emptyLines += 1
+            continue
+        if emptyLines > 0 and len(lines) > 0:
+            lines.append(u'')
+        emptyLines = 0
+        lines.append(line)
+    if len(lines) == 0:
+        return u''
+    return u'{0}\n'.format(u'\n'.join(lines))
+
 def set_author_or_committer_environment(who="author", name=None, email=None, date=None, tz=None, env={}):
     if who is None or who.lower() not in [ "author", "committer" ]:
         raise Exception("set_author_or_committer_environment: the 'who' argument can be set to 'author' or 'commiter' but not '{0}'".format(who))
@@ -426,21 +450,25 @@ class repo(object):
             path = path.decode("utf-8")
         self.path = path
         self.notes = repo.notes(self)
+        self.catFile = repo.cat_file(self)
         # Debug
         self.lastStderr = None
         self.lastStdout = None
         self.lastReturnCode = None
         # Private
         self._lastCommand = None
+        self._objectFormat = None
+        self._gitDir = None
     
-    def _docmd(self, cmd, env=None):
-        process = subprocess.Popen(args=cmd, cwd=self.path, env=env, stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=False)
+    def _docmd(self, cmd, env=None, input=None):
+        process = subprocess.Popen(args=cmd, cwd=self.path, env=env, stdin=(subprocess.PIPE if input is not None else None), stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=False)
 
         output = ''
         error  = ''
         process.poll()
         while process.returncode is None:
-            stdoutdata, stderrdata = process.communicate()
+            stdoutdata, stderrdata = process.communicate(input=input)
+            input = None
             output += decode_proc_output( stdoutdata )
             error  += decode_proc_output( stderrdata )
             process.poll()
@@ -477,6 +505,134 @@ class repo(object):
             return rv.strip()
         return rv
         
+    # Writes the data (bytes or str) as a blob, without needing a file, and returns its hash.
+    def hash_object(self, data, write=True):
+        cmd = [ gitCmd, u'hash-object', u'--stdin' ]
+        if write:
+            cmd.append(u'-w')
+        if not isinstance(data, bytes):
+            data = data.encode('utf-8')
+
+        rv = self._docmd(cmd, input=data)
+        if isinstance(rv, str):
+            return rv.strip()
+        return rv
+
+    # Writes a tree from a list of (mode, type, hash, name) tuples, e.g. ('100644', 'blob', '<hash>', 'file.txt'), and returns its hash.
+    def mktree(self, entries=[], missingOk=False):
+        cmd = [ gitCmd, u'mktree', u'-z' ]
+        if missingOk:
+            cmd.append(u'--missing')
+        data = b''.join([ u'{0} {1} {2}\t{3}\0'.format(mode, objType, objHash, name).encode('utf-8') for mode, objType, objHash, name in entries ])
+
+        rv = self._docmd(cmd, input=data)
+        if isinstance(rv, str):
+            return rv.strip()
+        return rv
+
+    # Returns the list of the files under the paths that git lists with `git ls-files`. The paths are matched literally and are passed in batches
+    # of lsFilesBatchSize so that there is no limit on their number. Returns None on failure.
+    lsFilesBatchSize = 1000
+    def ls_files(self, paths=[], cached=False, others=False, excludeStandard=False):
+        cmd = [ gitCmd, u'--literal-pathspecs', u'ls-files', u'-z' ]
+        if cached:
+            cmd.append(u'--cached')
+        if others:
+            cmd.append(u'--others')
+        if excludeStandard:
+            cmd.append(u'--exclude-standard')
+        cmd.append(u'--')
+
+        files = []
+        for i in range(0, len(paths), repo.lsFilesBatchSize):
+            rv = self._docmd(cmd + list(paths[i:i + repo.lsFilesBatchSize]))
+            if rv is None:
+                return None
+            files.extend([ path for path in rv.split('\0') if len(path) > 0 ])
+        return files
+
+    # Stops the long lived git processes started for the repository, see cat_file. They are started again if the repository is used afterwards.
+    def close(self):
+        self.catFile.close()
+
+    # Returns the name of the hash algorithm used by the repository (sha1 or sha256).
+    def object_format(self):
+        if self._objectFormat is None:
+            rv = self._docmd([ gitCmd, u'rev-parse', u'--show-object-format' ])
+            self._objectFormat = rv.strip() if rv is not None and len(rv.strip()) > 0 else u'sha1'
+        return self._objectFormat
+
+    # Returns the absolute path of the repository's git directory (usually the .git directory in the worktree) or None on failure.
+    def git_dir(self):
+        if self._gitDir is None:
+            rv = self._docmd([ gitCmd, u'rev-parse', u'--git-dir' ])
+            if rv is None or len(rv.strip()) == 0:
+                return None
+            self._gitDir = os.path.abspath(os.path.join(self.path, rv.strip()))
+        return self._gitDir
+
+    # Builds a commit object in memory and returns a (hash, data) tuple for it without writing it, see write_objects().
+    #   author/committer: a tuple of (name, email, timestamp, timezone) as for fast_import.commit().
+    def make_commit(self, tree, parents=[], message=u'', author=None, committer=None):
+        if committer is None:
+            committer = author
+        lines = [ u'tree {0}\n'.format(tree) ]
+        for parent in parents:
+            lines.append(u'parent {0}\n'.format(parent))
+        lines.append(u'author {0}\n'.format(repo.fast_import._identity(*author)))
+        lines.append(u'committer {0}\n'.format(repo.fast_import._identity(*committer)))
+        lines.append(u'\n')
+        lines.append(message if message.endswith(u'\n') else u'{0}\n'.format(message))
+        data = u''.join(lines).encode('utf-8')
+        return (self.object_hash(u'commit', data), data)
+
+    # Builds a tree object in memory and returns a (hash, data) tuple for it without writing it, see write_objects().
+    #   entries: a dictionary of name -> (mode, hash), e.g. { 'file.txt': ('100644', '<hash>') }, as returned by read_tree().
+    def make_tree(self, entries):
+        data = repo.notes._formatTree(entries)
+        return (self.object_hash(u'tree', data), data)
+
+    # Builds a blob object in memory and returns a (hash, data) tuple for it without writing it, see write_objects(). Strings are stored
+    # as utf-8, like hash_object() stores them.
+    def make_blob(self, data):
+        if not isinstance(data, bytes):
+            data = data.encode('utf-8')
+        return (self.object_hash(u'blob', data), data)
+
+    # Returns the hash that git gives the object of the given type and contents (bytes).
+    def object_hash(self, objType, data):
+        return hashlib.new(self.object_format(), u'{0} {1}\0'.format(objType, len(data)).encode('utf-8') + data).hexdigest()
+
+    # Reads the tree named by rev (e.g. '<commit>^{tree}') through the cat-file process and returns a (hash, entries) tuple for it, where the
+    # entries are in the make_tree() format, or (None, None) if it doesn't exist.
+    def read_tree(self, rev):
+        objHash, objType, data = self.catFile.read(rev)
+        if data is None or objType != u'tree':
+            return (None, None)
+        return (objHash, repo.notes._parseTree(data, hashlib.new(self.object_format()).digest_size))
+
+    # Writes the objects, a list of (hash, data) tuples such as the ones returned by make_commit(), with a single `git hash-object` command.
+    # Returns True if all of them were written and git computed the same hashes.
+    def write_objects(self, objects, objType=u'commit'):
+        if len(objects) == 0:
+            return True
+
+        rv = None
+        with tempfile.TemporaryDirectory(prefix='ac2git_objects_') as tempDir:
+            paths = []
+            for objHash, data in objects:
+                path = os.path.join(tempDir, objHash)
+                with io.open(path, 'wb') as f: # This module defines its own open().
+                    f.write(data)
+                paths.append(path)
+
+            cmd = [ gitCmd, u'hash-object', u'-w', u'-t', objType, u'--stdin-paths' ]
+            rv = self._docmd(cmd, input=u''.join([ u'{0}\n'.format(path) for path in paths ]).encode('utf-8'))
+
+        if rv is None:
+            return False
+        return rv.split() == [ objHash for objHash, data in objects ]
+
     def checkout(self, branchName=None, isNewBranch=False, isOrphan=False):
         cmd = [ gitCmd, u'checkout' ]
         
@@ -863,7 +1019,362 @@ class repo(object):
             cmd = [ u'show', obj ]
             
             return self._docmd(cmd=cmd, ref=ref)
+
+        # Returns the full name of the notes ref in the same way that `git notes --ref` expands it.
+        @staticmethod
+        def full_ref(ref=None):
+            if ref is None:
+                return u'refs/notes/commits'
+            elif ref.startswith(u'refs/notes/'):
+                return ref
+            elif ref.startswith(u'notes/'):
+                return u'refs/{0}'.format(ref)
+            return u'refs/notes/{0}'.format(ref)
+
+        @staticmethod
+        def _parseTree(data, hashLength):
+            entries = {}
+            i = 0
+            while i < len(data):
+                space = data.index(b' ', i)
+                nul = data.index(b'\0', space)
+                entries[data[space + 1:nul].decode('utf-8')] = (data[i:space].decode('utf-8'), binascii.hexlify(data[nul + 1:nul + 1 + hashLength]).decode('ascii'))
+                i = nul + 1 + hashLength
+            return entries
+
+        @staticmethod
+        def _formatTree(entries):
+            # Git sorts the tree entries by name, comparing the names of subtrees as if they ended with a slash.
+            sortedNames = sorted(entries, key=lambda name: (u'{0}/'.format(name) if entries[name][0] == u'40000' else name).encode('utf-8'))
+            return b''.join([ u'{0} {1}\0'.format(entries[name][0], name).encode('utf-8') + bytes.fromhex(entries[name][1]) for name in sortedNames ])
+
+        # Adds or replaces many notes with a single notes commit, without spawning a `git notes add` for each of them. The notes are a dictionary
+        # of object hash -> note text and end up exactly as `git notes add -f -F <file>` would store them. The notes tree is read through the
+        # cat-file process and the new blobs, trees and commit are written with one `git hash-object` command per object type.
+        # Existing fan-out is followed and a level of the notes tree is fanned out into 2 character subtrees once it holds more than 256 notes,
+        # git reads notes at any fan-out.
+        # The ref is not updated. Returns a tuple of the new notes commit hash and its parent (None if the notes ref doesn't exist yet).
+        #   author/committer: a tuple of (name, email, timestamp, timezone) as for fast_import.commit().
+        def write(self, notes, ref=None, author=None, committer=None, message=u"Notes added by 'git notes add'"):
+            fullRef = repo.notes.full_ref(ref)
+            objectFormat = self.repo.object_format()
+            hashLength = hashlib.new(objectFormat).digest_size
+            objects = { u'blob': [], u'tree': [] }
+
+            def makeObject(objType, data):
+                objHash = hashlib.new(objectFormat, u'{0} {1}\0'.format(objType, len(data)).encode('utf-8') + data).hexdigest()
+                objects[objType].append( (objHash, data) )
+                return objHash
+
+            def readTree(treeHash):
+                if treeHash is None:
+                    return {}
+                objHash, objType, data = self.repo.catFile.read(treeHash)
+                if data is None or objType != u'tree':
+                    raise Exception("Failed to read the notes tree {0} of {1}.".format(treeHash, fullRef))
+                return repo.notes._parseTree(data, hashLength)
+
+            # Only the subtrees that are changed are read, in the nodes' children.
+            def subtree(node, name):
+                if name not in node["children"]:
+                    node["children"][name] = { "entries": readTree(node["entries"][name][1]), "children": {} }
+                return node["children"][name]
+
+            def insert(node, path, blobHash):
+                prefix = path[:2]
+                if len(path) > 2 and prefix in node["entries"] and node["entries"][prefix][0] == u'40000':
+                    node["entries"].pop(path, None) # A note for the same object at a lower fan-out.
+                    insert(subtree(node, prefix), path[2:], blobHash)
+                else:
+                    node["entries"][path] = (u'100644', blobHash)
+
+            def writeTree(node, pathLength):
+                notePaths = [ name for name in node["entries"] if node["entries"][name][0] != u'40000' and len(name) == pathLength and pathLength > 2 and re.match(r'^[0-9a-f]+$', name) ]
+                if len(notePaths) > 256:
+                    for name in notePaths:
+                        mode, blobHash = node["entries"].pop(name)
+                        prefix = name[:2]
+                        if prefix not in node["entries"]:
+                            node["entries"][prefix] = (u'40000', None)
+                        insert(subtree(node, prefix), name[2:], blobHash)
+                for name in node["children"]:
+                    node["entries"][name] = (u'40000', writeTree(node["children"][name], pathLength - 2))
+                return makeObject(u'tree', repo.notes._formatTree(node["entries"]))
+
+            parent = self.repo._docmd([ gitCmd, u'rev-parse', u'--verify', u'--quiet', u'{0}^{{commit}}'.format(fullRef) ])
+            parent = parent.strip() if parent is not None and len(parent.strip()) > 0 else None
+
+            root = { "entries": readTree(None if parent is None else u'{0}^{{tree}}'.format(parent)), "children": {} }
+            for objHash in notes:
+                insert(root, objHash, makeObject(u'blob', stripspace(notes[objHash]).encode('utf-8')))
+            treeHash = writeTree(root, hashLength * 2)
+
+            commitHash, commitData = self.repo.make_commit(tree=treeHash, parents=([] if parent is None else [ parent ]), message=message, author=author, committer=committer)
+            for objType in [ u'blob', u'tree' ]:
+                if not self.repo.write_objects(objects=objects[objType], objType=objType):
+                    return (None, parent)
+            if not self.repo.write_objects(objects=[ (commitHash, commitData) ], objType=u'commit'):
+                return (None, parent)
+            return (commitHash, parent)
         
+    # Queues ref updates and deletes and applies them all at once with a single `git update-ref --stdin` command. Either all of the refs are updated
+    # or none of them are. An old value can be given for a ref in which case the transaction fails if the ref doesn't point to it when it is applied.
+    class ref_transaction(object):
+        def __init__(self, repo, message=None):
+            self.repo = repo
+            self.message = message
+            self.updates = {} # ref -> (new value, old value), in the order in which they were first queued. A new value of None deletes the ref.
+
+        def __len__(self):
+            return len(self.updates)
+
+        # Queues the update of the ref to the new value. Queueing a ref a second time replaces its new value but keeps the first old value since
+        # git only allows a single update per ref in a transaction.
+        def update(self, ref, newValue, oldValue=None):
+            if ref in self.updates:
+                oldValue = self.updates[ref][1]
+            self.updates[ref] = (newValue, oldValue)
+
+        def delete(self, ref, oldValue=None):
+            self.update(ref=ref, newValue=None, oldValue=oldValue)
+
+        # Returns the queued new value for the ref or None if the ref isn't queued or is queued for deletion.
+        def get(self, ref):
+            if ref in self.updates:
+                return self.updates[ref][0]
+            return None
+
+        def abort(self):
+            self.updates = {}
+
+        def commit(self):
+            if len(self.updates) == 0:
+                return True
+
+            lines = []
+            for ref in self.updates:
+                newValue, oldValue = self.updates[ref]
+                if newValue is None:
+                    line = u'delete {ref}'.format(ref=ref)
+                else:
+                    line = u'update {ref} {new}'.format(ref=ref, new=newValue)
+                if oldValue is not None:
+                    line += u' {old}'.format(old=oldValue)
+                lines.append(line)
+
+            cmd = [ gitCmd, u'update-ref', u'--stdin' ]
+            if self.message is not None:
+                cmd.extend([ u'-m', self.message ])
+
+            if self.repo._docmd(cmd, input=u''.join([ u'{0}\n'.format(line) for line in lines ]).encode('utf-8')) is None:
+                return False
+            self.updates = {}
+            return True
+
+    # A long lived `git cat-file --batch` process used to read objects without spawning a `git show` for each of them. It is started on first use
+    # and restarted if it exits or the pipe breaks.
+    class cat_file(object):
+        def __init__(self, repo):
+            self.repo = repo
+            self.process = None
+            self.lock = threading.Lock()
+
+        def is_running(self):
+            return self.process is not None and self.process.poll() is None
+
+        def start(self):
+            if not self.is_running():
+                self.close()
+                cmd = [ gitCmd, u'cat-file', u'--batch' ]
+                self.process = subprocess.Popen(args=cmd, cwd=self.repo.path, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+            return self.is_running()
+
+        def close(self):
+            if self.process is not None:
+                try:
+                    self.process.stdin.close()
+                except Exception:
+                    pass
+                try:
+                    self.process.wait()
+                except Exception:
+                    pass
+                self.process = None
+
+        def _read(self, rev):
+            self.process.stdin.write(u'{0}\n'.format(rev).encode('utf-8'))
+            self.process.stdin.flush()
+
+            header = self.process.stdout.readline()
+            if len(header) == 0 or not header.endswith(b'\n'):
+                raise IOError("git cat-file --batch exited unexpectedly")
+            header = header[:-1].split(b' ')
+            if len(header) != 3:
+                # <rev> missing or <rev> ambiguous
+                return (None, None)
+            objHash, objType, objSize = header[0].decode('utf-8'), header[1].decode('utf-8'), int(header[2])
+
+            data = self.process.stdout.read(objSize + 1) # The contents are followed by a newline.
+            if len(data) != objSize + 1:
+                raise IOError("git cat-file --batch returned a truncated object for {0}".format(rev))
+            return (objHash, objType, data[:-1])
+
+        # Returns a (hash, type, contents) tuple for the object named by rev (e.g. '<commit>:<path>'), where the contents are bytes, or (None, None, None)
+        # if the object doesn't exist.
+        def read(self, rev):
+            if u'\n' in rev:
+                return (None, None, None)
+            with self.lock:
+                for attempt in range(2):
+                    try:
+                        self.start()
+                        rv = self._read(rev)
+                        if rv[0] is None:
+                            return (None, None, None)
+                        return rv
+                    except (IOError, OSError, ValueError):
+                        # The process died or we lost the framing, restart it and try again once.
+                        self.close()
+                        if attempt != 0:
+                            raise
+
+        # Returns the decoded contents of the <rev>:<path> file or None if it doesn't exist.
+        def show(self, rev, path=None):
+            if path is not None:
+                rev = u'{0}:{1}'.format(rev, path)
+            objHash, objType, data = self.read(rev)
+            if data is None:
+                return None
+            return decode_proc_output(data)
+
+    # A long lived `git fast-import` process. Commits are streamed into its stdin and their hashes are read back with the get-mark command
+    # (fast-import writes its answers to stdout, its default --cat-blob-fd). The refs are only updated by checkpoint() and close().
+    class fast_import(object):
+        def __init__(self, repo):
+            self.repo = repo
+            self.process = None
+            self.errorFile = None
+            self.nextMark = 1
+            self.commitCount = 0
+            self.marks = {} # Commit hash -> mark for the commits written by this process, they can't be referred to by hash until a checkpoint.
+
+        @staticmethod
+        def _quotePath(path):
+            if path.startswith(u'"') or u'\n' in path or u'\\' in path:
+                return u'"{0}"'.format(path.replace(u'\\', u'\\\\').replace(u'"', u'\\"').replace(u'\n', u'\\n'))
+            return path
+
+        @staticmethod
+        def _identity(name, email, timestamp, tz):
+            if isinstance(tz, int):
+                tz = u'{0:+05}'.format(tz)
+            return u'{name} <{email}> {timestamp} {tz}'.format(name=name if name is not None else u'', email=email if email is not None else u'', timestamp=int(timestamp), tz=tz if tz is not None else u'+0000')
+
+        def _write(self, data):
+            if not isinstance(data, bytes):
+                data = data.encode('utf-8')
+            try:
+                self.process.stdin.write(data)
+            except (BrokenPipeError, OSError):
+                raise Exception("git fast-import has exited unexpectedly: {0}".format(self.error()))
+
+        def _readline(self):
+            self.process.stdin.flush()
+            line = self.process.stdout.readline()
+            if len(line) == 0:
+                raise Exception("git fast-import has exited unexpectedly: {0}".format(self.error()))
+            return decode_proc_output(line).strip()
+
+        def error(self):
+            if self.errorFile is None:
+                return None
+            self.errorFile.seek(0)
+            return decode_proc_output(self.errorFile.read())
+
+        def is_running(self):
+            return self.process is not None and self.process.poll() is None
+
+        def start(self):
+            if self.process is None:
+                self.errorFile = tempfile.TemporaryFile()
+                cmd = [ gitCmd, u'fast-import', u'--quiet', u'--done' ]
+                self.process = subprocess.Popen(args=cmd, cwd=self.repo.path, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=self.errorFile)
+            return self.is_running()
+
+        # Writes a commit to the ref and returns its hash.
+        #   author/committer: a tuple of (name, email, timestamp, timezone) where the timestamp is in seconds since the epoch and the timezone is
+        #                     an int like -0130 or a string like "+0100".
+        #   parent:           the hash of the parent commit or None to continue from the commit that was last written to this ref by this process.
+        #   deleteAll:        start from an empty tree instead of the parent's tree.
+        #   deletedPaths:     a list of paths (files or directories) to remove from the tree, applied before the modifiedFiles.
+        #   modifiedFiles:    a list of (path, mode, data) tuples where mode is one of '100644', '100755' or '120000' and the data is bytes.
+        def commit(self, ref, message, author, committer=None, parent=None, deleteAll=False, deletedPaths=[], modifiedFiles=[]):
+            if self.process is None:
+                self.start()
+            if committer is None:
+                committer = author
+
+            mark = self.nextMark
+            self.nextMark += 1
+
+            if not isinstance(message, bytes):
+                message = message.encode('utf-8')
+
+            self._write(u'commit {ref}\nmark :{mark}\n'.format(ref=ref, mark=mark))
+            self._write(u'author {0}\n'.format(repo.fast_import._identity(*author)))
+            self._write(u'committer {0}\n'.format(repo.fast_import._identity(*committer)))
+            self._write(u'data {0}\n'.format(len(message)))
+            self._write(message)
+            self._write(u'\n')
+            if parent is not None:
+                parentMark = self.marks.get(parent)
+                self._write(u'from {0}\n'.format(parent if parentMark is None else u':{0}'.format(parentMark)))
+            if deleteAll:
+                self._write(u'deleteall\n')
+            for path in deletedPaths:
+                self._write(u'D {0}\n'.format(repo.fast_import._quotePath(path)))
+            for path, mode, data in modifiedFiles:
+                self._write(u'M {mode} inline {path}\ndata {size}\n'.format(mode=mode, path=repo.fast_import._quotePath(path), size=len(data)))
+                self._write(data)
+                self._write(u'\n')
+            self._write(u'\n')
+
+            self._write(u'get-mark :{0}\n'.format(mark))
+            commitHash = self._readline()
+            if re.match(r'^[0-9a-f]{40,64}$', commitHash) is None:
+                raise Exception("git fast-import returned '{0}' instead of a commit hash for {1}. {2}".format(commitHash, ref, self.error()))
+
+            self.marks[commitHash] = mark
+            self.commitCount += 1
+            return commitHash
+
+        # Updates the refs with the commits written so far and waits for fast-import to finish writing them.
+        def checkpoint(self):
+            if self.process is None:
+                return True
+            self._write(u'checkpoint\nprogress checkpoint\n')
+            while self._readline() != u'progress checkpoint':
+                pass
+            return True
+
+        def close(self):
+            rv = True
+            if self.process is not None:
+                try:
+                    self._write(u'done\n')
+                    self.process.stdin.close()
+                except Exception:
+                    pass
+                self.process.wait()
+                rv = (self.process.returncode == 0)
+                self.repo.lastStderr = self.error()
+                self.repo.lastReturnCode = self.process.returncode
+                self.process = None
+            if self.errorFile is not None:
+                self.errorFile.close()
+                self.errorFile = None
+            return rv
+
     def diff(self, refs=[], files=[], stat=False):
         cmd = [u'git', u'diff' ]
         if stat:
@@ -0,0 +1,558 @@
+import datetime
+import json
+import logging
+import os
+import shutil
+import subprocess
+import tempfile
+import types
+import unittest
+from unittest import mock
+
+import ac2git
+import git
+
+def MakeRepo():
+    path = tempfile.mkdtemp(prefix='ac2git_test_')
+    subprocess.check_output([ 'git', 'init', '-q', path ])
+    return path
+
+# Commits a "transaction <trId>" commit with the given files onto the ref and returns its hash.
+def CommitTransaction(path, ref, trId, files={}):
+    env = dict(os.environ, GIT_AUTHOR_NAME='t', GIT_AUTHOR_EMAIL='t@t', GIT_COMMITTER_NAME='t', GIT_COMMITTER_EMAIL='t@t')
+    entries = []
+    for filename in sorted(files):
+        blobHash = subprocess.check_output([ 'git', 'hash-object', '-w', '--stdin' ], cwd=path, input=files[filename].encode('utf-8')).decode('utf-8').strip()
+        entries.append('100644 blob {0}\t{1}\n'.format(blobHash, filename))
+    treeHash = subprocess.check_output([ 'git', 'mktree' ], cwd=path, input=''.join(entries).encode('utf-8')).decode('utf-8').strip()
+    cmd = [ 'git', 'commit-tree', treeHash, '-m', 'transaction {0}'.format(trId) ]
+    parent = subprocess.run([ 'git', 'rev-parse', '--verify', '-q', ref ], cwd=path, stdout=subprocess.PIPE).stdout.decode('utf-8').strip()
+    if len(parent) > 0:
+        cmd.extend([ '-p', parent ])
+    commitHash = subprocess.check_output(cmd, cwd=path, env=env).decode('utf-8').strip()
+    subprocess.check_output([ 'git', 'update-ref', ref, commitHash ], cwd=path)
+    return commitHash
+
+class AccuRev2GitTestCase(unittest.TestCase):
+    def setUp(self):
+        ac2git.logger = logging.getLogger('ac2git')
+        self.path = MakeRepo()
+        self.state = ac2git.AccuRev2Git(config=None)
+        self.state.config = types.SimpleNamespace(usermaps=[ types.SimpleNamespace(accurevUsername='joe', gitName='Joe', gitEmail='joe@example.com', timezone='+0100') ], accurev=types.SimpleNamespace(UseCommandCache=lambda: False))
+        self.state.gitRepo = git.open(self.path)
+        self.state.GetDepot = lambda depot: types.SimpleNamespace(number=int(depot), name='MyDepot')
+
+    def tearDown(self):
+        self.state.Close()
+        shutil.rmtree(self.path)
+
+def Branch(name, commit, isCurrent):
+    return { "name": name, "commit": commit, "is_current": isCurrent }
+
+def Transaction(trId, time=datetime.datetime(2015, 7, 1, 12, 30)):
+    return types.SimpleNamespace(id=trId, Type='promote', user='joe', time=time)
+
+class TransactionMapTest(unittest.TestCase):
+    def setUp(self):
+        self.transactionsMap = ac2git.TransactionMap()
+        self.transactionsMap.Append(trId=3, streamNumber=1, stateHash='11' * 20, dataHash='12' * 20, dataTreeHash='13' * 20)
+        self.transactionsMap.Append(trId=3, streamNumber=4, stateHash='41' * 20)
+        self.transactionsMap.Append(trId=8, streamNumber=4, stateHash='42' * 20, dataHash='43' * 20, dataTreeHash='44' * 20)
+
+    def test_transactions(self):
+        self.assertEqual(list(self.transactionsMap), [ 3, 8 ])
+        self.assertEqual(len(self.transactionsMap), 2)
+        self.assertIn(8, self.transactionsMap)
+        self.assertNotIn(5, self.transactionsMap)
+        self.assertRaises(KeyError, lambda: self.transactionsMap[5])
+
+    def test_streams(self):
+        tr = self.transactionsMap[3]
+        self.assertEqual(list(tr), [ 1, 4 ])
+        self.assertEqual(len(tr), 2)
+        self.assertIn(4, tr)
+        self.assertIn("4", tr)
+        self.assertNotIn(8, tr)
+        self.assertNotIn("x", tr)
+        self.assertEqual(tr[1], { "state_hash": '11' * 20, "data_hash": '12' * 20, "data_tree_hash": '13' * 20 })
+        self.assertEqual(tr[4], { "state_hash": '41' * 20 })
+        self.assertEqual(dict(self.transactionsMap[8]), { 4: { "state_hash": '42' * 20, "data_hash": '43' * 20, "data_tree_hash": '44' * 20 } })
+        self.assertRaises(KeyError, lambda: tr[8])
+
+    def test_append_out_of_order(self):
+        self.assertRaises(Exception, self.transactionsMap.Append, trId=5, streamNumber=1, stateHash='51' * 20)
+
+class TransactionIndexTest(AccuRev2GitTestCase):
+    def setUp(self):
+        super(TransactionIndexTest, self).setUp()
+        self.stateRef, self.dataRef, self.hwmRef = self.state.GetStreamRefs(depot=1, streamNumber=5)
+        self.stateHashes, self.dataHashes = {}, {}
+        for trId in [ 3, 7, 9 ]:
+            self.stateHashes[trId] = CommitTransaction(self.path, self.stateRef, trId, { 'hist.xml': str(trId) })
+        for trId in [ 3, 7 ]:
+            self.dataHashes[trId] = CommitTransaction(self.path, self.dataRef, trId, { 'file': str(trId) })
+
+    def test_lookup(self):
+        self.assertEqual(self.state.LookupTransactionIndex(ref=self.stateRef, trId=7), self.stateHashes[7])
+        self.assertEqual(self.state.LookupTransactionIndex(ref=self.dataRef, trId=3), self.dataHashes[3])
+        self.assertIsNone(self.state.LookupTransactionIndex(ref=self.dataRef, trId=9))
+        self.assertIsNone(self.state.LookupTransactionIndex(ref=self.stateRef, trId=4))
+        self.assertIsNone(self.state.LookupTransactionIndex(ref=self.hwmRef, trId=3))
+
+    def test_lookup_doesnt_run_git_after_the_first_sync(self):
+        self.state.LookupTransactionIndex(ref=self.stateRef, trId=3)
+        with mock.patch.object(self.state.gitRepo, '_docmd', side_effect=AssertionError("git was run")):
+            self.assertEqual(self.state.LookupTransactionIndex(ref=self.stateRef, trId=9), self.stateHashes[9])
+            self.assertEqual(self.state.LookupTransactionIndex(ref=self.dataRef, trId=7), self.dataHashes[7])
+
+    def test_sync_after_ref_update(self):
+        self.state.LookupTransactionIndex(ref=self.stateRef, trId=3)
+        self.dataHashes[9] = CommitTransaction(self.path, self.dataRef, 9, { 'file': '9' })
+        self.assertIsNone(self.state.LookupTransactionIndex(ref=self.dataRef, trId=9))
+        self.state.SyncTransactionIndex(stateRef=self.stateRef, dataRef=self.dataRef)
+        self.assertEqual(self.state.LookupTransactionIndex(ref=self.dataRef, trId=9), self.dataHashes[9])
+        self.assertEqual(self.state.GetHashForTransaction(ref=self.dataRef, trNum=9), self.dataHashes[9])
+
+    def test_load(self):
+        transactionsMap = self.state.LoadTransactionIndex(depotNumber=1, streamNumbers=[ 5 ], afterTransaction=5)
+        self.assertEqual(list(transactionsMap), [ 3, 7, 9 ])
+        self.assertEqual(transactionsMap[7][5]["state_hash"], self.stateHashes[7])
+        self.assertEqual(transactionsMap[7][5]["data_hash"], self.dataHashes[7])
+        self.assertNotIn("data_hash", transactionsMap[9][5])
+
+class InfoCacheTest(AccuRev2GitTestCase):
+    def test_cache_hit_doesnt_parse_or_copy(self):
+        stateRef, dataRef, hwmRef = self.state.GetStreamRefs(depot=1, streamNumber=5)
+        CommitTransaction(self.path, stateRef, 3, { 'streams.xml': '<streams/>' })
+        parse = mock.Mock(return_value=object())
+        xml, obj = self.state.GetInfoFile(ref=stateRef, filename='streams.xml', parse=parse)
+        with mock.patch('copy.deepcopy', side_effect=AssertionError("the cached object was copied")), mock.patch('copy.copy', side_effect=AssertionError("the cached object was copied")):
+            self.assertEqual(self.state.GetInfoFile(ref=stateRef, filename='streams.xml', parse=parse), (xml, obj))
+            self.assertIs(self.state.GetInfoFile(ref=stateRef + '^{commit}', filename='streams.xml', parse=parse)[1], obj)
+        self.assertEqual(parse.call_count, 1)
+        self.assertEqual(self.state.infoCacheHits, 2)
+
+class BranchHeadsTest(AccuRev2GitTestCase):
+    def setUp(self):
+        super(BranchHeadsTest, self).setUp()
+        self.firstHash = CommitTransaction(self.path, 'refs/heads/master', 1, { 'file': '1' })
+        subprocess.check_output([ 'git', 'checkout', '-q', 'master' ], cwd=self.path)
+        self.state.LoadBranchHeads(branchNames=[ 'master', 'other' ])
+
+    def assertTableMatchesGit(self):
+        branchHeads, currentBranch = self.state.branchHeads, self.state.currentBranch
+        self.state.LoadBranchHeads(branchNames=list(branchHeads))
+        self.assertEqual(branchHeads, self.state.branchHeads)
+        self.assertEqual(currentBranch, self.state.currentBranch)
+
+    def test_update_and_checkout_dont_reload(self):
+        secondHash = CommitTransaction(self.path, 'refs/heads/scratch', 2, { 'file': '2' })
+        with mock.patch.object(self.state.gitRepo, 'raw_cmd', wraps=self.state.gitRepo.raw_cmd) as rawCmd:
+            self.assertTrue(self.state.UpdateAndCheckoutRef(ref='refs/heads/other', commitHash=secondHash, checkout=False))
+            self.state.SafeCheckout(ref='other')
+            self.assertTrue(self.state.UpdateAndCheckoutRef(ref='HEAD', commitHash=self.firstHash))
+            self.assertTrue(self.state.UpdateAndCheckoutRef(ref='refs/heads/master', commitHash=secondHash, checkout=False))
+            for call in rawCmd.call_args_list:
+                self.assertNotIn(call[0][0][1], [ 'for-each-ref', 'symbolic-ref' ])
+        self.assertEqual(self.state.currentBranch, 'other')
+        self.assertEqual(self.state.GetLastCommitHash(branchName='other'), self.firstHash)
+        self.assertEqual(self.state.GetLastCommitHash(branchName='master'), secondHash)
+        self.assertTableMatchesGit()
+
+    def test_detached_checkout(self):
+        self.assertTrue(self.state.UpdateAndCheckoutRef(ref='refs/heads/other', commitHash=self.firstHash))
+        self.assertIsNone(self.state.currentBranch)
+        self.assertTableMatchesGit()
+
+    def test_failed_ref_transaction_restores_the_table(self):
+        secondHash = CommitTransaction(self.path, 'refs/heads/scratch', 2, { 'file': '2' })
+        self.state.BeginRefTransaction()
+        self.assertTrue(self.state.UpdateAndCheckoutRef(ref='refs/heads/master', commitHash=secondHash, checkout=False, oldCommitHash=secondHash))
+        self.assertTrue(self.state.UpdateAndCheckoutRef(ref='refs/heads/other', commitHash=secondHash, checkout=False))
+        self.assertEqual(self.state.GetLastCommitHash(branchName='master'), secondHash)
+        self.assertFalse(self.state.CommitRefTransaction()) # master isn't at the expected old value.
+        self.assertEqual(self.state.GetLastCommitHash(branchName='master'), self.firstHash)
+        self.assertIsNone(self.state.GetLastCommitHash(branchName='other'))
+        self.assertTableMatchesGit()
+
+class CommitInfoFilesTest(AccuRev2GitTestCase):
+    def setUp(self):
+        super(CommitInfoFilesTest, self).setUp()
+        self.stateRef, self.dataRef, self.hwmRef = self.state.GetStreamRefs(depot=1, streamNumber=5)
+        self.infoFiles = { 'streams.xml': '<streams/>', 'hist.xml': '<hist id="3"/>' }
+        self.state.GetInfoFiles = lambda **kwargs: dict(self.infoFiles)
+
+    def test_commit(self):
+        firstHash = self.state.CommitInfoFiles(depot=1, streamName='s', transaction=Transaction(3), ref=self.stateRef, parents=[])
+        self.assertEqual(self.state.gitRepo.raw_cmd([ 'git', 'rev-parse', self.stateRef ]).strip(), firstHash)
+
+        self.infoFiles['hist.xml'] = '<hist id="4"/>'
+        with mock.patch.object(self.state.gitRepo, 'write_objects', wraps=self.state.gitRepo.write_objects) as writeObjects:
+            secondHash = self.state.CommitInfoFiles(depot=1, streamName='s', transaction=Transaction(4), ref=self.stateRef, parents=[ firstHash ])
+        self.assertEqual([ len(call[1]['objects']) for call in writeObjects.call_args_list ], [ 1, 1, 1 ]) # streams.xml is already in the parent.
+
+        git = lambda *args: subprocess.check_output([ 'git' ] + list(args), cwd=self.path).decode('utf-8')
+        self.assertEqual(git('rev-parse', self.stateRef).strip(), secondHash)
+        self.assertEqual(git('rev-parse', '{0}^'.format(secondHash)).strip(), firstHash)
+        self.assertEqual(git('show', '{0}:hist.xml'.format(secondHash)), '<hist id="4"/>')
+        self.assertEqual(git('show', '{0}:streams.xml'.format(secondHash)), '<streams/>')
+        self.assertEqual(git('log', '-1', '--format=%an <%ae> %ad|%cn|%B', '--date=iso', secondHash).strip(), 'Joe <joe@example.com> 2015-07-01 13:30:00 +0100|Joe|transaction 4')
+        subprocess.check_output([ 'git', 'fsck', '--strict' ], cwd=self.path)
+
+    def test_nothing_to_commit(self):
+        firstHash = self.state.CommitInfoFiles(depot=1, streamName='s', transaction=Transaction(3), ref=self.stateRef, parents=[])
+        with mock.patch.object(self.state.gitRepo, '_docmd', side_effect=AssertionError("git was run")):
+            self.assertEqual(self.state.CommitInfoFiles(depot=1, streamName='s', transaction=Transaction(4), ref=self.stateRef, parents=[ firstHash ]), firstHash)
+
+class FastImportDataCommitTest(AccuRev2GitTestCase):
+    def setUp(self):
+        super(FastImportDataCommitTest, self).setUp()
+        self.stateRef, self.dataRef, self.hwmRef = self.state.GetStreamRefs(depot=1, streamNumber=5)
+
+    def WriteFile(self, relPath, text):
+        path = os.path.join(self.path, relPath)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'w') as f:
+            f.write(text)
+        return path
+
+    # Returns the tree that Commit() would stage with `git add`, using a separate index so that the repository's index isn't touched.
+    def GitAddTree(self):
+        self.state.PreserveEmptyDirs()
+        env = dict(os.environ, GIT_INDEX_FILE=os.path.join(self.path, '.git', 'test_index'))
+        if os.path.exists(env['GIT_INDEX_FILE']):
+            os.remove(env['GIT_INDEX_FILE'])
+        subprocess.check_output([ 'git', '-c', 'core.autocrlf=false', 'add', '-f', '--all' ], cwd=self.path, env=env)
+        return subprocess.check_output([ 'git', 'write-tree' ], cwd=self.path, env=env).decode('utf-8').strip()
+
+    def DataTree(self):
+        self.state.fastImport.checkpoint()
+        return subprocess.check_output([ 'git', 'rev-parse', '{0}^{{tree}}'.format(self.dataRef) ], cwd=self.path).decode('utf-8').strip()
+
+    def test_same_tree_as_git_add(self):
+        self.WriteFile('a.txt', 'a')
+        self.WriteFile('dir/b.txt', 'b')
+        self.WriteFile('dir/sub/c.txt', 'c')
+        self.WriteFile('.gitignore', '*.log\n')
+        self.WriteFile('build.log', 'ignored but an element')
+        os.chmod(self.WriteFile('run.sh', '#!/bin/sh\n'), 0o755)
+        os.symlink('a.txt', os.path.join(self.path, 'link'))
+        os.makedirs(os.path.join(self.path, 'empty', 'nested'))
+        firstHash = self.state.FastImportDataCommit(transaction=Transaction(3), ref=self.dataRef, parent=None, fullTree=True)
+        self.assertIsNotNone(firstHash)
+        self.assertEqual(self.DataTree(), self.GitAddTree())
+
+        # Transaction 4 changes a.txt, adds new/d.txt and an empty directory and deletes dir/sub/c.txt, which leaves dir/sub empty.
+        self.WriteFile('a.txt', 'a2')
+        self.WriteFile('new/d.txt', 'd')
+        os.makedirs(os.path.join(self.path, 'new', 'empty'))
+        deletedPath = os.path.join(self.path, 'dir', 'sub', 'c.txt')
+        os.remove(deletedPath)
+        names = [ '/./a.txt', '/./new', '/./new/d.txt', '/./new/empty' ]
+        diff = types.SimpleNamespace(elements=[ types.SimpleNamespace(changes=[ types.SimpleNamespace(stream1=types.SimpleNamespace(name=name), stream2=None) ]) for name in names ])
+        secondHash = self.state.FastImportDataCommit(transaction=Transaction(4), ref=self.dataRef, parent=firstHash, diff=diff, deletedPathList=[ deletedPath ])
+        self.assertIsNotNone(secondHash)
+        self.assertEqual(self.DataTree(), self.GitAddTree())
+        self.assertEqual(subprocess.check_output([ 'git', 'rev-parse', '{0}^'.format(secondHash) ], cwd=self.path).decode('utf-8').strip(), firstHash)
+
+class CloseTest(AccuRev2GitTestCase):
+    def test_close_stops_the_git_processes(self):
+        stateRef, dataRef, hwmRef = self.state.GetStreamRefs(depot=1, streamNumber=5)
+        CommitTransaction(self.path, stateRef, 3, { 'hist.xml': '3' })
+        self.assertEqual(self.state.gitRepo.catFile.show(stateRef, 'hist.xml'), '3')
+        self.state.LookupTransactionIndex(ref=stateRef, trId=3)
+        process = self.state.gitRepo.catFile.process
+        self.state.Close()
+        self.assertIsNotNone(process.poll())
+        self.assertFalse(self.state.gitRepo.catFile.is_running())
+        self.assertIsNone(self.state.transactionIndex)
+        self.assertEqual(self.state.gitRepo.catFile.show(stateRef, 'hist.xml'), '3') # Started again on demand.
+
+class FindNextDiffTransactionTest(AccuRev2GitTestCase):
+    def setUp(self):
+        super(FindNextDiffTransactionTest, self).setUp()
+        self.state.config.method = "diff"
+        self.maxWindow = ac2git.AccuRev2Git.diffProbeMaxWindow
+
+    def tearDown(self):
+        ac2git.AccuRev2Git.diffProbeMaxWindow = self.maxWindow
+        if self.state.diffProbePool is not None:
+            self.state.diffProbePool.shutdown(wait=True)
+        super(FindNextDiffTransactionTest, self).tearDown()
+
+    # Runs FindNextChangeTransaction() for every start transaction up to the end against a stream that changes in the given transactions
+    # and where the diffs up to the failing transactions fail. Returns the results and the diffs that were run.
+    def FindAll(self, maxWindow, changes, failures=[], endTr=40):
+        ac2git.AccuRev2Git.diffProbeMaxWindow = maxWindow
+        diffs = []
+        def fakeTryDiff(streamName, firstTrNumber, secondTrNumber, *args, **kwargs):
+            diffs.append( (firstTrNumber, secondTrNumber) )
+            if secondTrNumber in failures:
+                return (None, None)
+            changed = [ trId for trId in changes if firstTrNumber < trId <= secondTrNumber ]
+            return (types.SimpleNamespace(elements=changed), '<diff/>')
+        results = []
+        with mock.patch.object(self.state, 'TryDiff', side_effect=fakeTryDiff):
+            for startTr in range(1, endTr + 1):
+                nextTr, diff = self.state.FindNextChangeTransaction(streamName='MyStream', startTrNumber=startTr, endTrNumber=endTr)
+                results.append( (startTr, nextTr, None if diff is None else diff.elements) )
+        return results, diffs
+
+    def test_same_result_as_the_serial_loop(self):
+        for changes, failures in [ ([], []), ([ 2, 3, 20, 21, 39 ], []), (list(range(1, 41)), []), ([ 5, 30 ], [ 17 ]), ([ 40 ], [ 41 ]) ]:
+            serial, serialDiffs = self.FindAll(maxWindow=1, changes=changes, failures=failures)
+            windowed, windowedDiffs = self.FindAll(maxWindow=4, changes=changes, failures=failures)
+            self.assertEqual(windowed, serial, "changes {0}, failures {1}".format(changes, failures))
+            self.assertTrue(set(serialDiffs).issubset(set(windowedDiffs)))
+
+    def test_window_grows_over_empty_diffs(self):
+        self.FindAll(maxWindow=8, changes=[], endTr=40)
+        self.assertEqual(self.state.diffProbeWindow, 8)
+        results, diffs = self.FindAll(maxWindow=8, changes=[ 3 ], endTr=3)
+        self.assertEqual(results[0], (1, 3, [ 3 ]))
+
+class PopResult(object):
+    def __init__(self, success):
+        self.success = success
+        self.messages = []
+
+    def __bool__(self):
+        return self.success
+
+class TargetedPopTest(AccuRev2GitTestCase):
+    def setUp(self):
+        super(TargetedPopTest, self).setUp()
+        self.state.config.accurev.targetedPop = True
+        change = lambda name1, name2, isDir=False: types.SimpleNamespace(stream1=(None if name1 is None else types.SimpleNamespace(name=name1, isDir=isDir)), stream2=(None if name2 is None else types.SimpleNamespace(name=name2, isDir=isDir)))
+        self.diff = types.SimpleNamespace(elements=[
+            types.SimpleNamespace(changes=[ change('/./dir', '/./dir', isDir=True) ]), # Modified directory.
+            types.SimpleNamespace(changes=[ change('/./a/b/new.txt', None) ]), # Added file, its parents may not exist.
+            types.SimpleNamespace(changes=[ change(None, '/./gone.txt') ]), # Deleted file.
+            types.SimpleNamespace(changes=[ change('/./a/file.txt', '/./a/file.txt') ]),
+        ])
+
+    # Runs PopTransaction() with accurev.pop() returning the given results in turn and returns the (keyword arguments, list file lines) of each pop.
+    def Pop(self, results, overwrite=False):
+        pops = []
+        def fakePop(**kwargs):
+            listLines = None
+            if kwargs.get('listFile') is not None:
+                with open(kwargs['listFile']) as f:
+                    listLines = f.read().splitlines()
+            pops.append( (kwargs, listLines) )
+            return PopResult(results[len(pops) - 1])
+        with mock.patch.object(ac2git.accurev, 'pop', side_effect=fakePop):
+            self.popResult = self.state.PopTransaction(streamName='MyStream', transaction=types.SimpleNamespace(id=7), diff=self.diff, overwrite=overwrite)
+        return pops
+
+    def test_targeted_pop(self):
+        pops = self.Pop(results=[ True, True ])
+        self.assertTrue(self.popResult)
+        self.assertEqual([ (kwargs['isRecursive'], kwargs['isOverride'], kwargs['timeSpec'], lines) for kwargs, lines in pops ], [
+            (True, True, 7, [ '/./dir' ]),
+            (False, True, 7, [ '/./a/b/new.txt', '/./a/b', '/./a', '/./a/file.txt' ]),
+        ])
+
+    def test_fallback_to_the_whole_stream(self):
+        pops = self.Pop(results=[ True, False, True ])
+        self.assertTrue(self.popResult)
+        self.assertEqual(len(pops), 3)
+        kwargs, lines = pops[-1]
+        self.assertEqual((kwargs['elementList'], kwargs['isRecursive'], kwargs['isOverride'], lines), ('.', True, False, None))
+
+    def test_pop_method_populates_the_whole_stream(self):
+        pops = self.Pop(results=[ True ], overwrite=True)
+        self.assertEqual([ (kwargs['elementList'], kwargs['isOverride']) for kwargs, lines in pops ], [ ('.', True) ])
+
+class RefTransactionTest(AccuRev2GitTestCase):
+    def test_abort(self):
+        firstHash = CommitTransaction(self.path, 'refs/heads/master', 1, { 'file': '1' })
+        secondHash = CommitTransaction(self.path, 'refs/heads/scratch', 2, { 'file': '2' })
+        self.state.BeginRefTransaction()
+        self.assertTrue(self.state.UpdateAndCheckoutRef(ref='refs/heads/master', commitHash=secondHash, checkout=False))
+        self.state.WriteFileRef(ref='refs/ac2git/test', text='queued')
+        self.assertEqual(self.state.GetPendingRef(name='master'), secondHash)
+        self.assertEqual(self.state.GetLastCommitHash(ref='refs/heads/master'), secondHash)
+        self.assertEqual(self.state.ReadFileRef(ref='refs/ac2git/test'), 'queued')
+
+        self.state.AbortRefTransaction()
+        self.assertIsNone(self.state.refTransaction)
+        self.assertIsNone(self.state.GetPendingRef(name='master'))
+        self.assertEqual(self.state.GetLastCommitHash(ref='refs/heads/master').strip(), firstHash)
+        self.assertIsNone(self.state.gitRepo.raw_cmd([ 'git', 'rev-parse', '--verify', '-q', 'refs/ac2git/test' ]))
+
+    def test_commit(self):
+        firstHash = CommitTransaction(self.path, 'refs/heads/master', 1, { 'file': '1' })
+        secondHash = CommitTransaction(self.path, 'refs/heads/scratch', 2, { 'file': '2' })
+        self.state.BeginRefTransaction()
+        self.assertTrue(self.state.UpdateAndCheckoutRef(ref='refs/heads/master', commitHash=secondHash, checkout=False, oldCommitHash=firstHash))
+        self.state.WriteFileRef(ref='refs/ac2git/test', text='queued')
+        self.assertTrue(self.state.CommitRefTransaction())
+        self.assertEqual(self.state.gitRepo.raw_cmd([ 'git', 'rev-parse', 'refs/heads/master' ]).strip(), secondHash)
+        self.assertEqual(self.state.ReadFileRef(ref='refs/ac2git/test'), 'queued')
+
+class CommitHistoryTest(AccuRev2GitTestCase):
+    def setUp(self):
+        super(CommitHistoryTest, self).setUp()
+        self.stream = types.SimpleNamespace(name='MyStream', streamNumber=5, depotName='1')
+        self.historyRef = self.state.GetStreamCommitHistoryRef(depot=1, streamNumber=5)
+        self.branchCommits = [ CommitTransaction(self.path, 'refs/heads/scratch', trId, { 'file': str(trId) }) for trId in [ 1, 2, 3 ] ]
+
+    def Log(self):
+        log = subprocess.check_output([ 'git', 'log', '--first-parent', '--reverse', '--format=%P|%s|%an|%ct', self.historyRef ], cwd=self.path).decode('utf-8')
+        return [ line.split('|') for line in log.strip().split('\n') ]
+
+    def test_commits_are_written_once_per_ref_transaction(self):
+        self.state.BeginRefTransaction()
+        with mock.patch.object(self.state.gitRepo, 'write_objects', wraps=self.state.gitRepo.write_objects) as writeObjects:
+            for trId, commitHash in zip([ 4, 5, 6 ], self.branchCommits):
+                self.state.LogBranchState(stream=self.stream, tr=Transaction(trId), commitHash=commitHash)
+            self.assertEqual(writeObjects.call_count, 0)
+            self.assertIsNone(self.state.gitRepo.raw_cmd([ 'git', 'rev-parse', '--verify', '-q', self.historyRef ]))
+            self.assertTrue(self.state.CommitRefTransaction())
+            self.assertEqual(writeObjects.call_count, 1)
+
+        log = self.Log()
+        self.assertEqual([ len(parents.split()) for parents, subject, author, timestamp in log ], [ 0, 2, 2, 2 ])
+        self.assertEqual([ parents.split()[1] for parents, subject, author, timestamp in log[1:] ], self.branchCommits)
+        self.assertEqual([ subject for parents, subject, author, timestamp in log ], [ 'transaction 4', 'transaction 4', 'transaction 5', 'transaction 6' ])
+        self.assertEqual(set([ (author, timestamp) for parents, subject, author, timestamp in log ]), set([ ('Joe', '1435753800') ]))
+        subprocess.check_output([ 'git', 'fsck', '--strict' ], cwd=self.path)
+
+    def test_without_a_ref_transaction(self):
+        self.state.LogBranchState(stream=self.stream, tr=Transaction(4), commitHash=self.branchCommits[0])
+        self.state.LogBranchState(stream=self.stream, tr=Transaction(5), commitHash=self.branchCommits[1])
+        self.assertEqual([ parents.split()[1] for parents, subject, author, timestamp in self.Log()[1:] ], self.branchCommits[:2])
+
+    def test_aborted_ref_transaction(self):
+        self.state.LogBranchState(stream=self.stream, tr=Transaction(4), commitHash=self.branchCommits[0])
+        self.state.BeginRefTransaction()
+        self.state.LogBranchState(stream=self.stream, tr=Transaction(5), commitHash=self.branchCommits[1])
+        self.state.AbortRefTransaction()
+        self.state.LogBranchState(stream=self.stream, tr=Transaction(6), commitHash=self.branchCommits[2])
+        self.assertEqual([ parents.split()[1] for parents, subject, author, timestamp in self.Log()[1:] ], [ self.branchCommits[0], self.branchCommits[2] ])
+
+class BranchPositionsTest(AccuRev2GitTestCase):
+    def setUp(self):
+        super(BranchPositionsTest, self).setUp()
+        self.stream = types.SimpleNamespace(name='MyStream', streamNumber=5, depotName='1')
+        self.historyRef = self.state.GetStreamCommitHistoryRef(depot=1, streamNumber=5)
+        self.branchCommits = [ CommitTransaction(self.path, 'refs/heads/scratch', trId, { 'file': str(trId) }) for trId in range(1, 7) ]
+        # The minutes are out of order at transaction 4, as a timelock or clock skew could leave them.
+        self.minutes = [ 0, 10, 20, 15, 30, 40 ]
+        self.LogBranchStates(range(0, 4))
+
+    def LogBranchStates(self, indexes):
+        for i in indexes:
+            self.state.LogBranchState(stream=self.stream, tr=Transaction(i + 1, time=datetime.datetime(2015, 7, 1, 12, self.minutes[i])), commitHash=self.branchCommits[i])
+
+    # What `git log --before` finds, which is how the branch positions used to be looked up.
+    def GitLogPosition(self, timestamp):
+        parents = subprocess.check_output([ 'git', 'log', '--first-parent', '-1', '--format=%P', '--before={0}'.format(timestamp), self.historyRef ], cwd=self.path).decode('utf-8').split()
+        return parents[1] if len(parents) > 1 else None
+
+    def assertSameAsGitLog(self, state):
+        start = ac2git.accurev.GetTimestamp(datetime.datetime(2015, 7, 1, 11, 55))
+        for timestamp in range(int(start), int(start) + 50 * 60, 150):
+            self.assertEqual(state.GetBranchPosition(ref=self.historyRef, timestamp=timestamp), self.GitLogPosition(timestamp), "timestamp {0}".format(timestamp))
+
+    def test_same_as_git_log(self):
+        self.assertSameAsGitLog(self.state)
+        self.assertEqual(self.state.GetBranchPosition(ref=self.historyRef), self.branchCommits[3])
+
+    def test_persisted_positions(self):
+        self.state.SaveBranchPositions()
+        self.LogBranchStates(range(4, 6)) # Not saved, read from the commit_history ref on load.
+
+        state = ac2git.AccuRev2Git(config=self.state.config)
+        state.gitRepo, state.GetDepot = self.state.gitRepo, self.state.GetDepot
+        with mock.patch.object(state.gitRepo, 'raw_cmd', wraps=state.gitRepo.raw_cmd) as rawCmd:
+            self.assertEqual(state.GetBranchPosition(ref=self.historyRef), self.branchCommits[5])
+            logCommands = [ call[0][0] for call in rawCmd.call_args_list if call[0][0][1] == 'log' ]
+        self.assertEqual(len(logCommands), 1)
+        self.assertEqual(len(logCommands[0][-1]), 41) # Only the commits after the persisted tip, ^<tip>.
+        self.assertSameAsGitLog(state)
+
+    def test_rewritten_ref_is_rebuilt(self):
+        self.state.SaveBranchPositions()
+        subprocess.check_output([ 'git', 'update-ref', '-d', self.historyRef ], cwd=self.path)
+        self.state.commitHistoryTips, self.state.branchPositions = {}, {}
+        self.LogBranchStates(range(4, 6))
+
+        state = ac2git.AccuRev2Git(config=self.state.config)
+        state.gitRepo, state.GetDepot = self.state.gitRepo, self.state.GetDepot
+        self.assertEqual(state.LoadBranchPositions(ref=self.historyRef)["commits"], self.branchCommits[4:6])
+        self.assertSameAsGitLog(state)
+
+class StateJournalTest(AccuRev2GitTestCase):
+    def setUp(self):
+        super(StateJournalTest, self).setUp()
+        self.stateRef = 'refs/ac2git/state/depots/1/last'
+        self.journalPath = self.state.GetStateJournalPath(depotNumber=1)
+        self.checkpoint = { "last_transaction": 10, "stream_map": {}, "branch_list": [ Branch('a', 'a1', True), Branch('b', 'b1', False) ] }
+
+    def Load(self):
+        stateHash = self.state.GitRevParse(self.stateRef)
+        state = json.loads(self.state.ReadFileRef(ref=self.stateRef))
+        return self.state.LoadStateJournal(journalPath=self.journalPath, stateHash=stateHash, state=state)
+
+    def test_replay(self):
+        self.state.WriteStateCheckpoint(ref=self.stateRef, state=self.checkpoint, journalPath=self.journalPath)
+        self.state.AppendStateJournal(trId=11, branchList=[ Branch('b', 'b2', False) ])
+        self.state.AppendStateJournal(trId=13, branchList=[ Branch('a', 'a1', False), Branch('c', 'c1', True) ])
+        state = self.Load()
+        self.assertEqual(state["last_transaction"], 13)
+        self.assertEqual(state["branch_list"], [ Branch('a', 'a1', False), Branch('b', 'b2', False), Branch('c', 'c1', True) ])
+
+    def test_new_checkpoint_starts_a_new_journal(self):
+        self.state.WriteStateCheckpoint(ref=self.stateRef, state=self.checkpoint, journalPath=self.journalPath)
+        self.state.AppendStateJournal(trId=11, branchList=[ Branch('b', 'b2', False) ])
+        self.checkpoint["last_transaction"], self.checkpoint["branch_list"][1] = 12, Branch('b', 'b3', False)
+        self.state.WriteStateCheckpoint(ref=self.stateRef, state=self.checkpoint, journalPath=self.journalPath)
+        self.state.CloseStateJournal()
+        with open(self.journalPath) as f:
+            self.assertEqual(len(f.read().splitlines()), 1)
+        self.assertEqual(self.Load(), self.checkpoint)
+
+    def test_journal_of_another_checkpoint_is_ignored(self):
+        self.state.WriteStateCheckpoint(ref=self.stateRef, state=self.checkpoint, journalPath=self.journalPath)
+        self.state.AppendStateJournal(trId=11, branchList=[ Branch('b', 'b2', False) ])
+        self.state.gitRepo.raw_cmd([ 'git', 'update-ref', self.stateRef, self.state.gitRepo.hash_object(json.dumps(dict(self.checkpoint, last_transaction=9))) ])
+        state = self.Load()
+        self.assertEqual((state["last_transaction"], state["branch_list"]), (9, self.checkpoint["branch_list"]))
+
+    def test_partially_written_entry(self):
+        self.state.WriteStateCheckpoint(ref=self.stateRef, state=self.checkpoint, journalPath=self.journalPath)
+        self.state.AppendStateJournal(trId=11, branchList=[ Branch('b', 'b2', False) ])
+        self.state.stateJournal.write('{"last_transaction": 12, "branch_l')
+        self.state.CloseStateJournal()
+        state = self.Load()
+        self.assertEqual(state["last_transaction"], 11)
+        self.assertEqual(state["branch_list"], [ Branch('a', 'a1', True), Branch('b', 'b2', False) ])
+
+class DepotManifestTest(AccuRev2GitTestCase):
+    def setUp(self):
+        super(DepotManifestTest, self).setUp()
+        self.stateRef, self.dataRef, self.hwmRef = self.state.GetStreamRefs(depot=1, streamNumber=5)
+        self.stateHash = CommitTransaction(self.path, self.stateRef, 3, { 'hist.xml': '3' })
+        self.dataHash = CommitTransaction(self.path, self.dataRef, 3, { 'file': '3' })
+        self.state.WriteFileRef(ref=self.hwmRef, text='{"high-water-mark": 4}')
+
+    def test_build(self):
+        manifest = self.state.ReadDepotManifest(depot=1)
+        self.assertEqual(manifest, { "5": { "info": 3, "info-hash": self.stateHash, "data": 3, "data-hash": self.dataHash, "high-water-mark": 4 } })
+        self.assertEqual(self.state.GetDepotHighWaterMark(depot=1), 4)
+        self.assertIsNotNone(self.state.ReadFileRef(ref=self.state.GetDepotManifestRef(depot=1)))
+
+    def test_update_only_the_refs_that_moved(self):
+        self.state.ReadDepotManifest(depot=1)
+        stateHash = CommitTransaction(self.path, self.stateRef, 8, { 'hist.xml': '8' })
+        self.state.UpdateDepotManifest(depot=1, streamNumber=5, highWaterMark=8)
+        manifest = self.state.ReadDepotManifest(depot=1)
+        self.assertEqual(manifest["5"], { "info": 8, "info-hash": stateHash, "data": 3, "data-hash": self.dataHash, "high-water-mark": 8 })
+
+        self.state.UpdateDepotManifest(depot=1, streamNumber=5)
+        self.assertEqual(self.state.ReadDepotManifest(depot=1), manifest)
+
+if __name__ == '__main__':
+    unittest.main()
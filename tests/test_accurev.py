@@ -0,0 +1,325 @@
+import datetime
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+from unittest import mock
+
+import accurev
+
+class CommandKindTest(unittest.TestCase):
+    def test_streams_command_with_options(self):
+        cmd, xmlFilter, useCache = accurev.raw.show._streamsCommand(depot="MyDepot", timeSpec="12", stream="MyStream", isXmlOutput=True, includeHasDefaultGroupAttribute=True)
+        self.assertEqual(accurev.raw.CommandCache.CommandKind(cmd), "show streams")
+        self.assertEqual(accurev.raw.CommandCache.CommandCost("show streams"), accurev.raw.CommandCache.commandCost["show streams"])
+
+    def test_hist_range(self):
+        self.assertEqual(accurev.raw.CommandCache.CommandKind([ "accurev", "hist", "-p", "MyDepot", "-t", "10-20" ]), "hist range")
+        self.assertEqual(accurev.raw.CommandCache.CommandKind([ "accurev", "hist", "-p", "MyDepot", "-t", "20" ]), "hist")
+
+    def test_unknown(self):
+        self.assertEqual(accurev.raw.CommandCache.CommandKind([ "accurev", "diff", "-a" ]), "diff")
+        self.assertIsNone(accurev.raw.CommandCache.CommandKind([ "accurev" ]))
+
+class SplitHistTest(unittest.TestCase):
+    pageXml = '''<?xml version="1.0" encoding="utf-8"?>
+<AcResponse
+    Command="hist"
+    TaskId="4321">
+  <transaction
+      id="10"
+      type="promote"
+      time="1400000000"
+      user="bob"
+      streamName="Child"
+      streamNumber="2"
+      fromStreamName="Child_bob"
+      fromStreamNumber="3">
+    <comment>café &amp; crème</comment>
+    <version
+        path="/./a.txt"
+        eid="5"
+        virtual="2/1"
+        real="3/1"/>
+  </transaction>
+  <transaction
+      id="11"
+      type="promote"
+      time="1400000001"
+      user="bob"
+      streamName="Root"
+      streamNumber="1">
+    <comment>no source</comment>
+  </transaction>
+  <transaction
+      id="12"
+      type="chstream"
+      time="1400000002"
+      user="bob"
+      streamName="Gone"
+      streamNumber="9">
+    <comment/>
+  </transaction>
+  <streams>
+    <stream
+        name="Root"
+        streamNumber="1"
+        type="normal"/>
+    <stream
+        name="Child"
+        streamNumber="2"
+        basisStreamNumber="1"
+        type="normal"/>
+    <stream
+        name="Child_bob"
+        streamNumber="3"
+        basisStreamNumber="2"
+        type="workspace"/>
+  </streams>
+</AcResponse>
+'''
+
+    def test_split(self):
+        items = accurev.obj.History.splitxmlstring(self.pageXml)
+        self.assertEqual([ item[0] for item in items ], [ 10, 11, 12 ])
+
+        trId, hist, histXml = items[0]
+        self.assertEqual(histXml, '''<?xml version="1.0" encoding="utf-8"?>
+<AcResponse
+    Command="hist"
+    TaskId="4321">
+  <transaction
+      id="10"
+      type="promote"
+      time="1400000000"
+      user="bob"
+      streamName="Child"
+      streamNumber="2"
+      fromStreamName="Child_bob"
+      fromStreamNumber="3">
+    <comment>café &amp; crème</comment>
+    <version
+        path="/./a.txt"
+        eid="5"
+        virtual="2/1"
+        real="3/1"/>
+  </transaction>
+  <streams>
+    <stream
+        name="Child"
+        streamNumber="2"
+        basisStreamNumber="1"
+        type="normal"/>
+    <stream
+        name="Child_bob"
+        streamNumber="3"
+        basisStreamNumber="2"
+        type="workspace"/>
+  </streams>
+</AcResponse>
+''')
+        self.assertEqual(hist.transactions[0].comment, 'café & crème')
+        self.assertEqual([ stream.streamNumber for stream in hist.streams ], [ 2, 3 ])
+
+    def test_transactions_that_cant_be_split_out(self):
+        items = accurev.obj.History.splitxmlstring(self.pageXml)
+        self.assertEqual(items[1], (11, None, None)) # A promote without a fromStreamNumber.
+        self.assertEqual(items[2], (12, None, None)) # A stream that isn't in the page's streams list.
+
+    def test_malformed(self):
+        self.assertIsNone(accurev.obj.History.splitxmlstring(self.pageXml[:-20]))
+
+class StreamTimelineTest(unittest.TestCase):
+    streamsXml = '<streams><stream name="MyDepot" depotName="MyDepot" streamNumber="1" isDynamic="true" type="normal" startTime="0" hasDefaultGroup="false"/></streams>'
+
+    # Loads a timeline from a fake depot history, hist -k <type> returns the transactions of that type.
+    def load(self, transactions, start=1, end=20, seedStreamsXml=None):
+        def fakeHist(depot, timeSpec, transactionKind, useCache):
+            return accurev.obj.History(transactions=[ accurev.obj.Transaction(id=trId, Type=trType, time=None, user=None, comment=None) for trId, trType in transactions if trType == transactionKind ])
+        timeline = accurev.ext.StreamTimeline(depot="MyDepot")
+        with mock.patch.object(accurev, "hist", side_effect=fakeHist) as histMock:
+            timeline.Load(startTransaction=start, endTransaction=end, seedStreamsXml=seedStreamsXml)
+        self.assertEqual(sorted([ call[1]["transactionKind"] for call in histMock.call_args_list ]), sorted(accurev.ext.StreamTimeline.definitionTransactionTypes))
+        for call in histMock.call_args_list:
+            self.assertEqual(call[1]["timeSpec"], "{0}-{1}".format(end, start))
+        return timeline
+
+    def test_only_stream_definition_changes_are_boundaries(self):
+        timeline = self.load([ (18, "purge"), (15, "promote"), (12, "dispatch"), (10, "keep"), (7, "defcomp"), (5, "chstream"), (3, "mkstream"), (2, "archive") ])
+        self.assertEqual(timeline.epochs, [ 1, 3, 5, 7 ])
+
+    def test_epoch(self):
+        timeline = self.load([ (10, "chstream"), (5, "mkstream"), (25, "chstream") ], start=3)
+        self.assertEqual(timeline.epochs, [ 3, 5, 10 ])
+        self.assertEqual(timeline.Epoch(3), 3)
+        self.assertEqual(timeline.Epoch(4), 3)
+        self.assertEqual(timeline.Epoch(5), 5)
+        self.assertEqual(timeline.Epoch(12), 10)
+        self.assertEqual(timeline.Epoch(20), 10)
+        self.assertIsNone(timeline.Epoch(21))
+        self.assertIsNone(timeline.Epoch(2))
+        self.assertIsNone(timeline.Epoch("highest"))
+
+    def test_streams_are_queried_once_per_epoch(self):
+        timeline = self.load([ (10, "mkstream") ])
+        with mock.patch.object(accurev.raw.show, "streams", return_value=self.streamsXml) as showMock:
+            for tr in [ 10, 11, 12, 20 ]:
+                streams, streamsXml = timeline.Streams(tr)
+                self.assertEqual(streamsXml, self.streamsXml)
+                self.assertIsNotNone(streams.getStream(1))
+        self.assertEqual(showMock.call_count, 1)
+        self.assertEqual(showMock.call_args[1]["timeSpec"], 10)
+
+    def test_seeded_epoch_isnt_queried(self):
+        timeline = self.load([ (10, "mkstream") ], seedStreamsXml=self.streamsXml)
+        with mock.patch.object(accurev.raw.show, "streams", side_effect=AssertionError("show streams was run")):
+            self.assertEqual(timeline.Streams(15)[1], self.streamsXml)
+
+    def test_failed_load_leaves_the_timeline_unloaded(self):
+        timeline = accurev.ext.StreamTimeline(depot="MyDepot")
+        with mock.patch.object(accurev, "hist", return_value=None):
+            self.assertIsNone(timeline.Load(startTransaction=1, endTransaction=20, seedStreamsXml=self.streamsXml))
+        self.assertFalse(timeline.IsLoaded())
+        with mock.patch.object(accurev.raw.show, "streams", side_effect=AssertionError("show streams was run")):
+            self.assertEqual(timeline.Streams(5), (None, None))
+            self.assertIsNone(timeline.GetStream(stream=1, transaction=20))
+
+class MultiDeepHistTest(unittest.TestCase):
+    # (id, type, destination stream number) of the fake depot history. Root (1) is created at 1, A (2) at 3 and B (3) at 6, both on Root.
+    transactions = [ (1, "mkstream", 1), (2, "promote", 1), (3, "mkstream", 2), (4, "promote", 1), (5, "promote", 2), (6, "mkstream", 3), (7, "promote", 1), (8, "promote", 3), (9, "keep", 2), (10, "promote", 2) ]
+    streams = [ (1, "Root", None), (2, "A", 1), (3, "B", 1) ]
+
+    def setUp(self):
+        self.histCalls = []
+        self.showCalls = []
+
+    def fakeHist(self, depot, timeSpec, transactionKind=None, useCache=False):
+        self.histCalls.append( (timeSpec, transactionKind) )
+        end, start = [ int(tr) for tr in timeSpec.split('-') ]
+        transactions = [ accurev.obj.Transaction(id=trId, Type=trType, time=None, user=None, comment=None, streamNumber=streamNumber) for trId, trType, streamNumber in self.transactions if start <= trId <= end and (transactionKind is None or trType == transactionKind) ]
+        return accurev.obj.History(transactions=transactions)
+
+    def fakeShowStreams(self, depot, timeSpec, **kwargs):
+        self.showCalls.append(timeSpec)
+        created = [ streamNumber for trId, trType, streamNumber in self.transactions if trType == "mkstream" and trId <= int(timeSpec) ]
+        streamsXml = ''.join([ '<stream name="{0}" streamNumber="{1}" {2}type="normal"/>'.format(name, number, 'basisStreamNumber="{0}" '.format(basis) if basis is not None else '') for number, name, basis in self.streams if number in created ])
+        return '<streams>{0}</streams>'.format(streamsXml)
+
+    def test_accurev_calls(self):
+        with mock.patch.object(accurev, "hist", side_effect=self.fakeHist), mock.patch.object(accurev.raw.show, "streams", side_effect=self.fakeShowStreams):
+            trLists, affected = accurev.ext.multi_deep_hist(depot="MyDepot", streams=[ 2, 3 ], timeSpec="1-10", pageSize=4)
+
+        self.assertEqual([ tr.id for tr in trLists[2] ], [ 3, 4, 5, 7, 9, 10 ])
+        self.assertEqual([ tr.id for tr in trLists[3] ], [ 6, 7, 8 ])
+        self.assertEqual(affected[7], set([ 2, 3 ]))
+        self.assertNotIn(2, affected)
+
+        # One hist per stream definition type for the timeline and one per page, one show streams per epoch.
+        self.assertEqual(sorted([ kind for timeSpec, kind in self.histCalls if kind is not None ]), sorted(accurev.ext.StreamTimeline.definitionTransactionTypes))
+        self.assertEqual([ timeSpec for timeSpec, kind in self.histCalls if kind is None ], [ "4-1", "8-5", "10-9" ])
+        self.assertEqual(self.showCalls, [ 1, 3, 6 ])
+
+    def test_hist_page_callback(self):
+        pages = []
+        def histPage(pageStart, pageEnd):
+            pages.append( (pageStart, pageEnd) )
+            return self.fakeHist(depot="MyDepot", timeSpec="{0}-{1}".format(pageEnd, pageStart)).transactions
+        with mock.patch.object(accurev, "hist", side_effect=self.fakeHist), mock.patch.object(accurev.raw.show, "streams", side_effect=self.fakeShowStreams):
+            trLists, affected = accurev.ext.multi_deep_hist(depot="MyDepot", streams=[ 2 ], timeSpec="3-10", pageSize=5, histPage=histPage)
+        self.assertEqual(pages, [ (3, 7), (8, 10) ])
+        self.assertEqual([ tr.id for tr in trLists[2] ], [ 3, 4, 5, 7, 9, 10 ])
+
+class HistIntervalCacheTest(unittest.TestCase):
+    # Returns the `accurev hist -s <stream> -t <start>-<end>` XML output for a stream with a promote at every third transaction.
+    @staticmethod
+    def fakeRawHist(depot=None, stream=None, timeSpec=None, **kwargs):
+        start, end = [ int(tr) for tr in timeSpec.split('-') ]
+        transactions = [ '<transaction id="{0}" type="promote" time="{1}" user="joe"><comment>tr. {0}</comment><version path="/./file" eid="1" virtual="1/{0}" real="1/{0}"/></transaction>'.format(trId, 1400000000 + trId) for trId in range(start, end + 1) if trId % 3 == 0 ]
+        return '<AcResponse Command="hist" TaskId="1">{0}</AcResponse>'.format(''.join(transactions))
+
+    def setUp(self):
+        self.cache = accurev.ext.HistIntervalCache(depot="MyDepot")
+
+    def hist(self, start, end):
+        with mock.patch.object(accurev.raw, "hist", side_effect=self.fakeRawHist) as histMock:
+            history = self.cache.hist(stream="MyStream", streamNumber=5, start=start, end=end)
+        return [ tr.id for tr in history.transactions ], [ call[1]["timeSpec"] for call in histMock.call_args_list ]
+
+    def test_merge(self):
+        self.assertEqual(self.hist(10, 20), ([ 12, 15, 18 ], [ "10-20" ]))
+        self.assertEqual(self.hist(30, 40), ([ 30, 33, 36, 39 ], [ "30-40" ]))
+        self.assertEqual([ (i.start, i.end) for i in self.cache.streams[5] ], [ (10, 20), (30, 40) ])
+
+        # Only the gaps are retrieved and the overlapping and adjacent intervals are merged.
+        self.assertEqual(self.hist(5, 45), ([ 6, 9, 12, 15, 18, 21, 24, 27, 30, 33, 36, 39, 42, 45 ], [ "5-9", "21-29", "41-45" ]))
+        self.assertEqual([ (i.start, i.end) for i in self.cache.streams[5] ], [ (5, 45) ])
+        self.assertEqual(self.hist(12, 30), ([ 12, 15, 18, 21, 24, 27, 30 ], []))
+        self.assertEqual((self.cache.hits, self.cache.misses), (1, 3))
+
+    def test_gaps(self):
+        self.hist(10, 20)
+        self.hist(31, 40)
+        self.assertEqual(self.cache.Gaps(streamNumber=5, start=1, end=50), [ (1, 9), (21, 30), (41, 50) ])
+        self.assertEqual(self.cache.Gaps(streamNumber=5, start=12, end=18), [])
+        self.assertEqual(self.cache.Gaps(streamNumber=6, start=12, end=18), [ (12, 18) ])
+
+    def test_only_the_transaction_headers_are_kept(self):
+        self.hist(1, 10)
+        tr = self.cache.streams[5][0].transactions[0]
+        self.assertEqual((tr.id, tr.Type, tr.time, tr.user, tr.comment, tr.versions), (3, "promote", datetime.datetime.utcfromtimestamp(1400000003), "joe", None, []))
+
+    def test_json_round_trip(self):
+        self.hist(10, 20)
+        self.hist(30, 40)
+        jsonText = self.cache.tojson()
+        self.assertNotIn("tr. 12", jsonText)
+        cache = accurev.ext.HistIntervalCache.fromjson(jsonText)
+        self.assertEqual(cache.depot, "MyDepot")
+        self.assertEqual([ (i.start, i.end) for i in cache.streams[5] ], [ (10, 20), (30, 40) ])
+        for interval, loaded in zip(self.cache.streams[5], cache.streams[5]):
+            self.assertEqual([ (tr.id, tr.Type, tr.time, tr.user) for tr in interval.transactions ], [ (tr.id, tr.Type, tr.time, tr.user) for tr in loaded.transactions ])
+        self.assertEqual(cache.tojson(), jsonText)
+
+    def test_json_is_capped(self):
+        self.hist(10, 20)
+        self.hist(30, 40)
+        with mock.patch.object(accurev.ext.HistIntervalCache, "maxTransactions", 5):
+            cache = accurev.ext.HistIntervalCache.fromjson(self.cache.tojson())
+        self.assertEqual([ (i.start, i.end) for i in cache.streams[5] ], [ (30, 40) ]) # The interval that ends the earliest is dropped first.
+
+class CommandCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp(prefix='ac2git_test_')
+        self.cache = accurev.raw.CommandCache(os.path.join(self.path, 'cache.sqlite3'), commitInterval=1)
+        self.cache.Open()
+
+    def tearDown(self):
+        self.cache.Close()
+        shutil.rmtree(self.path)
+
+    def test_total_size(self):
+        cmd = [ "accurev", "hist", "-p", "MyDepot", "-t", "10" ]
+        self.cache.Add(cmd=cmd, result=0, stdout="a" * 1000)
+        self.cache.Add(cmd=cmd, result=0, stdout="b" * 5000)
+        self.assertEqual(self.cache.totalSize, self.cache.StoredSize())
+        self.cache.Add(cmd=[ "accurev", "hist", "-p", "MyDepot", "-t", "11" ], result=0, stdout="c")
+        self.cache.Remove(cmd=cmd)
+        self.assertEqual(self.cache.totalSize, self.cache.StoredSize())
+        self.assertIsNone(self.cache.Get(cmd=cmd))
+
+    def test_new_entries_dont_look_up_the_old_size(self):
+        with mock.patch.object(self.cache, 'EntrySize', side_effect=AssertionError("EntrySize was called")):
+            self.cache.Add(cmd=[ "accurev", "hist", "-p", "MyDepot", "-t", "12" ], result=0, stdout="d" * 100)
+        self.assertEqual(self.cache.totalSize, self.cache.StoredSize())
+
+class LastCommandTest(unittest.TestCase):
+    def test_last_command_is_per_thread(self):
+        accurev.raw._runCommand([ "false" ])
+        thread = threading.Thread(target=accurev.raw._runCommand, args=([ "true" ],))
+        thread.start()
+        thread.join()
+        self.assertEqual(accurev.raw._commandState.lastCommand.returncode, 1)
+
+if __name__ == '__main__':
+    unittest.main()
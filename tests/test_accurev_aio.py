@@ -0,0 +1,65 @@
+import asyncio
+import unittest
+from unittest import mock
+
+import accurev
+from accurev_aio import aio
+
+class AioTest(unittest.TestCase):
+    def setUp(self):
+        self.maxConcurrentCommands = aio.maxConcurrentCommands
+
+    def tearDown(self):
+        aio.set_max_concurrent_commands(self.maxConcurrentCommands)
+
+    def test_run_command(self):
+        self.assertEqual(asyncio.run(aio._runCommand([ "echo", "hello" ])), "hello\n")
+
+    def test_same_command_lines_as_raw(self):
+        commands = []
+        async def fakeRunCommand(cmd, outputFilename=None, useCache=False):
+            commands.append(cmd)
+            return ""
+        with mock.patch.object(aio, "_runCommand", side_effect=fakeRunCommand):
+            asyncio.run(aio.raw.hist(depot="MyDepot", timeSpec="10-1", isXmlOutput=True))
+            asyncio.run(aio.raw.show.streams(depot="MyDepot", timeSpec=10, isXmlOutput=True, includeHasDefaultGroupAttribute=True))
+        self.assertEqual(commands[0], accurev.raw._histCommand(depot="MyDepot", timeSpec="10-1", isXmlOutput=True)[0])
+        self.assertEqual(commands[1], accurev.raw.show._streamsCommand(depot="MyDepot", timeSpec=10, isXmlOutput=True, includeHasDefaultGroupAttribute=True)[0])
+
+    def test_parsed_output(self):
+        async def fakeRunCommand(cmd, outputFilename=None, useCache=False):
+            return '<AcResponse Command="hist" TaskId="1"><transaction id="7" type="keep"/></AcResponse>'
+        with mock.patch.object(aio, "_runCommand", side_effect=fakeRunCommand):
+            history = asyncio.run(aio.hist(depot="MyDepot", timeSpec="7"))
+        self.assertEqual([ tr.id for tr in history.transactions ], [ 7 ])
+
+    def test_cached_command_isnt_run(self):
+        cache = mock.Mock()
+        cache.Get.return_value = ([ "accurev", "hist" ], 0, "cached", "")
+        with mock.patch.object(accurev.raw, "_commandCache", cache), mock.patch("asyncio.create_subprocess_exec", side_effect=AssertionError("the command was run")):
+            self.assertEqual(asyncio.run(aio._runCommand([ "accurev", "hist" ], useCache=True)), "cached")
+
+    def test_max_concurrent_commands(self):
+        aio.set_max_concurrent_commands(2)
+        self.running, self.maxRunning = 0, 0
+        async def run():
+            return await asyncio.gather(*[ aio._runCommand([ "sleep", "0.1" ]) for i in range(6) ])
+        realExec = asyncio.create_subprocess_exec
+        async def countingExec(*args, **kwargs):
+            self.running += 1
+            self.maxRunning = max(self.maxRunning, self.running)
+            process = await realExec(*args, **kwargs)
+            realCommunicate = process.communicate
+            async def communicate(*args, **kwargs):
+                try:
+                    return await realCommunicate(*args, **kwargs)
+                finally:
+                    self.running -= 1
+            process.communicate = communicate
+            return process
+        with mock.patch("asyncio.create_subprocess_exec", side_effect=countingExec):
+            asyncio.run(run())
+        self.assertEqual(self.maxRunning, 2)
+
+if __name__ == '__main__':
+    unittest.main()
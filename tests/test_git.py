@@ -0,0 +1,176 @@
+import hashlib
+import os
+import shutil
+import subprocess
+import tempfile
+import unittest
+
+import git
+
+class LsFilesTest(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp(prefix='ac2git_test_')
+        subprocess.check_output([ 'git', 'init', '-q', self.path ])
+        for relPath in [ '.gitignore', 'a.log', 'b [1].txt', 'd/c.log', 'sub/f' ]:
+            os.makedirs(os.path.join(self.path, os.path.dirname(relPath)), exist_ok=True)
+            with open(os.path.join(self.path, relPath), 'w') as f:
+                f.write('*.log\n' if relPath == '.gitignore' else relPath)
+        subprocess.check_output([ 'git', 'init', '-q', os.path.join(self.path, 'sub') ])
+        self.repo = git.open(self.path)
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_others(self):
+        self.assertEqual(sorted(self.repo.ls_files(paths=[ '.' ], cached=True, others=True)), [ '.gitignore', 'a.log', 'b [1].txt', 'd/c.log', 'sub/' ])
+        self.assertEqual(sorted(self.repo.ls_files(paths=[ '.' ], cached=True, others=True, excludeStandard=True)), [ '.gitignore', 'b [1].txt', 'sub/' ])
+
+    def test_literal_paths_in_batches(self):
+        batchSize = git.repo.lsFilesBatchSize
+        git.repo.lsFilesBatchSize = 1
+        try:
+            self.assertEqual(sorted(self.repo.ls_files(paths=[ 'b [1].txt', 'd/c.log', 'sub/f', 'missing' ], others=True)), [ 'b [1].txt', 'd/c.log' ])
+        finally:
+            git.repo.lsFilesBatchSize = batchSize
+        self.assertEqual(self.repo.ls_files(paths=[], others=True), [])
+
+env = dict(os.environ, GIT_AUTHOR_NAME='t', GIT_AUTHOR_EMAIL='t@t', GIT_COMMITTER_NAME='t', GIT_COMMITTER_EMAIL='t@t')
+
+def MakeCommit(path, message):
+    treeHash = subprocess.check_output([ 'git', 'mktree' ], cwd=path, input=b'').decode('utf-8').strip()
+    return subprocess.check_output([ 'git', 'commit-tree', treeHash, '-m', message ], cwd=path, env=env).decode('utf-8').strip()
+
+class RepoTestCase(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp(prefix='ac2git_test_')
+        subprocess.check_output([ 'git', 'init', '-q', self.path ])
+        self.repo = git.open(self.path)
+
+    def tearDown(self):
+        self.repo.close()
+        shutil.rmtree(self.path)
+
+    def RevParse(self, rev):
+        rv = subprocess.run([ 'git', 'rev-parse', '--verify', '-q', rev ], cwd=self.path, stdout=subprocess.PIPE)
+        return rv.stdout.decode('utf-8').strip() if rv.returncode == 0 else None
+
+class RefTransactionTest(RepoTestCase):
+    def setUp(self):
+        super(RefTransactionTest, self).setUp()
+        self.first, self.second = MakeCommit(self.path, 'first'), MakeCommit(self.path, 'second')
+        subprocess.check_output([ 'git', 'update-ref', 'refs/heads/a', self.first ], cwd=self.path)
+        subprocess.check_output([ 'git', 'update-ref', 'refs/heads/b', self.first ], cwd=self.path)
+
+    def test_commit(self):
+        transaction = git.repo.ref_transaction(self.repo)
+        transaction.update(ref='refs/heads/a', newValue=self.second, oldValue=self.first)
+        transaction.update(ref='refs/heads/c', newValue=self.first)
+        transaction.update(ref='refs/heads/c', newValue=self.second)
+        transaction.delete(ref='refs/heads/b')
+        self.assertEqual(len(transaction), 3)
+        self.assertEqual(transaction.get('refs/heads/c'), self.second)
+        self.assertIsNone(transaction.get('refs/heads/b'))
+        self.assertEqual(self.RevParse('refs/heads/a'), self.first) # Nothing is applied before the commit.
+
+        self.assertTrue(transaction.commit())
+        self.assertEqual(len(transaction), 0)
+        self.assertEqual([ self.RevParse('refs/heads/a'), self.RevParse('refs/heads/b'), self.RevParse('refs/heads/c') ], [ self.second, None, self.second ])
+
+    def test_failed_commit_updates_nothing(self):
+        transaction = git.repo.ref_transaction(self.repo)
+        transaction.update(ref='refs/heads/c', newValue=self.second)
+        transaction.update(ref='refs/heads/a', newValue=self.second, oldValue=self.second)
+        transaction.update(ref='refs/heads/a', newValue=self.first, oldValue=self.first) # The first old value is kept.
+        self.assertFalse(transaction.commit())
+        self.assertEqual([ self.RevParse('refs/heads/a'), self.RevParse('refs/heads/c') ], [ self.first, None ])
+
+    def test_abort(self):
+        transaction = git.repo.ref_transaction(self.repo)
+        transaction.update(ref='refs/heads/a', newValue=self.second)
+        transaction.abort()
+        self.assertEqual(len(transaction), 0)
+        self.assertIsNone(transaction.get('refs/heads/a'))
+        self.assertTrue(transaction.commit())
+        self.assertEqual(self.RevParse('refs/heads/a'), self.first)
+
+class WriteObjectsTest(RepoTestCase):
+    author = ('Joe', 'joe@example.com', 1435753800, '+0100')
+
+    def test_make_commit_matches_git(self):
+        blobHash, blobData = self.repo.make_blob(data=u'caf\u00e9\n')
+        self.assertEqual(blobHash, self.repo.hash_object(data=u'caf\u00e9\n', write=False))
+        treeHash, treeData = self.repo.make_tree(entries={ 'b.txt': ('100644', blobHash), 'a': ('40000', self.repo.empty_tree(write=True)) })
+        self.assertEqual(treeHash, self.repo.mktree(entries=[ ('100644', 'blob', blobHash, 'b.txt'), ('040000', 'tree', self.repo.empty_tree(), 'a') ], missingOk=True))
+        first, firstData = self.repo.make_commit(tree=treeHash, message=u'first', author=self.author)
+        second, secondData = self.repo.make_commit(tree=treeHash, parents=[ first ], message=u'second\n', author=self.author, committer=('Ann', 'ann@example.com', 1435757400, -200))
+
+        self.assertTrue(self.repo.write_objects(objects=[ (blobHash, blobData) ], objType=u'blob'))
+        self.assertTrue(self.repo.write_objects(objects=[], objType=u'tree'))
+        self.assertTrue(self.repo.write_objects(objects=[ (treeHash, treeData) ], objType=u'tree'))
+        self.assertTrue(self.repo.write_objects(objects=[ (first, firstData), (second, secondData) ], objType=u'commit'))
+        self.assertEqual(self.RevParse('{0}^'.format(second)), first)
+        self.assertEqual(self.repo.read_tree(u'{0}^{{tree}}'.format(second)), (treeHash, { 'b.txt': ('100644', blobHash), 'a': ('40000', self.repo.empty_tree()) }))
+        log = subprocess.check_output([ 'git', 'log', '--format=%an <%ae> %at %ai|%cn %ci|%B', second ], cwd=self.path).decode('utf-8')
+        self.assertEqual(log, u'Joe <joe@example.com> 1435753800 2015-07-01 13:30:00 +0100|Ann 2015-07-01 11:30:00 -0200|second\n\nJoe <joe@example.com> 1435753800 2015-07-01 13:30:00 +0100|Joe 2015-07-01 13:30:00 +0100|first\n\n')
+        subprocess.check_output([ 'git', 'fsck', '--strict' ], cwd=self.path)
+
+    def test_wrong_hash(self):
+        commitHash, data = self.repo.make_commit(tree=self.repo.empty_tree(write=True), message=u'first', author=self.author)
+        self.assertFalse(self.repo.write_objects(objects=[ ('0' * 40, data) ], objType=u'commit'))
+        self.assertIsNone(self.repo.read_tree(u'{0}^{{tree}}'.format('0' * 40))[0])
+
+class NotesTest(RepoTestCase):
+    author = ('Joe', 'joe@example.com', 1435753800, '+0100')
+
+    def setUp(self):
+        super(NotesTest, self).setUp()
+        self.objects = [ hashlib.sha1(str(i).encode('utf-8')).hexdigest() for i in range(400) ]
+
+    def Write(self, notes):
+        commitHash, parent = self.repo.notes.write(notes=notes, ref='accurev', author=self.author)
+        self.assertIsNotNone(commitHash)
+        self.assertEqual(parent, self.RevParse('refs/notes/accurev'))
+        subprocess.check_output([ 'git', 'update-ref', 'refs/notes/accurev', commitHash ], cwd=self.path)
+        return commitHash
+
+    # Returns { object hash: note text } as git reads the notes.
+    def List(self):
+        notes = {}
+        for line in subprocess.check_output([ 'git', 'notes', '--ref', 'accurev', 'list' ], cwd=self.path).decode('utf-8').splitlines():
+            blobHash, objHash = line.split()
+            notes[objHash] = subprocess.check_output([ 'git', 'cat-file', 'blob', blobHash ], cwd=self.path).decode('utf-8')
+        return notes
+
+    def RootEntries(self):
+        return subprocess.check_output([ 'git', 'ls-tree', '--name-only', 'refs/notes/accurev' ], cwd=self.path).decode('utf-8').split()
+
+    def test_flat_below_257_notes(self):
+        self.Write(dict([ (objHash, 'note {0}'.format(objHash)) for objHash in self.objects[:256] ]))
+        self.assertEqual(len(self.RootEntries()), 256)
+        self.assertEqual(self.List(), dict([ (objHash, 'note {0}\n'.format(objHash)) for objHash in self.objects[:256] ]))
+
+    def test_fan_out_above_256_notes(self):
+        self.Write(dict([ (objHash, 'first') for objHash in self.objects[:200] ]))
+        self.assertTrue(all([ len(name) == 40 for name in self.RootEntries() ]))
+        self.Write(dict([ (objHash, 'second') for objHash in self.objects[100:300] ]))
+        self.assertTrue(all([ len(name) == 2 for name in self.RootEntries() ]))
+        expected = dict([ (objHash, 'first\n') for objHash in self.objects[:100] ] + [ (objHash, 'second\n') for objHash in self.objects[100:300] ])
+        self.assertEqual(self.List(), expected)
+
+        # The existing fan-out is followed.
+        self.Write({ self.objects[0]: 'third', self.objects[300]: 'third' })
+        expected.update({ self.objects[0]: 'third\n', self.objects[300]: 'third\n' })
+        self.assertEqual(self.List(), expected)
+        self.assertTrue(all([ len(name) == 2 for name in self.RootEntries() ]))
+        subprocess.check_output([ 'git', 'fsck', '--strict' ], cwd=self.path)
+
+    def test_same_note_as_git_notes_add(self):
+        commitHash = MakeCommit(self.path, 'annotated')
+        text = '  First line\n\n\n\nSecond line   \n\n'
+        self.Write({ commitHash: text })
+        written = self.List()[commitHash]
+        subprocess.check_output([ 'git', 'notes', '--ref', 'accurev', 'add', '-f', '-m', text, commitHash ], cwd=self.path, env=env)
+        self.assertEqual(self.List()[commitHash], written)
+
+if __name__ == '__main__':
+    unittest.main()